@@ -1,17 +1,32 @@
 # coding=utf-8
-import bs4, hashlib, html, opencc, re, requests, sys, threading, uuid, retrying, os, gc, psutil, logging
-from datetime import datetime
+import asyncio, bs4, hashlib, html, json, opencc, random, re, requests, sys, threading, uuid, os, gc, psutil, logging
+import bisect, collections, copy, mmap, multiprocessing, sqlite3, struct, tempfile, zipfile, zlib
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
 from io import BytesIO
 from os import path, mkdir
-from time import sleep
+from time import perf_counter, process_time, sleep, thread_time, time
 from urllib.parse import urljoin, urlparse
-from bs4 import BeautifulSoup, Tag, MarkupResemblesLocatorWarning
+from bs4 import BeautifulSoup, SoupStrainer, Tag, MarkupResemblesLocatorWarning
+from bs4.builder import builder_registry
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
 from ebooklib import epub
+from lxml import etree
 from requests import HTTPError
+from requests.adapters import HTTPAdapter
+from urllib3.connectionpool import HTTPConnectionPool, HTTPSConnectionPool
 import warnings
 
+try:
+    import aiohttp
+except ImportError:
+    aiohttp = None
+
 # 记得更改参数 t2s是繁体转简体 s2t是简体转繁体
 converter = opencc.OpenCC('t2s.json')
+# 同一次下载额外输出的文字版本，"raw"为不转换，其余为OpenCC配置名(不含.json)，例如 ["raw", "s2t"]
+# 额外版本的文件名带"_版本名"后缀，如《书名》作者_s2t.epub。章节选择模式只输出converter的版本
+extraOutputVariants = []
 # 是否为全部下载
 isDownloadAll = False
 # 全部下载的列表网址， 也可以类似 https://www.esjzone.cc/tags/R18/ 包含 /tags/?/ 或 /list-??/
@@ -20,10 +35,72 @@ bookListURL = "https://www.esjzone.me/list-01/"
 bookURL = "https://www.esjzone.cc/detail/1764496071.html"
 # 多线程数(esjzone被cloudflare反向代理的。可能有反爬虫机制，不建议调太大)
 threadNum = 4
+# 全部下载时同时下载的书籍数，书与书之间不再串行等待封面、简介和epub写入
+bookThreadNum = 2
+# 全部下载时所有书籍合计的最大同时请求数，避免 bookThreadNum*threadNum 个请求同时打到站点
+maxRequestNum = 8
+# 下载引擎 "thread"为多线程，"async"为asyncio(需要 pip install aiohttp)
+downloadEngine = "thread"
+# async引擎同时进行的最大请求数
+asyncConcurrency = 32
+# 请求失败时最多尝试的次数。只重试网络异常与408/429/5xx，404、403等不重试
+retryMaxAttempts = 3
+# 重试等待从retryBaseDelay秒开始每次翻倍并加随机抖动，最多retryMaxDelay秒。429/503按Retry-After等待，同样不超过retryMaxDelay秒
+retryBaseDelay = 1.0
+retryMaxDelay = 60.0
+# 同一站点连续retryCircuitThreshold个请求重试用尽仍失败后熔断，retryCircuitCooldown秒内该站点的请求直接失败，之后放行一个请求试探
+retryCircuitThreshold = 8
+retryCircuitCooldown = 60.0
+# 自适应限速：章节页面站点与图片站点各自用令牌桶限制每秒请求数，并限制同时请求数
+# 以threadNum为起点，响应正常且延迟未明显升高时逐步加快，遇到403/429/cloudflare验证页面时减半
+# 启用后多线程引擎的线程数为adaptiveMaxConcurrency，实际同时请求数由限速决定
+# 默认关闭，固定使用threadNum个线程。同时请求数上限默认与threadNum相同，开启后不会超过原先的并发，调大前请注意站点的反爬虫机制
+isAdaptiveRateLimit = False
+adaptiveMaxConcurrency = threadNum
+# 每秒请求数的上下限
+adaptiveMaxRate = 20.0
+adaptiveMinRate = 0.5
+# 平均延迟超过最低延迟的adaptiveLatencyFactor倍时不再加快
+adaptiveLatencyFactor = 2.0
+# 被限流后adaptiveDecreaseInterval秒内不再重复减半，之前已发出的请求接连返回429只算一次
+adaptiveDecreaseInterval = 2.0
+# 章节页面解析与繁简转换使用的进程数，0为在下载线程中处理。章节多、CPU核心多时可设为核心数
+convertProcessNum = 0
 # 站点url 可能为 https://www.esjzone.cc/ 或 https://www.esjzone.me/
 # 请确保bookListURL、bookURL、base_url的域名一致，同时esj.txt里cookie为对应的cookie！！！
 base_url = "https://www.esjzone.cc/"
 
+# 图片持久缓存目录，跨书籍、跨运行复用已下载的图片
+imgCacheDir = "./cache_esjzone/img"
+# 图片缓存大小上限(MB)，超过后淘汰最久未使用的图片。设为0不使用缓存
+imgCacheMaxMB = 2048
+# 命中缓存时是否发送条件请求(ETag/Last-Modified)确认图片未变化。False则直接使用缓存不发请求
+isImgCacheRevalidate = True
+# 章节页面缓存目录，再次下载同一本书时已缓存的章节不必重新下载
+pageCacheDir = "./cache_esjzone"
+# 章节页面缓存大小上限(MB)，超过后淘汰最久未使用的页面。设为0不使用缓存
+pageCacheMaxMB = 512
+# 有缓存的章节页面总是发送条件请求(ETag/Last-Modified)，服务器返回304时才使用缓存
+# 超过pageCacheTTLDays天未使用的页面从缓存中删除，设为0不按时间删除
+pageCacheTTLDays = 30
+# 书籍清单索引，按书籍url记录书名、作者、更新日期、章节数、文件路径及hash，全部下载时据此判断书籍是否已是最新，不必打开epub
+# 删除该文件后下次运行会从epub目录重建
+bookManifestPath = "./cache_esjzone/book_manifest.db"
+# 页面解析器："html.parser"为原先使用的解析器；"lxml"(ebooklib已依赖lxml)处理不规范的嵌套(如<p>中的<div>)时结果不同
+htmlParser = "html.parser"
+# 使用lxml时章节页面也用html.parser再解析一次比对结果，不一致时使用html.parser的结果。详情页、列表页始终比对
+# 关闭后章节页面只用lxml解析，速度较快，但不规范的页面生成的epub/txt可能与html.parser不同
+isParserParityCheck = True
+# 下载中图片的暂存方式："memory"全部保存在内存；"spooled"超过imgStoreMemoryLimitMB后写入临时文件；"mmap"全部写入临时文件，以mmap读取
+imgStoreBackend = "spooled"
+# 每本书保存在内存中的图片上限(MB)，仅spooled使用
+imgStoreMemoryLimitMB = 64
+# 全部下载时用列表页上的更新日期与书籍清单比对，未更新的书籍连详情页也不请求
+isListDateSkip = True
+# 性能统计导出目录：运行结束时写入各阶段(请求的DNS/连接/TLS/首字节/传输、解析、繁简转换、写入等)的耗时直方图、CPU时间与字节数
+# 按整次运行与每本书汇总，输出metrics_时间.json及Prometheus textfile格式的esj_metrics.prom。设为""不导出
+metricsDir = "./logs"
+
 # ============ 章节选择下载设置 ============
 # 是否只下载指定章节 (设为True启用章节选择模式)
 isSelectChapters = True
@@ -42,12 +119,25 @@ chapterRangeEnd = -1
 isMergeToExisting = True
 # ==========================================
 
+# 增量更新：已有epub时按章节url对应已有章节，章节页面发送条件请求，服务器返回304(未变化)时沿用已有epub/txt中的内容
+# 需要章节页面缓存(pageCacheMaxMB大于0)提供ETag/Last-Modified
+isIncrementalUpdate = False
+
 # 日志系统配置
-current_book_logger = None
+# 当前线程正在处理的书籍logger，多本书并行下载时各线程互不干扰
+bookLoggerLocal = threading.local()
+
+
+def get_current_book_logger():
+    return getattr(bookLoggerLocal, "logger", None)
+
+
+def set_current_book_logger(logger):
+    bookLoggerLocal.logger = logger
+
 
 def setup_book_logger(book_name, book_author):
     """为每本书设置独立的日志记录器"""
-    global current_book_logger
     
     # 创建logs文件夹
     if not path.exists("./logs"):
@@ -81,7 +171,7 @@ def setup_book_logger(book_name, book_author):
     
     logger.addHandler(file_handler)
     
-    current_book_logger = logger
+    set_current_book_logger(logger)
     return logger
 
 def log_message(message, level='info', console_only=False):
@@ -91,7 +181,7 @@ def log_message(message, level='info', console_only=False):
         level: 日志级别 ('info', 'warning', 'error')
         console_only: 如果为True，只输出到控制台不记录到文件
     """
-    global current_book_logger
+    current_book_logger = get_current_book_logger()
     
     # 控制台输出
     print(message)
@@ -106,30 +196,414 @@ def log_message(message, level='info', console_only=False):
             current_book_logger.info(message)
 
 
+# 耗时直方图的桶上限(秒)
+secondBucketList = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+
+class Histogram(object):
+    """固定桶的直方图，导出时按Prometheus的方式累计：每个桶为不大于上限的样本数"""
+
+    def __init__(self, bucketList):
+        self.bucketList = bucketList
+        # 最后一个为超过全部上限的样本数
+        self.bucketCountList = [0] * (len(bucketList) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def observe(self, value):
+        self.bucketCountList[bisect.bisect_left(self.bucketList, value)] += 1
+        self.count += 1
+        self.sum += value
+        self.max = max(self.max, value)
+
+    def cumulativeList(self):
+        """返回[(上限, 累计样本数)]，最后一项的上限为+Inf"""
+        resultList = []
+        cumulative = 0
+        for bucket, count in zip(list(self.bucketList) + ["+Inf"], self.bucketCountList):
+            cumulative += count
+            resultList.append((bucket, cumulative))
+        return resultList
+
+    def toDict(self):
+        return {"count": self.count, "sum": round(self.sum, 6), "max": round(self.max, 6),
+                "buckets": {str(bucket): count for bucket, count in self.cumulativeList()}}
+
+
+class StageStats(object):
+    """一个阶段的耗时直方图、CPU时间与字节数"""
+
+    def __init__(self):
+        self.histogram = Histogram(secondBucketList)
+        self.cpuTime = 0.0
+        self.byteCount = 0
+
+    def observe(self, wallTime, cpuTime, byteCount):
+        self.histogram.observe(wallTime)
+        self.cpuTime += cpuTime
+        self.byteCount += byteCount
+
+    def toDict(self):
+        result = self.histogram.toDict()
+        result["cpu_seconds"] = round(self.cpuTime, 6)
+        result["bytes"] = self.byteCount
+        return result
+
+
+class RunMetrics(object):
+    """汇总各阶段统计，整次运行与每本书(当前线程的书籍logger)分别记录，运行结束时由export导出
+    进程池的子进程中用beginCapture/endCapture收集样本，交回主进程用merge记入对应的书籍"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.startTime = time()
+        self.stageDict = {}
+        self.countDict = {}
+        # 书籍 -> ({阶段 -> StageStats}, {事件 -> 次数})
+        self.bookDict = {}
+        self.captureLocal = threading.local()
+
+    def beginCapture(self):
+        self.captureLocal.sampleList = []
+
+    def endCapture(self):
+        sampleList = self.captureLocal.sampleList
+        self.captureLocal.sampleList = None
+        return sampleList
+
+    def merge(self, sampleList: list):
+        for sample in sampleList:
+            self.observe(*sample)
+
+    def bookOf(self):
+        """调用时需持有self.lock，没有正在下载的书籍时返回None"""
+        bookLogger = get_current_book_logger()
+        if bookLogger is None:
+            return None
+        return self.bookDict.setdefault(bookLogger.name, ({}, {}))
+
+    def observe(self, stage, wallTime, cpuTime=0.0, byteCount=0):
+        sampleList = getattr(self.captureLocal, "sampleList", None)
+        if sampleList is not None:
+            sampleList.append((stage, wallTime, cpuTime, byteCount))
+            return
+        with self.lock:
+            self.stageDict.setdefault(stage, StageStats()).observe(wallTime, cpuTime, byteCount)
+            book = self.bookOf()
+            if book is not None:
+                book[0].setdefault(stage, StageStats()).observe(wallTime, cpuTime, byteCount)
+
+    def addCount(self, event, count=1):
+        with self.lock:
+            self.countDict[event] = self.countDict.get(event, 0) + count
+            book = self.bookOf()
+            if book is not None:
+                book[1][event] = book[1].get(event, 0) + count
+
+    def observeRequest(self, kind, timing):
+        """记录一次请求，kind为"page"或"img"。dns/connect/tls只在新建连接时记录"""
+        self.observe(kind, timing.total, timing.cpuTime, timing.byteCount)
+        for phase in ("dns", "connect", "tls"):
+            if getattr(timing, phase) > 0:
+                self.observe(f"{kind}_{phase}", getattr(timing, phase))
+        self.observe(f"{kind}_ttfb", timing.ttfb)
+        self.observe(f"{kind}_transfer", timing.transfer, 0.0, timing.byteCount)
+
+    def summary(self):
+        with self.lock:
+            stageList = sorted(self.stageDict.items(), key=lambda item: -item[1].histogram.sum)
+            countList = sorted(self.countDict.items())
+        lineList = ["各阶段耗时:"]
+        for stage, stats in stageList:
+            histogram = stats.histogram
+            lineList.append(f"  {stage}: {histogram.count} 次, 耗时 {histogram.sum:.2f}s"
+                            f"(平均 {histogram.sum / histogram.count:.3f}s, 最长 {histogram.max:.2f}s), "
+                            f"CPU {stats.cpuTime:.2f}s, {stats.byteCount / 1024 / 1024:.2f}MB")
+        if countList:
+            lineList.append("  " + ", ".join(f"{event} {count} 次" for event, count in countList))
+        return "\n".join(lineList)
+
+    def toDict(self):
+        endTime = time()
+        with self.lock:
+            return {
+                "start": datetime.fromtimestamp(self.startTime).isoformat(timespec="seconds"),
+                "end": datetime.fromtimestamp(endTime).isoformat(timespec="seconds"),
+                "wall_seconds": round(endTime - self.startTime, 3),
+                "process_cpu_seconds": round(process_time(), 3),
+                "stages": {stage: stats.toDict() for stage, stats in sorted(self.stageDict.items())},
+                "counts": dict(sorted(self.countDict.items())),
+                "books": {bookName: {"stages": {stage: stats.toDict() for stage, stats in sorted(book[0].items())},
+                                     "counts": dict(sorted(book[1].items()))}
+                          for bookName, book in self.bookDict.items()},
+            }
+
+    def prometheusText(self):
+        """Prometheus textfile格式，只含整次运行的统计，书籍数量多时不产生大量标签"""
+        lineList = ["# HELP esj_stage_duration_seconds 各阶段耗时",
+                    "# TYPE esj_stage_duration_seconds histogram"]
+        with self.lock:
+            stageList = sorted(self.stageDict.items())
+            countList = sorted(self.countDict.items())
+        for stage, stats in stageList:
+            for bucket, count in stats.histogram.cumulativeList():
+                lineList.append(f'esj_stage_duration_seconds_bucket{{stage="{stage}",le="{bucket}"}} {count}')
+            lineList.append(f'esj_stage_duration_seconds_sum{{stage="{stage}"}} {stats.histogram.sum:.6f}')
+            lineList.append(f'esj_stage_duration_seconds_count{{stage="{stage}"}} {stats.histogram.count}')
+        lineList += ["# HELP esj_stage_cpu_seconds_total 各阶段所在线程的CPU时间",
+                     "# TYPE esj_stage_cpu_seconds_total counter"]
+        lineList += [f'esj_stage_cpu_seconds_total{{stage="{stage}"}} {stats.cpuTime:.6f}' for stage, stats in stageList]
+        lineList += ["# HELP esj_stage_bytes_total 各阶段处理的字节数", "# TYPE esj_stage_bytes_total counter"]
+        lineList += [f'esj_stage_bytes_total{{stage="{stage}"}} {stats.byteCount}' for stage, stats in stageList]
+        lineList += ["# HELP esj_events_total 重试、失败等事件次数", "# TYPE esj_events_total counter"]
+        lineList += [f'esj_events_total{{event="{event}"}} {count}' for event, count in countList]
+        lineList += ["# HELP esj_run_duration_seconds 本次运行耗时", "# TYPE esj_run_duration_seconds gauge",
+                     f"esj_run_duration_seconds {time() - self.startTime:.3f}"]
+        return "\n".join(lineList) + "\n"
+
+    def export(self, outputDir):
+        """写入metrics_时间.json与esj_metrics.prom(先写临时文件再替换，textfile采集不会读到一半的文件)，返回json路径"""
+        os.makedirs(outputDir, exist_ok=True)
+        jsonPath = path.join(outputDir, f"metrics_{datetime.now().strftime('%Y%m%d_%H%M%S')}.json")
+        with open(jsonPath, "w", encoding="utf-8") as jsonFile:
+            json.dump(self.toDict(), jsonFile, ensure_ascii=False, indent=1)
+        promPath = path.join(outputDir, "esj_metrics.prom")
+        with open(promPath + ".part", "w", encoding="utf-8") as promFile:
+            promFile.write(self.prometheusText())
+        os.replace(promPath + ".part", promPath)
+        return jsonPath
+
+
+runMetrics = RunMetrics()
+
+
+class StageTimer(object):
+    """记录with块的耗时与当前线程的CPU时间，byteCount可在块内设置"""
+
+    def __init__(self, stage, byteCount=0):
+        self.stage = stage
+        self.byteCount = byteCount
+
+    def __enter__(self):
+        self.startTime = perf_counter()
+        self.startCpuTime = thread_time()
+        return self
+
+    def __exit__(self, excType, excValue, traceback):
+        runMetrics.observe(self.stage, perf_counter() - self.startTime, thread_time() - self.startCpuTime,
+                           self.byteCount)
+
+
 # esjzone 的 cookie请在浏览器中获取，将包含ews_key ews_token的cookie字符串(一行)填在脚本同文件夹下的esj.txt文件第一行
 
+class MemoryImgStore(object):
+    """图片内容保存在内存中"""
+
+    def __init__(self):
+        self.imgDict = {}
+
+    def put(self, imgFileName, content):
+        self.imgDict[imgFileName] = content
+
+    def get(self, imgFileName):
+        """返回图片内容，已释放时返回None"""
+        return self.imgDict.get(imgFileName)
+
+    def release(self, imgFileName):
+        self.imgDict.pop(imgFileName, None)
+
+    def close(self):
+        self.imgDict.clear()
+
+
+class SpooledImgStore(MemoryImgStore):
+    """内存中的图片超过memoryLimit后，之后的图片追加写入临时文件"""
+
+    def __init__(self, memoryLimit):
+        MemoryImgStore.__init__(self)
+        self.memoryLimit = memoryLimit
+        self.memoryBytes = 0
+        self.lock = threading.Lock()
+        self.tempFile = None
+        # 图片文件名 -> (临时文件中的偏移, 长度)
+        self.fileIndexDict = {}
+
+    def put(self, imgFileName, content):
+        with self.lock:
+            if self.memoryBytes + len(content) <= self.memoryLimit:
+                self.imgDict[imgFileName] = content
+                self.memoryBytes += len(content)
+                return
+            if self.tempFile is None:
+                self.tempFile = tempfile.TemporaryFile(prefix="esj_img_")
+            self.tempFile.seek(0, os.SEEK_END)
+            self.fileIndexDict[imgFileName] = (self.tempFile.tell(), len(content))
+            self.tempFile.write(content)
+
+    def get(self, imgFileName):
+        with self.lock:
+            if imgFileName in self.imgDict:
+                return self.imgDict[imgFileName]
+            if imgFileName not in self.fileIndexDict:
+                return None
+            offset, length = self.fileIndexDict[imgFileName]
+            return self.readFile(offset, length)
+
+    def readFile(self, offset, length):
+        self.tempFile.seek(offset)
+        return self.tempFile.read(length)
+
+    def release(self, imgFileName):
+        # 临时文件中的空间不回收，close时整体删除
+        with self.lock:
+            content = self.imgDict.pop(imgFileName, None)
+            if content is not None:
+                self.memoryBytes -= len(content)
+            self.fileIndexDict.pop(imgFileName, None)
+
+    def close(self):
+        with self.lock:
+            self.imgDict.clear()
+            self.fileIndexDict.clear()
+            self.memoryBytes = 0
+            if self.tempFile is not None:
+                self.tempFile.close()
+                self.tempFile = None
+
+
+class MmapImgStore(SpooledImgStore):
+    """图片全部写入临时文件，读取时返回mmap上的memoryview，交给zip写入时不再复制"""
+
+    def __init__(self):
+        SpooledImgStore.__init__(self, 0)
+        self.mmapList = []
+
+    def readFile(self, offset, length):
+        if length == 0:
+            return b""
+        if not self.mmapList or len(self.mmapList[-1]) < offset + length:
+            # 文件增长后重新映射，旧的映射可能仍被memoryview引用，close时一并关闭
+            self.tempFile.flush()
+            self.mmapList.append(mmap.mmap(self.tempFile.fileno(), 0, access=mmap.ACCESS_READ))
+        return memoryview(self.mmapList[-1])[offset:offset + length]
+
+    def close(self):
+        with self.lock:
+            for imgMmap in self.mmapList:
+                try:
+                    imgMmap.close()
+                except BufferError:
+                    # 仍有memoryview引用，随对象回收释放
+                    pass
+            self.mmapList = []
+        SpooledImgStore.close(self)
+
+
+def createImgStore():
+    if imgStoreBackend == "memory":
+        return MemoryImgStore()
+    if imgStoreBackend == "mmap":
+        return MmapImgStore()
+    return SpooledImgStore(imgStoreMemoryLimitMB * 1024 * 1024)
+
+
 class ImgThreadSafeDict(object):
     def __init__(self):
-        # 理论上用读写锁更好，但是需要第三方库
+        # 锁只保护字典登记，下载在锁外进行
         self.lock = threading.Lock()
-        self.imgByteDict = {}
+        # 图片内容，按imgStoreBackend保存在内存或临时文件中
+        self.imgStore = createImgStore()
         self.imgContentTypeDict = {}
         self.imgFilePathDict = {}
         self.imgOriginalUrlDict = {}
+        # url -> 生成的html片段，同一本书内同一url只下载一次
+        self.imgUrlResultDict = {}
+        # url -> threading.Event，正在下载的url，其他线程等待其完成
+        self.imgInFlightDict = {}
+        # 设置后新登记的图片立即写入其中全部epub，不再保留在内存中
+        self.epubWriterList = []
 
     def set(self, imgUrl):
         with self.lock:
-            imgByte, imgType, imgHash, imgContentType = getImgData(imgUrl)
-            if imgType is None:
-                log_message(f"图片下载失败: {urlHandler(imgUrl)}", 'warning')
-                return f"<p>下载失败：{html.escape(urlHandler(imgUrl))}</p>"
-            imgFileName = f"Image_{imgHash}{imgType}"
-            if imgFileName not in self.imgFilePathDict:
-                self.imgByteDict[imgFileName] = imgByte
+            if imgUrl in self.imgUrlResultDict:
+                return self.imgUrlResultDict[imgUrl]
+            inFlightEvent = self.imgInFlightDict.get(imgUrl)
+            isOwner = inFlightEvent is None
+            if isOwner:
+                inFlightEvent = threading.Event()
+                self.imgInFlightDict[imgUrl] = inFlightEvent
+        if not isOwner:
+            # 其他线程正在下载同一url，等待共享结果
+            inFlightEvent.wait()
+            return self.imgUrlResultDict[imgUrl]
+        result = f"<p>下载失败：{html.escape(urlHandler(imgUrl))}</p>"
+        try:
+            result = self.download(imgUrl)
+        finally:
+            with self.lock:
+                self.imgUrlResultDict[imgUrl] = result
+                del self.imgInFlightDict[imgUrl]
+            inFlightEvent.set()
+        return result
+
+    def download(self, imgUrl):
+        # 网络下载不持有锁
+        return self.register(imgUrl, getImgData(imgUrl))
+
+    def setFetched(self, imgUrl, imgData):
+        """登记已在外部下载好的图片(async引擎使用)，之后对该url的set直接返回结果"""
+        result = self.register(imgUrl, imgData)
+        with self.lock:
+            self.imgUrlResultDict[imgUrl] = result
+        return result
+
+    def registerExisting(self, imgFileName, content, contentType):
+        """登记已有epub中的图片，增量更新时沿用"""
+        with self.lock:
+            isNewImg = imgFileName not in self.imgFilePathDict
+            if isNewImg:
+                self.imgStore.put(imgFileName, content)
+                self.imgContentTypeDict[imgFileName] = contentType
+                self.imgFilePathDict[imgFileName] = imgFileName
+        if isNewImg:
+            self.streamImg(imgFileName)
+
+    def register(self, imgUrl, imgData):
+        imgByte, imgType, imgHash, imgContentType = imgData
+        if imgType is None:
+            log_message(f"图片下载失败: {urlHandler(imgUrl)}", 'warning')
+            return f"<p>下载失败：{html.escape(urlHandler(imgUrl))}</p>"
+        imgFileName = f"Image_{imgHash}{imgType}"
+        # 仅登记以hash命名的条目时加锁
+        with self.lock:
+            isNewImg = imgFileName not in self.imgFilePathDict
+            if isNewImg:
+                # 直接保存下载内容的buffer，不再复制一份bytes
+                self.imgStore.put(imgFileName, imgByte.getbuffer())
                 self.imgContentTypeDict[imgFileName] = imgContentType
                 self.imgFilePathDict[imgFileName] = f"{imgFileName}"
+            # 沿用的图片没有原始url，由首次下载到它的章节补上
+            if imgFileName not in self.imgOriginalUrlDict:
                 self.imgOriginalUrlDict[imgFileName] = imgUrl
-            return f"<img src='{imgFileName}'/><br>"
+        if isNewImg:
+            self.streamImg(imgFileName)
+        return f"<img src='{imgFileName}'/><br>"
+
+    def txtOf(self, imgHtml):
+        """register结果在txt中的文字：图片为原始url，下载失败为提示文字"""
+        match = re.fullmatch(r"<img src='(.*)'/><br>", imgHtml)
+        if match is None:
+            return html.unescape(re.sub(r'<[^>]+>', '', imgHtml))
+        return self.imgOriginalUrlDict[match.group(1)]
+
+    def streamImg(self, imgFileName):
+        """图片写入各版本的epub后只保留文件名与类型"""
+        if len(self.epubWriterList) == 0:
+            return
+        for epubWriter in self.epubWriterList:
+            epubWriter.writeEntry(self.imgFilePathDict[imgFileName], self.imgStore.get(imgFileName))
+        self.imgStore.release(imgFileName)
 
 
 class novelCharacterListNode(object):
@@ -139,58 +613,154 @@ class novelCharacterListNode(object):
         self.level = 0
         self.value = 0
         self.title = ""
+        # 转换前的标题，用于生成额外文字版本的标题
+        self.rawTitle = ""
         self.url = ""
         self.fatherValue = -1
+        # 文字版本，None为converter的主版本
+        self.variant = None
+        # 额外文字版本的节点，与本节点由同一次下载生成
+        self.variantNodeList = []
         # download处理
         self.content = ""
         self.txtValue = ""
         self.epubValue = epub.EpubHtml(lang="zh")
         self.lock = threading.Lock()
         self.isDone = False
-        self.isLogged = False
         self.threadNum = 0
         self.childVolumeList = []
+        # 统计用，内容写入epub后会被释放
+        self.isPasswordSkipped = False
+        self.isEmpty = False
+        # 增量更新：已有书籍中的(epub内容, txt内容, 引用的图片)，章节页面未变化时沿用
+        self.existingChapter = None
+        # 交给进程池解析的章节：(解析的Future, 页面内容, 响应头)，由finishCharacter取出
+        self.pendingParse = None
 
     def downloadCharacter(self, imgDict: ImgThreadSafeDict, threadNumValue: int = 0):
-        if self.lock.locked():
-            return
+        """下载并生成节点。章节交给进程池解析时返回解析的Future，下载线程不等待，解析完成后调用finishCharacter
+        其余情况在本线程中完成，返回None"""
+        # 工作队列保证每个节点只交给一个线程，锁仅作为防重入保护
         with self.lock:
             if self.isDone:
-                return
+                return None
             self.threadNum = threadNumValue
+            pageResult = None
             if self.isChapter:
-                characterSoup = getSoupData(urlHandler(self.url))
-                characterSoupDiv = characterSoup.find("div", {"class": "forum-content mt-3"})
-                if characterSoupDiv is None or self.url is None or len(self.url) == 0:
-                    error_msg = f"章节下载失败: {self.title} - URL: {urlHandler(self.url)}"
+                content, responseHeaders = getChapterContent(self.url)
+                if self.isUnchanged(content, responseHeaders):
+                    self.reuseExisting(imgDict)
+                    return None
+                parseFuture = submitChapterContent(content, self.outputVariants())
+                if parseFuture is not None:
+                    self.pendingParse = parseFuture, content, responseHeaders
+                    return parseFuture
+                pageResult = processChapterPageWithCache(self.url, content, responseHeaders, self.outputVariants())
+            self.buildCharacter(pageResult, imgDict)
+            return None
+
+    def finishCharacter(self, imgDict: ImgThreadSafeDict):
+        """进程池解析完成后生成章节，下载章节内的图片"""
+        with self.lock:
+            parseFuture, content, responseHeaders = self.pendingParse
+            self.pendingParse = None
+            pageResult = resolveChapterContent(self.url, content, responseHeaders, self.outputVariants(), parseFuture)
+            self.buildCharacter(pageResult, imgDict)
+
+    def addVariantNode(self, variant, title):
+        """额外文字版本的节点，目录位置与本节点相同"""
+        node = novelCharacterListNode()
+        node.isVolume = self.isVolume
+        node.isChapter = self.isChapter
+        node.level = self.level
+        node.value = self.value
+        node.url = self.url
+        node.fatherValue = self.fatherValue
+        node.title = title
+        node.variant = variant
+        self.variantNodeList.append(node)
+
+    def outputVariants(self):
+        return [self.variant] + [node.variant for node in self.variantNodeList]
+
+    def buildCharacter(self, pageResult, imgDict: ImgThreadSafeDict):
+        """由processChapterPage的结果(各文字版本的片段列表)生成各版本的epub/txt内容，卷节点pageResult为None"""
+        variantResultList = pageResult if pageResult else [pageResult] * (len(self.variantNodeList) + 1)
+        with StageTimer("build"):
+            isBuilt = self.buildContent(variantResultList[0], imgDict)
+            for node, pieceList in zip(self.variantNodeList, variantResultList[1:]):
+                node.buildContent(pieceList, imgDict, False)
+        self.isDone = isBuilt
+
+    def buildContent(self, pieceList, imgDict: ImgThreadSafeDict, isLogged=True):
+        """生成本节点的epub/txt内容，pieceList为None表示下载失败，False表示需要密码。下载失败返回False"""
+        if self.isChapter:
+            if pieceList is None or self.url is None or len(self.url) == 0:
+                error_msg = f"章节下载失败: {self.title} - URL: {urlHandler(self.url)}"
+                if isLogged:
                     log_message(error_msg, 'error')
-                    self.txtValue = self.title + "章节下载失败" + "\n" + urlHandler(self.url) + "\n"
-                    self.epubValue.title = self.title
-                    self.epubValue.content = \
-                        f"<html><head></head><body><h1>{html.escape(self.title)}</h1>" \
-                        f"<p>章节下载失败</p><p>{html.escape(urlHandler(self.url))}</p></body></html>"
-                    self.epubValue.file_name = f"error_novel_{self.value}.html"
-                    self.epubValue.uid = "error_novel" + str(self.value)
-                    return
-                if characterSoupDiv.find("button", {"class": "btn btn-primary btn-send-pw"}) is not None:
-                    log_message(f"章节需要密码已跳过: {self.title}", 'warning')
-                    self.content = "<p>本章节需要密码，已跳过</p>"
-                else:
-                    self.content = htmlSimplified(characterSoup, characterSoupDiv.contents, imgDict)
-                if len(re.sub('\\s', '', self.content)) == 0:
-                    log_message(f"章节内容为空: {self.title}", 'warning')
-                    self.content = "<p>【空】</p>"
-                self.txtValue = self.title + "\n" + imgTagConvert(self.content, imgDict)
-                self.epubValue.set_content(self.content)
+                notice = convertText(failedNotice, self.variant)
+                self.txtValue = self.title + notice + "\n" + urlHandler(self.url) + "\n"
                 self.epubValue.title = self.title
-                self.epubValue.file_name = f"novel_{self.value}.html"
-                self.epubValue.uid = "novel" + str(self.value)
+                self.epubValue.content = \
+                    f"<html><head></head><body><h1>{html.escape(self.title)}</h1>" \
+                    f"<p>{notice}</p><p>{html.escape(urlHandler(self.url))}</p></body></html>"
+                self.epubValue.file_name = f"error_novel_{self.value}.html"
+                self.epubValue.uid = "error_novel" + str(self.value)
+                return False
+            txtPieceList = []
+            if pieceList is False:
+                if isLogged:
+                    log_message(f"章节需要密码已跳过: {self.title}", 'warning')
+                notice = convertText(passwordNotice, self.variant)
+                self.content = f"<p>{notice}</p>"
+                txtPieceList = [(False, notice)]
+                self.isPasswordSkipped = True
             else:
-                self.txtValue = self.title + "\n"
-                self.epubValue.title = self.title
-                self.epubValue.file_name = f"volume_{self.value}.html"
-                self.epubValue.content = f"<html><head></head><body><h1>{self.title}</h1></body></html>"
-                self.epubValue.uid = "volume" + str(self.value)
+                self.content = resolveContents(pieceList, imgDict, txtPieceList)
+            if len(re.sub('\\s', '', self.content)) == 0:
+                if isLogged:
+                    log_message(f"章节内容为空: {self.title}", 'warning')
+                notice = convertText(emptyNotice, self.variant)
+                self.content = f"<p>{notice}</p>"
+                txtPieceList = [(False, notice)]
+                self.isEmpty = True
+            self.txtValue = self.title + "\n" + simplifiedTxt(txtPieceList)
+            self.epubValue.set_content(self.content)
+            self.epubValue.title = self.title
+            self.epubValue.file_name = f"novel_{self.value}.html"
+            self.epubValue.uid = "novel" + str(self.value)
+        else:
+            self.txtValue = self.title + "\n"
+            self.epubValue.title = self.title
+            self.epubValue.file_name = f"volume_{self.value}.html"
+            self.epubValue.content = f"<html><head></head><body><h1>{self.title}</h1></body></html>"
+            self.epubValue.uid = "volume" + str(self.value)
+        return True
+
+    def isUnchanged(self, content, responseHeaders):
+        """有已有内容且服务器返回304(内容来自页面缓存，没有新的响应头)"""
+        return self.existingChapter is not None and content is not None and responseHeaders is None
+
+    def reuseExisting(self, imgDict: ImgThreadSafeDict):
+        """沿用existingChapter，并登记其引用的图片"""
+        epubContent, txtValue, imgItemList = self.existingChapter
+        self.existingChapter = None
+        for imgItem in imgItemList:
+            imgDict.registerExisting(imgItem.file_name, imgItem.get_content(), imgItem.media_type)
+        self.loadExisting(epubContent, txtValue)
+
+    def loadExisting(self, epubContent: bytes, txtValue: str):
+        """沿用已有书籍中的章节内容，不再下载"""
+        self.content = epubContent.decode("utf-8")
+        # 已有文件只有主版本
+        self.isPasswordSkipped = convertText(passwordNotice) in self.content
+        self.isEmpty = convertText(emptyNotice) in self.content
+        self.txtValue = txtValue
+        self.epubValue.content = epubContent
+        self.epubValue.title = self.title
+        self.epubValue.file_name = f"novel_{self.value}.html"
+        self.epubValue.uid = "novel" + str(self.value)
         self.isDone = True
 
 
@@ -198,7 +768,7 @@ isTerminal = True
 
 
 def printProgressBar(iteration, total, prefix='', suffix='', decimals=1, length=20, fill='█', printEnd="\r"):
-    global isTerminal, current_book_logger
+    global isTerminal
     """
     Call in a loop to create terminal progress bar
     @params:
@@ -218,6 +788,7 @@ def printProgressBar(iteration, total, prefix='', suffix='', decimals=1, length=
     
     # 记录每个进度到日志文件
     progress_msg = f"==={prefix} {percent_int}% {suffix}"
+    current_book_logger = get_current_book_logger()
     if current_book_logger:
         current_book_logger.info(progress_msg)
     
@@ -243,30 +814,343 @@ def printProgressBar(iteration, total, prefix='', suffix='', decimals=1, length=
         print()
 
 
+class DownloadProgress(object):
+    """线程安全的完成计数，用于打印进度条。onCharacterDone在每个节点完成后调用(锁外)"""
+
+    def __init__(self, total, onCharacterDone=None):
+        self.lock = threading.Lock()
+        self.total = total
+        self.doneCount = 0
+        self.onCharacterDone = onCharacterDone
+
+    def finish(self, character):
+        if self.onCharacterDone is not None:
+            self.onCharacterDone(character)
+        with self.lock:
+            self.doneCount += 1
+            printProgressBar(self.doneCount, self.total, prefix='进度:', suffix=character.title, length=20)
+
+
+class DownloadTaskQueue(object):
+    """下载线程的任务队列，任务为(节点, 解析的Future)，Future为None表示需要下载
+    章节交给进程池解析时先hold占住名额，解析完成后生成任务放回队列，由空闲的线程处理。全部任务完成后get返回None"""
+
+    def __init__(self):
+        self.condition = threading.Condition()
+        self.taskDeque = collections.deque()
+        # 在队列中、正在处理或正在进程池中解析的任务数
+        self.pendingCount = 0
+
+    def put(self, task):
+        with self.condition:
+            self.pendingCount += 1
+            self.taskDeque.append(task)
+            self.condition.notify()
+
+    def hold(self):
+        """之后会由putHeld放入一个任务"""
+        with self.condition:
+            self.pendingCount += 1
+
+    def putHeld(self, task):
+        with self.condition:
+            self.taskDeque.append(task)
+            self.condition.notify()
+
+    def get(self):
+        with self.condition:
+            while len(self.taskDeque) == 0 and self.pendingCount > 0:
+                self.condition.wait()
+            return self.taskDeque.popleft() if len(self.taskDeque) > 0 else None
+
+    def done(self):
+        with self.condition:
+            self.pendingCount -= 1
+            if self.pendingCount == 0:
+                self.condition.notify_all()
+
+
 class ThreadDownload(threading.Thread):
-    def __init__(self, inputThreadNum, novelCharacterList: list, imgDict: ImgThreadSafeDict):
+    def __init__(self, inputThreadNum, taskQueue: DownloadTaskQueue, progress: DownloadProgress,
+                 imgDict: ImgThreadSafeDict):
         threading.Thread.__init__(self)
-        self.novelCharacterList = novelCharacterList
+        self.taskQueue = taskQueue
+        self.progress = progress
         self.imgDict = imgDict
         self.inputThreadNum = inputThreadNum
+        # 章节线程沿用创建它的书籍线程的logger
+        self.bookLogger = get_current_book_logger()
+        # 统计该线程处理的节点数与实际工作时间
+        self.taskCount = 0
+        self.busyTime = 0.0
 
     def run(self):
-        for character in self.novelCharacterList:
+        set_current_book_logger(self.bookLogger)
+        while True:
+            task = self.taskQueue.get()
+            if task is None:
+                return
+            character, parseFuture = task
             assert isinstance(character, novelCharacterListNode)
-            character.downloadCharacter(self.imgDict)
-            if not character.isLogged:
-                character.isLogged = True
-                printProgressBar(character.value, len(self.novelCharacterList), prefix='进度:',
-                                 suffix=character.title, length=20)
+            startTime = perf_counter()
+            try:
+                if parseFuture is None:
+                    parseFuture = character.downloadCharacter(self.imgDict, self.inputThreadNum)
+                    if parseFuture is not None:
+                        # 不等待解析，解析完成后放回队列生成章节，本线程继续下载
+                        self.taskQueue.hold()
+                        parseFuture.add_done_callback(
+                            lambda future, node=character: self.taskQueue.putHeld((node, future)))
+                        continue
+                else:
+                    character.finishCharacter(self.imgDict)
+                self.taskCount += 1
+                self.progress.finish(character)
+            finally:
+                self.busyTime += perf_counter() - startTime
+                self.taskQueue.done()
+
+
+def runDownloadWorkers(downloadList: list, imgDict: ImgThreadSafeDict, onCharacterDone=None):
+    """所有节点入队一次，由固定数量的线程领取，慢章节不会拖住其他线程"""
+    taskQueue = DownloadTaskQueue()
+    for character in downloadList:
+        taskQueue.put((character, None))
+    progress = DownloadProgress(len(downloadList), onCharacterDone)
+    threadList = [ThreadDownload(threadCount, taskQueue, progress, imgDict)
+                  for threadCount in range(downloadThreadNum())]
+    startTime = perf_counter()
+    for thread in threadList:
+        thread.start()
+    for thread in threadList:
+        thread.join()
+    wallTime = perf_counter() - startTime
+    if threadList:
+        # 每本书一行汇总
+        meanIdleTime = sum(max(wallTime - thread.busyTime, 0.0) for thread in threadList) / len(threadList)
+        log_message(f"{len(threadList)}个线程处理 {sum(thread.taskCount for thread in threadList)} 项, 耗时 {wallTime:.1f}s, "
+                    f"最长忙碌 {max(thread.busyTime for thread in threadList):.1f}s, 平均空闲 {meanIdleTime:.1f}s")
+
+
+def createTraceConfig():
+    """aiohttp的请求跟踪，把DNS解析与新建连接(TCP+TLS)的耗时写入trace_request_ctx(RequestTiming)"""
+    traceConfig = aiohttp.TraceConfig()
+
+    async def onDnsStart(session, context, params):
+        context.dnsStartTime = perf_counter()
+
+    async def onDnsEnd(session, context, params):
+        context.trace_request_ctx.dns += perf_counter() - context.dnsStartTime
+
+    async def onConnectionStart(session, context, params):
+        context.connectionStartTime = perf_counter()
+
+    async def onConnectionEnd(session, context, params):
+        # 新建连接的过程包含DNS解析
+        timing = context.trace_request_ctx
+        timing.connect += max(perf_counter() - context.connectionStartTime - timing.dns, 0.0)
+
+    traceConfig.on_dns_resolvehost_start.append(onDnsStart)
+    traceConfig.on_dns_resolvehost_end.append(onDnsEnd)
+    traceConfig.on_connection_create_start.append(onConnectionStart)
+    traceConfig.on_connection_create_end.append(onConnectionEnd)
+    return traceConfig
+
+
+class AsyncDownloadEngine(object):
+    """asyncio下载引擎，用信号量限制并发请求数，章节与图片在同一个事件循环中下载"""
+
+    def __init__(self, imgDict: ImgThreadSafeDict):
+        self.imgDict = imgDict
+        self.session = None
+        self.semaphore = None
+        # url -> asyncio.Task，同一url的图片只下载一次
+        self.imgTaskDict = {}
+
+    async def fetchOnce(self, url, requestHeaders, timeout, kind):
+        hostSlot = HostSlot(urlparse(url).netloc)
+        await hostSlot.acquireAsync()
+        try:
+            async with self.semaphore, RequestSlot():
+                # dns与connect由traceConfig写入timing。事件循环中交替执行其他请求，不统计CPU时间
+                timing = RequestTiming()
+                hostSlot.begin()
+                startTime = perf_counter()
+                try:
+                    async with self.session.get(url, headers=requestHeaders, timeout=timeout,
+                                                trace_request_ctx=timing) as response:
+                        headersTime = perf_counter()
+                        result = response.status, response.headers, await response.read()
+                except Exception:
+                    runMetrics.addCount(f"{kind}_failed")
+                    raise
+                timing.total = perf_counter() - startTime
+                timing.ttfb = max(headersTime - startTime - timing.dns - timing.connect, 0.0)
+                timing.transfer = timing.total - (headersTime - startTime)
+                timing.byteCount = len(result[2])
+                runMetrics.observeRequest(kind, timing)
+            hostSlot.setResponse(*result)
+            return result
+        finally:
+            hostSlot.release()
+
+    async def fetch(self, url, requestHeaders, connectTimeout, readTimeout, kind="page"):
+        """返回(状态码, 响应头, 内容)，失败返回None。与retryGet一致按retryPolicy重试"""
+        timeout = aiohttp.ClientTimeout(sock_connect=connectTimeout, sock_read=readTimeout)
+        host = urlparse(url).netloc
+        attempt = 0
+        while True:
+            try:
+                retryPolicy.checkCircuit(host)
+                result = await self.fetchOnce(url, requestHeaders, timeout, kind)
+            except CircuitOpenError as e:
+                log_message(f"*x*x*x*{str(e)},url={url}", 'error')
+                return None
+            except Exception as e:
+                delay = retryPolicy.onException(host, attempt, e)
+                if delay is None:
+                    log_message(f"*x*x*x*网络问题，请检测VPN等环境,url={url}\n{str(e)}", 'error')
+                    return None
+            else:
+                delay = retryPolicy.onResponse(host, attempt, result[0], result[1])
+                if delay is None:
+                    if result[0] >= 400:
+                        log_message(f"*x*x*x*http错误{result[0]},url={url}", 'error')
+                        return None
+                    return result
+            runMetrics.addCount(f"{kind}_retry")
+            await asyncio.sleep(delay)
+            retryPolicy.recordWait(delay)
+            attempt += 1
+
+    async def fetchImg(self, imgUrl):
+        task = self.imgTaskDict.get(imgUrl)
+        if task is None:
+            task = asyncio.ensure_future(self.downloadImg(imgUrl))
+            self.imgTaskDict[imgUrl] = task
+        await task
+
+    async def downloadImg(self, imgUrl):
+        imgData = None
+        cachedEntry = lookupImgCache(imgUrl)
+        if cachedEntry is not None and not isImgCacheRevalidate:
+            imgData = readImgCache(imgUrl, cachedEntry)
+            cachedEntry = None
+        # 返回304但缓存文件已丢失时imgData为None，不带条件重新下载一次
+        while imgData is None:
+            imgData = None, None, None, None
+            result = await self.fetch(urlHandler(imgUrl), conditionalImgHeaders(cachedEntry), 25, 30, "img")
+            if result is not None:
+                imgData = resolveImgResponse(imgUrl, result[0], result[1], result[2], cachedEntry)
+            cachedEntry = None
+        self.imgDict.setFetched(imgUrl, imgData)
+
+    async def processContent(self, content, variantList: list):
+        """进程池中解析章节页面，事件循环不被解析阻塞。未启用进程池时直接解析"""
+        pool = getConvertPool()
+        if pool is not None:
+            try:
+                pageResult, sampleList = await asyncio.get_running_loop().run_in_executor(
+                    pool, processChapterPageInProcess, content, variantList)
+                runMetrics.merge(sampleList)
+                return pageResult
+            except Exception as e:
+                log_message(f"进程池处理章节失败，改为直接处理: {str(e)}", 'warning')
+        return processChapterPage(content, variantList)
+
+    async def downloadCharacter(self, character: novelCharacterListNode, progress: DownloadProgress):
+        pageResult = None
+        if character.isChapter:
+            content, responseHeaders = None, None
+            cachedEntry = lookupPageCache(character.url)
+            result = await self.fetch(urlHandler(character.url), conditionalPageHeaders(cachedEntry), 10, 25)
+            if result is not None:
+                content, responseHeaders = resolveChapterResponse(character.url, result[0], result[1],
+                                                                  result[2], cachedEntry)
+            if character.isUnchanged(content, responseHeaders):
+                character.reuseExisting(self.imgDict)
+                progress.finish(character)
+                return
+            if content is not None:
+                pageResult = await self.processContent(content, character.outputVariants())
+                storeChapterContent(character.url, content, responseHeaders, pageResult)
+            if pageResult:
+                # 先并发下载章节内全部图片，之后resolveContents直接取已登记的结果
+                await asyncio.gather(*(self.fetchImg(piece[1]) for piece in pageResult[0]
+                                       if piece[0] == "img" and piece[1]))
+        character.buildCharacter(pageResult, self.imgDict)
+        progress.finish(character)
+
+    async def run(self, downloadList: list, onCharacterDone=None):
+        self.semaphore = asyncio.Semaphore(asyncConcurrency)
+        progress = DownloadProgress(len(downloadList), onCharacterDone)
+        connector = aiohttp.TCPConnector(limit=asyncConcurrency)
+        async with aiohttp.ClientSession(connector=connector, trace_configs=[createTraceConfig()]) as session:
+            self.session = session
+            await asyncio.gather(*(self.downloadCharacter(character, progress) for character in downloadList))
+
+
+def runDownload(downloadList: list, imgDict: ImgThreadSafeDict, onCharacterDone=None):
+    """按downloadEngine选择下载引擎"""
+    if downloadEngine == "async":
+        if aiohttp is not None:
+            startTime = perf_counter()
+            asyncio.run(AsyncDownloadEngine(imgDict).run(downloadList, onCharacterDone))
+            log_message(f"async引擎下载耗时 {perf_counter() - startTime:.1f}s")
+            return
+        log_message("未安装aiohttp，改用多线程下载。可执行 pip install aiohttp", 'warning')
+    runDownloadWorkers(downloadList, imgDict, onCharacterDone)
+
+
+# 章节页面只构建正文div，跳过导航、评论等其余部分
+chapterContentStrainer = SoupStrainer("div", {"class": "forum-content mt-3"})
+
+
+def getHtmlParser():
+    """htmlParser指定的解析器未安装时使用html.parser"""
+    if builder_registry.lookup(htmlParser) is None:
+        return 'html.parser'
+    return htmlParser
+
+
+def parseHtml(content, isChapterPage=False):
+    """解析页面，章节页面只解析正文。使用html.parser以外的解析器时按需与html.parser的结果比对"""
+    parser = getHtmlParser()
+    with StageTimer("parse", len(content)):
+        soup = BeautifulSoup(content, parser, parse_only=chapterContentStrainer if isChapterPage else None)
+    if parser != 'html.parser' and (isParserParityCheck or not isChapterPage):
+        with StageTimer("parse_parity", len(content)):
+            referenceSoup = BeautifulSoup(content, 'html.parser')
+            isSame = parserParityKey(soup) == parserParityKey(referenceSoup)
+        if not isSame:
+            log_message(f"{parser}解析结果与html.parser不一致，使用html.parser的结果", 'warning')
+            return referenceSoup
+    return soup
+
+
+def parserParityKey(soup: BeautifulSoup):
+    """比对解析结果用：正文转换结果、书名、简介、章节目录及列表页的书籍"""
+    keyList = []
+    for findArgs in [("div", {"class": "forum-content mt-3"}), ("div", {"class": "description"})]:
+        contentDiv = soup.find(*findArgs)
+        keyList.append(extractContents(contentDiv.contents) if contentDiv is not None else None)
+    bookNameTag = soup.find("h2")
+    keyList.append(bookNameTag.text if bookNameTag is not None else None)
+    chapterList = soup.find("div", {"id": "chapterList"})
+    if chapterList is not None:
+        keyList.append([(tag.name, tag.get("href"), tag.get_text()) for tag in chapterList.find_all(True)])
+    for bookCard in soup.find_all("div", {"class": "col-lg-3 col-md-4 col-sm-3 col-xs-6"}):
+        keyList.append(bookCard.get_text())
+    return keyList
 
 
 def getSoupData(url):
     r = DefaultResponse()
     soup = BeautifulSoup("", 'html.parser')
     try:
-        r = retryGet(urlHandler(url), headers, (10, 25))
+        r = retryGet(urlHandler(url), headers, (10, 25), getPageSession())
         r.raise_for_status()
-        soup = BeautifulSoup(r.content, 'html.parser')
+        soup = parseHtml(r.content)
     except HTTPError as e:
         log_message(f"*x*x*x*http错误{str(e)}", 'error')
     except Exception as e:
@@ -285,17 +1169,790 @@ def getSoupData(url):
     #     return soup
 
 
-class DefaultResponse:
-    def __init__(self):
-        self.status_code = None
+def getChapterContent(url):
+    """获取章节页面原始内容，有缓存时发送条件请求，服务器返回304则使用缓存
+    返回(内容, 响应头)，响应头不为None表示内容是新获取的，由storeChapterContent确认正常后写入缓存。失败时内容为None"""
+    r = DefaultResponse()
+    cachedEntry = lookupPageCache(url)
+    try:
+        r = retryGet(urlHandler(url), conditionalPageHeaders(cachedEntry), (10, 25), getPageSession())
+        r.raise_for_status()
+        return resolveChapterResponse(url, r.status_code, r.headers, r.content, cachedEntry)
+    except HTTPError as e:
+        log_message(f"*x*x*x*http错误{str(e)}", 'error')
+    except Exception as e:
+        log_message(f"*x*x*x*网络问题，请检测VPN等环境(最好使用TUN模式){str(e)}", 'error')
+    finally:
+        r.close()
+    return None, None
+
+
+def resolveChapterResponse(url, statusCode, responseHeaders, content, cachedEntry):
+    """处理章节页面响应：304使用缓存内容，200时返回响应头以便写入缓存"""
+    if statusCode == 304 and cachedEntry is not None:
+        getPageCache().refresh(urlHandler(url), responseHeaders.get('ETag'), responseHeaders.get('Last-Modified'))
+        return cachedEntry.content, None
+    return content, responseHeaders if statusCode == 200 else None
+
+
+def storeChapterContent(url, content, responseHeaders, pageResult):
+    """只缓存新获取的正常章节页面，未登录、出错或需要密码的页面下次仍重新获取"""
+    pageCache = getPageCache()
+    if pageCache is None or responseHeaders is None or not pageResult:
+        return
+    try:
+        pageCache.put(urlHandler(url), content, responseHeaders.get('ETag'), responseHeaders.get('Last-Modified'))
+    except Exception as e:
+        log_message(f"页面缓存写入失败: {url} {str(e)}", 'warning')
+
+
+def analyseChapterPage(characterSoup: BeautifulSoup):
+    """章节页面转为extractContents的片段列表，没有正文返回None，需要密码返回False"""
+    characterSoupDiv = characterSoup.find("div", {"class": "forum-content mt-3"})
+    if characterSoupDiv is None:
+        return None
+    if characterSoupDiv.find("button", {"class": "btn btn-primary btn-send-pw"}) is not None:
+        return False
+    return extractContents(characterSoupDiv.contents)
+
+
+def processChapterPage(content, variantList: list):
+    """解析章节页面一次，按各文字版本分别转换，可在进程池中执行
+    返回各版本的片段列表，结果只含字符串，图片在下载线程中由resolveContents处理。没有正文或需要密码时同analyseChapterPage"""
+    characterSoup = parseHtml(content, True)
+    with StageTimer("extract"):
+        pieceList = analyseChapterPage(characterSoup)
+    if not pieceList:
+        return pieceList
+    return [convertContents(pieceList, variant) for variant in variantList]
+
+
+def processChapterPageInProcess(content, variantList: list):
+    """在进程池中执行processChapterPage，连同子进程中记录的各阶段统计一起返回，由主进程记入当前书籍"""
+    runMetrics.beginCapture()
+    try:
+        pageResult = processChapterPage(content, variantList)
+    finally:
+        sampleList = runMetrics.endCapture()
+    return pageResult, sampleList
+
+
+def submitChapterContent(content, variantList: list):
+    """convertProcessNum大于0时把章节页面交给进程池解析，返回Future，由resolveChapterContent取得结果
+    未启用进程池、没有内容或提交失败时返回None，在当前线程中解析"""
+    pool = getConvertPool()
+    if pool is None or content is None:
+        return None
+    try:
+        return pool.submit(processChapterPageInProcess, content, variantList)
+    except Exception as e:
+        log_message(f"进程池处理章节失败，改为直接处理: {str(e)}", 'warning')
+        return None
+
+
+def resolveChapterContent(url, content, responseHeaders, variantList: list, parseFuture):
+    """取得已完成的进程池解析结果并记入子进程的统计，进程池出错时改为在当前线程中解析"""
+    try:
+        pageResult, sampleList = parseFuture.result()
+        runMetrics.merge(sampleList)
+    except Exception as e:
+        log_message(f"进程池处理章节失败，改为直接处理: {str(e)}", 'warning')
+        pageResult = processChapterPage(content, variantList)
+    storeChapterContent(url, content, responseHeaders, pageResult)
+    return pageResult
+
+
+def processChapterPageWithCache(url, content, responseHeaders, variantList: list):
+    """在当前线程中解析章节页面，正常的页面写入页面缓存"""
+    if content is None:
+        return None
+    pageResult = processChapterPage(content, variantList)
+    storeChapterContent(url, content, responseHeaders, pageResult)
+    return pageResult
+
+
+convertPoolLock = threading.Lock()
+convertPool = None
+
+
+def initConvertProcess(converterConfig, parserName, isParityCheck):
+    """进程池的子进程沿用主进程的繁简转换与解析器设置"""
+    global converter, htmlParser, isParserParityCheck
+    warnings.simplefilter("ignore", MarkupResemblesLocatorWarning)
+    converter = opencc.OpenCC(converterConfig)
+    htmlParser = parserName
+    isParserParityCheck = isParityCheck
+
+
+def getConvertPool():
+    """全部书籍共用的进程池，convertProcessNum为0时返回None。
+    主进程中有下载线程在运行，子进程以spawn方式启动，不fork持有锁的线程状态"""
+    global convertPool
+    if convertProcessNum <= 0:
+        return None
+    with convertPoolLock:
+        if convertPool is None:
+            convertPool = ProcessPoolExecutor(max_workers=convertProcessNum,
+                                              mp_context=multiprocessing.get_context("spawn"),
+                                              initializer=initConvertProcess,
+                                              initargs=(converter.config, htmlParser, isParserParityCheck))
+        return convertPool
+
+
+def shutdownConvertPool():
+    global convertPool
+    with convertPoolLock:
+        if convertPool is not None:
+            convertPool.shutdown()
+            convertPool = None
+
+
+class PageCacheEntry(object):
+    def __init__(self, content, etag, lastModified, fetchedAt):
+        self.content = content
+        self.etag = etag
+        self.lastModified = lastModified
+        self.fetchedAt = fetchedAt
+
+
+class PageCache(object):
+    """章节页面缓存，sqlite中保存zlib压缩后的html及ETag/Last-Modified，用于条件请求
+    超过大小上限时按最近使用时间淘汰，超过maxIdleSeconds未使用的页面在打开时删除(为0不删除)"""
+
+    def __init__(self, cacheDir, maxBytes, maxIdleSeconds=0):
+        self.maxBytes = maxBytes
+        os.makedirs(cacheDir, exist_ok=True)
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(path.join(cacheDir, "page_cache.db"), check_same_thread=False)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("CREATE TABLE IF NOT EXISTS pages (url TEXT PRIMARY KEY, content BLOB NOT NULL, etag TEXT, "
+                        "last_modified TEXT, size INTEGER NOT NULL, fetched_at REAL NOT NULL, "
+                        "last_access REAL NOT NULL)")
+        self.db.execute("CREATE INDEX IF NOT EXISTS pages_last_access ON pages (last_access)")
+        if maxIdleSeconds > 0:
+            self.db.execute("DELETE FROM pages WHERE last_access < ?", (time() - maxIdleSeconds,))
+        self.db.commit()
+        self.totalBytes = self.db.execute("SELECT COALESCE(SUM(size), 0) FROM pages").fetchone()[0]
+
+    def lookup(self, url):
+        with self.lock:
+            row = self.db.execute("SELECT content, etag, last_modified, fetched_at FROM pages WHERE url = ?",
+                                  (url,)).fetchone()
+            if row is None:
+                return None
+            self.db.execute("UPDATE pages SET last_access = ? WHERE url = ?", (time(), url))
+            self.db.commit()
+        return PageCacheEntry(zlib.decompress(row[0]), row[1], row[2], row[3])
+
+    def put(self, url, content, etag, lastModified):
+        compressed = zlib.compress(content)
+        with self.lock:
+            oldRow = self.db.execute("SELECT size FROM pages WHERE url = ?", (url,)).fetchone()
+            if oldRow is not None:
+                self.totalBytes -= oldRow[0]
+            now = time()
+            self.db.execute("INSERT OR REPLACE INTO pages VALUES (?, ?, ?, ?, ?, ?, ?)",
+                            (url, compressed, etag, lastModified, len(compressed), now, now))
+            self.totalBytes += len(compressed)
+            self.evict()
+            self.db.commit()
+
+    def refresh(self, url, etag, lastModified):
+        """服务器返回304，更新获取时间与验证信息"""
+        with self.lock:
+            self.db.execute("UPDATE pages SET fetched_at = ?, etag = COALESCE(?, etag), "
+                            "last_modified = COALESCE(?, last_modified) WHERE url = ?",
+                            (time(), etag, lastModified, url))
+            self.db.commit()
+
+    def evict(self):
+        while self.totalBytes > self.maxBytes:
+            row = self.db.execute("SELECT url, size FROM pages ORDER BY last_access LIMIT 1").fetchone()
+            if row is None:
+                break
+            self.db.execute("DELETE FROM pages WHERE url = ?", (row[0],))
+            self.totalBytes -= row[1]
+
+
+pageCacheLock = threading.Lock()
+pageCache = None
+
+
+def getPageCache():
+    global pageCache
+    if pageCacheMaxMB <= 0:
+        return None
+    with pageCacheLock:
+        if pageCache is None:
+            pageCache = PageCache(pageCacheDir, pageCacheMaxMB * 1024 * 1024, pageCacheTTLDays * 24 * 3600)
+        return pageCache
+
+
+def lookupPageCache(url):
+    cache = getPageCache()
+    if cache is None or url is None or len(url) == 0:
+        return None
+    try:
+        return cache.lookup(urlHandler(url))
+    except Exception as e:
+        log_message(f"页面缓存读取失败: {url} {str(e)}", 'warning')
+        return None
+
+
+def conditionalPageHeaders(cachedEntry):
+    if cachedEntry is None:
+        return headers
+    requestHeaders = dict(headers)
+    if cachedEntry.etag:
+        requestHeaders["If-None-Match"] = cachedEntry.etag
+    if cachedEntry.lastModified:
+        requestHeaders["If-Modified-Since"] = cachedEntry.lastModified
+    return requestHeaders
+
+
+class DefaultResponse:
+    def __init__(self):
+        self.status_code = None
+
+    def close(self):
+        return
+
+
+# 全部下载时创建，限制所有书籍合计的同时请求数。为None时不限制
+requestSemaphore = None
+
+
+class RequestSlot(object):
+    """占用一个全局请求名额，未启用全局限制时不做任何事。async引擎使用async with"""
+
+    def __init__(self):
+        self.semaphore = requestSemaphore
+
+    def __enter__(self):
+        if self.semaphore is not None:
+            self.semaphore.acquire()
+        return self
+
+    def __exit__(self, excType, excValue, traceback):
+        if self.semaphore is not None:
+            self.semaphore.release()
+
+    async def __aenter__(self):
+        # 全局名额是各书籍线程共用的线程信号量，不能在事件循环中阻塞等待，轮询取得。等待中被取消时未占用名额
+        if self.semaphore is not None:
+            while not self.semaphore.acquire(blocking=False):
+                await asyncio.sleep(0.01)
+        return self
+
+    async def __aexit__(self, excType, excValue, traceback):
+        self.__exit__(excType, excValue, traceback)
+
+
+class CircuitOpenError(Exception):
+    """站点熔断中，请求未发送"""
+
+
+class HostCircuit(object):
+    """单个站点的熔断状态"""
+
+    def __init__(self):
+        self.failureCount = 0
+        # 熔断到期时间，0为未熔断
+        self.openUntil = 0.0
+
+
+class RetryPolicy(object):
+    """请求重试策略：按状态码与异常类型判断是否重试，指数退避加随机抖动，429/503按Retry-After等待
+    偶发失败由重试吸收，同一站点连续多个请求重试用尽仍失败时熔断。统计重试次数、等待时间与熔断拒绝次数"""
+
+    retryStatusSet = {408, 429, 500, 502, 503, 504, 520, 521, 522, 523, 524}
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        # 站点 -> HostCircuit
+        self.circuitDict = {}
+        self.retryCount = 0
+        self.waitTime = 0.0
+        self.rejectCount = 0
+        self.openCount = 0
+
+    @staticmethod
+    def isRetryableException(e):
+        retryableTypes = (requests.ConnectionError, requests.Timeout, requests.exceptions.ChunkedEncodingError,
+                          asyncio.TimeoutError, ConnectionError, TimeoutError)
+        if aiohttp is not None:
+            retryableTypes += (aiohttp.ClientConnectionError, aiohttp.ClientPayloadError)
+        return isinstance(e, retryableTypes)
+
+    @staticmethod
+    def parseRetryAfter(value):
+        """Retry-After为秒数或HTTP日期，无法解析返回None"""
+        if not value:
+            return None
+        try:
+            return max(float(value), 0.0)
+        except ValueError:
+            pass
+        try:
+            return max((parsedate_to_datetime(value) - datetime.now(timezone.utc)).total_seconds(), 0.0)
+        except Exception:
+            return None
+
+    def backoffDelay(self, attempt, retryAfter=None):
+        if retryAfter is not None:
+            return min(retryAfter, retryMaxDelay)
+        # 一半固定一半随机，避免多个线程同时重试
+        delay = min(retryBaseDelay * 2 ** attempt, retryMaxDelay)
+        return delay / 2 + random.uniform(0, delay / 2)
+
+    def checkCircuit(self, host):
+        """熔断中抛出CircuitOpenError。熔断到期后放行一个请求试探，试探结果出来之前其余请求仍被拒绝"""
+        with self.lock:
+            circuit = self.circuitDict.setdefault(host, HostCircuit())
+            if circuit.openUntil == 0.0:
+                return
+            if time() < circuit.openUntil:
+                self.rejectCount += 1
+                raise CircuitOpenError(f"站点{host}连续失败已熔断，跳过请求")
+            circuit.openUntil = time() + retryCircuitCooldown
+
+    def recordResult(self, host, isFailure):
+        with self.lock:
+            circuit = self.circuitDict.setdefault(host, HostCircuit())
+            if not isFailure:
+                circuit.failureCount = 0
+                circuit.openUntil = 0.0
+                return
+            circuit.failureCount += 1
+            if circuit.failureCount < retryCircuitThreshold:
+                return
+            isNewOpen = circuit.openUntil == 0.0
+            circuit.openUntil = time() + retryCircuitCooldown
+            if isNewOpen:
+                self.openCount += 1
+        if isNewOpen:
+            log_message(f"站点{host}连续{circuit.failureCount}个请求失败，{retryCircuitCooldown:.0f}秒内暂停请求", 'warning')
+
+    def nextDelay(self, host, attempt, retryAfter=None):
+        """还可以重试时返回等待秒数。重试用尽时记为该站点的一次失败，返回None"""
+        if attempt + 1 >= retryMaxAttempts:
+            self.recordResult(host, True)
+            return None
+        with self.lock:
+            self.retryCount += 1
+        return self.backoffDelay(attempt, retryAfter)
+
+    def onResponse(self, host, attempt, statusCode, responseHeaders):
+        """收到响应后调用，需要重试时返回等待秒数。404、403等客户端错误不算站点故障"""
+        if statusCode not in self.retryStatusSet:
+            self.recordResult(host, False)
+            return None
+        retryAfter = None
+        if statusCode in (429, 503):
+            retryAfter = self.parseRetryAfter(responseHeaders.get('Retry-After'))
+        return self.nextDelay(host, attempt, retryAfter)
+
+    def onException(self, host, attempt, e):
+        """请求异常后调用，需要重试时返回等待秒数"""
+        if not self.isRetryableException(e):
+            return None
+        return self.nextDelay(host, attempt)
+
+    def recordWait(self, seconds):
+        with self.lock:
+            self.waitTime += seconds
+
+    def wait(self, seconds):
+        sleep(seconds)
+        self.recordWait(seconds)
+
+    def summary(self):
+        with self.lock:
+            return f"重试: {self.retryCount} 次, 等待 {self.waitTime:.1f}s, 熔断 {self.openCount} 次, " \
+                   f"熔断跳过请求 {self.rejectCount} 次"
+
+
+retryPolicy = RetryPolicy()
+
+# cloudflare验证页面的特征，只在响应开头查找
+challengeMarkerList = (b"<title>Just a moment...</title>", b"cf_chl_opt", b"cf-browser-verification")
+
+
+def classifyResponse(statusCode, responseHeaders, content=None):
+    """按响应判断限速结果，返回(结果, 原因)。403/429/验证页面为"throttle"，5xx为"error"，其余为"ok" """
+    if statusCode in (403, 429):
+        return "throttle", f"http {statusCode}"
+    if responseHeaders.get('cf-mitigated', '').lower() == 'challenge':
+        return "throttle", "cloudflare验证"
+    if content and any(marker in content[:16384] for marker in challengeMarkerList):
+        return "throttle", "cloudflare验证"
+    if statusCode >= 500:
+        return "error", f"http {statusCode}"
+    return "ok", ""
+
+
+class HostRateController(object):
+    """单个站点的AIMD限速：令牌桶限制每秒请求数，另限制同时请求数
+    响应正常且延迟、错误率未升高时加性增加，被限流时乘性减半"""
+
+    def __init__(self, host):
+        self.host = host
+        self.lock = threading.Lock()
+        self.concurrencyLimit = float(min(max(threadNum, 1), adaptiveMaxConcurrency))
+        self.rate = float(min(max(threadNum, adaptiveMinRate), adaptiveMaxRate))
+        self.tokens = 1.0
+        self.lastRefill = perf_counter()
+        self.inFlight = 0
+        # 延迟的移动平均与基准(观察到的最低平均值，缓慢上浮以适应站点变化)
+        self.latencyAverage = None
+        self.latencyBase = None
+        self.errorAverage = 0.0
+        self.lastDecrease = 0.0
+        self.isSlowStart = True
+        self.requestCount = 0
+        self.throttleCount = 0
+        self.peakConcurrency = self.concurrencyLimit
+        self.peakRate = self.rate
+
+    def tryAcquire(self):
+        """取得名额返回0，否则返回建议等待的秒数"""
+        with self.lock:
+            now = perf_counter()
+            # 桶容量为半秒的请求数，空闲后不会一下子涌出大量请求
+            self.tokens = min(self.tokens + (now - self.lastRefill) * self.rate, max(1.0, self.rate / 2))
+            self.lastRefill = now
+            if self.inFlight >= int(self.concurrencyLimit):
+                return 0.05
+            if self.tokens < 1.0:
+                return (1.0 - self.tokens) / self.rate
+            self.tokens -= 1.0
+            self.inFlight += 1
+            return 0.0
+
+    def acquire(self):
+        while True:
+            delay = self.tryAcquire()
+            if delay == 0.0:
+                return
+            sleep(delay)
+
+    async def acquireAsync(self):
+        while True:
+            delay = self.tryAcquire()
+            if delay == 0.0:
+                return
+            await asyncio.sleep(delay)
+
+    def release(self, latency, outcome, reason=""):
+        isDecreased = False
+        with self.lock:
+            self.inFlight -= 1
+            self.requestCount += 1
+            self.errorAverage = self.errorAverage * 0.9 + (0.1 if outcome == "error" else 0.0)
+            if outcome == "throttle":
+                self.throttleCount += 1
+                now = perf_counter()
+                if now - self.lastDecrease >= adaptiveDecreaseInterval:
+                    self.lastDecrease = now
+                    self.isSlowStart = False
+                    self.concurrencyLimit = max(self.concurrencyLimit / 2, 1.0)
+                    self.rate = max(self.rate / 2, adaptiveMinRate)
+                    self.tokens = min(self.tokens, 0.0)
+                    isDecreased = True
+            elif outcome == "ok":
+                if self.latencyAverage is None:
+                    self.latencyAverage = latency
+                    self.latencyBase = latency
+                else:
+                    self.latencyAverage = self.latencyAverage * 0.8 + latency * 0.2
+                    self.latencyBase = min(self.latencyBase * 1.01, self.latencyAverage)
+                if self.latencyAverage <= self.latencyBase * adaptiveLatencyFactor and self.errorAverage < 0.1:
+                    # 首次被限流前每个成功的请求加1，尽快找到上限；之后每个成功的请求加 1/当前并发数，
+                    # 大约每轮请求并发数加1、每秒请求数加1
+                    step = 1.0 if self.isSlowStart else 1.0 / self.concurrencyLimit
+                    self.concurrencyLimit = min(self.concurrencyLimit + step, float(adaptiveMaxConcurrency))
+                    self.rate = min(self.rate + step, adaptiveMaxRate)
+                    self.peakConcurrency = max(self.peakConcurrency, self.concurrencyLimit)
+                    self.peakRate = max(self.peakRate, self.rate)
+            concurrencyLimit, rate = int(self.concurrencyLimit), self.rate
+        if isDecreased:
+            log_message(f"站点{self.host}被限流({reason})，同时请求数降至{concurrencyLimit}，"
+                        f"每秒请求数降至{rate:.1f}", 'warning')
+
+    def summary(self):
+        with self.lock:
+            return f"{self.host}: 请求 {self.requestCount} 次, 被限流 {self.throttleCount} 次, " \
+                   f"同时请求数 {int(self.concurrencyLimit)}(最高 {int(self.peakConcurrency)}), " \
+                   f"每秒请求数 {self.rate:.1f}(最高 {self.peakRate:.1f})"
+
+
+class AdaptiveRateLimiter(object):
+    """按站点(netloc)创建HostRateController，章节页面站点与各图片站点互不影响"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.controllerDict = {}
+
+    def controllerOf(self, host):
+        """未启用自适应限速时返回None"""
+        if not isAdaptiveRateLimit:
+            return None
+        with self.lock:
+            controller = self.controllerDict.get(host)
+            if controller is None:
+                controller = HostRateController(host)
+                self.controllerDict[host] = controller
+            return controller
+
+    def summary(self):
+        with self.lock:
+            controllerList = list(self.controllerDict.values())
+        if not controllerList:
+            return "自适应限速: 未启用"
+        return "自适应限速:\n" + "\n".join("  " + controller.summary() for controller in controllerList)
+
+
+rateLimiter = AdaptiveRateLimiter()
+
+
+class HostSlot(object):
+    """占用一个站点的请求名额，结束时按setResponse记录的结果调整该站点的速率。未收到响应视为网络异常
+    延迟从begin开始计算，取得站点名额后还要等全局名额，这段等待不算站点的延迟。未启用自适应限速时不做任何事"""
+
+    def __init__(self, host):
+        self.controller = rateLimiter.controllerOf(host)
+        self.outcome = "error"
+        self.reason = "网络异常"
+        self.startTime = None
+
+    def setResponse(self, statusCode, responseHeaders, content=None):
+        self.outcome, self.reason = classifyResponse(statusCode, responseHeaders, content)
+
+    def __enter__(self):
+        if self.controller is not None:
+            waitStartTime = perf_counter()
+            self.controller.acquire()
+            runMetrics.observe("rate_wait", perf_counter() - waitStartTime)
+        return self
+
+    async def acquireAsync(self):
+        if self.controller is not None:
+            waitStartTime = perf_counter()
+            await self.controller.acquireAsync()
+            runMetrics.observe("rate_wait", perf_counter() - waitStartTime)
+
+    def begin(self):
+        """已取得全部名额，即将发送请求"""
+        self.startTime = perf_counter()
+
+    def release(self):
+        if self.controller is not None:
+            latency = perf_counter() - self.startTime if self.startTime is not None else 0.0
+            self.controller.release(latency, self.outcome, self.reason)
+
+    def __exit__(self, excType, excValue, traceback):
+        self.release()
+
+
+def downloadThreadNum():
+    """多线程引擎的线程数。启用自适应限速时线程数取上限，由限速控制实际同时请求数"""
+    if isAdaptiveRateLimit:
+        return max(adaptiveMaxConcurrency, threadNum, 1)
+    return threadNum
+
+
+class RequestTiming(object):
+    """一次请求各阶段的耗时(秒)。dns/connect/tls只在新建连接时有值，多线程引擎的connect含DNS解析"""
+
+    def __init__(self):
+        self.dns = 0.0
+        self.connect = 0.0
+        self.tls = 0.0
+        self.ttfb = 0.0
+        self.transfer = 0.0
+        self.total = 0.0
+        self.cpuTime = 0.0
+        self.byteCount = 0
+
+
+# 当前线程正在进行的请求的RequestTiming，新建连接时由TimedConnection写入
+requestTimingLocal = threading.local()
+
+
+class RequestTimer(object):
+    """记录一次requests请求，kind为"page"或"img"。requests的elapsed到响应头为止，减去新建连接的耗时为首字节时间
+    没有调用setResponse(请求异常)时只记一次失败"""
+
+    def __init__(self, kind):
+        self.kind = kind
+        self.timing = RequestTiming()
+        self.isDone = False
+
+    def __enter__(self):
+        requestTimingLocal.timing = self.timing
+        self.startTime = perf_counter()
+        self.startCpuTime = thread_time()
+        return self
+
+    def setResponse(self, response):
+        timing = self.timing
+        timing.total = perf_counter() - self.startTime
+        timing.cpuTime = thread_time() - self.startCpuTime
+        elapsed = response.elapsed.total_seconds()
+        timing.ttfb = max(elapsed - timing.connect - timing.tls, 0.0)
+        timing.transfer = max(timing.total - elapsed, 0.0)
+        timing.byteCount = len(response.content)
+        self.isDone = True
+
+    def __exit__(self, excType, excValue, traceback):
+        requestTimingLocal.timing = None
+        if self.isDone:
+            runMetrics.observeRequest(self.kind, self.timing)
+        else:
+            runMetrics.addCount(f"{self.kind}_failed")
+
+
+def retryGet(u, h, t, session=None, kind="page"):
+    """按retryPolicy重试的GET，返回最后一次的响应(可能是错误状态码)，网络异常重试用尽后抛出
+    等待重试时不占用全局请求名额。kind为性能统计中的请求类别"""
+    host = urlparse(u).netloc
+    attempt = 0
+    while True:
+        retryPolicy.checkCircuit(host)
+        try:
+            # 先等站点名额再占全局名额，等待某个站点限速时不占用其他站点可用的全局名额
+            with HostSlot(host) as hostSlot, RequestSlot(), RequestTimer(kind) as requestTimer:
+                hostSlot.begin()
+                if session is None:
+                    response = requests.get(u, headers=h, timeout=t)
+                else:
+                    response = session.get(u, headers=h, timeout=t)
+                requestTimer.setResponse(response)
+                hostSlot.setResponse(response.status_code, response.headers, response.content)
+        except Exception as e:
+            delay = retryPolicy.onException(host, attempt, e)
+            if delay is None:
+                raise
+        else:
+            delay = retryPolicy.onResponse(host, attempt, response.status_code, response.headers)
+            if delay is None:
+                return response
+            response.close()
+        runMetrics.addCount(f"{kind}_retry")
+        retryPolicy.wait(delay)
+        attempt += 1
+
+
+class ConnectionStats(object):
+    """统计请求数与新建连接数，复用次数 = 请求数 - 新建连接数"""
+
+    def __init__(self, name):
+        self.name = name
+        self.lock = threading.Lock()
+        self.requestCount = 0
+        self.openedCount = 0
+
+    def addRequest(self):
+        with self.lock:
+            self.requestCount += 1
+
+    def addOpened(self):
+        with self.lock:
+            self.openedCount += 1
+
+    def summary(self):
+        with self.lock:
+            reusedCount = max(self.requestCount - self.openedCount, 0)
+            return f"{self.name}: 请求 {self.requestCount} 次, 新建连接 {self.openedCount} 个, 复用连接 {reusedCount} 次"
 
-    def close(self):
-        return
 
+def timedConnectionClass(baseConnectionClass, isTls):
+    """新建连接时把TCP连接(含DNS解析)与TLS握手的耗时记入当前线程正在进行的请求"""
+    class TimedConnection(baseConnectionClass):
+        def _new_conn(self):
+            startTime = perf_counter()
+            sock = super()._new_conn()
+            self.tcpTime = perf_counter() - startTime
+            return sock
+
+        def connect(self):
+            self.tcpTime = 0.0
+            startTime = perf_counter()
+            super().connect()
+            timing = getattr(requestTimingLocal, "timing", None)
+            if timing is not None:
+                timing.connect += self.tcpTime
+                if isTls:
+                    timing.tls += max(perf_counter() - startTime - self.tcpTime, 0.0)
+
+    return TimedConnection
+
+
+def countingPoolClass(basePoolClass, stats: ConnectionStats):
+    class CountingConnectionPool(basePoolClass):
+        ConnectionCls = timedConnectionClass(basePoolClass.ConnectionCls, basePoolClass.scheme == "https")
+
+        def _new_conn(self):
+            stats.addOpened()
+            return super()._new_conn()
+
+    return CountingConnectionPool
+
+
+class CountingHTTPAdapter(HTTPAdapter):
+    """keep-alive连接池，并统计连接新建/复用情况"""
+
+    def __init__(self, stats: ConnectionStats, **kwargs):
+        self.stats = stats
+        super().__init__(**kwargs)
 
-@retrying.retry(stop_max_attempt_number=3, wait_fixed=10 * 1000)
-def retryGet(u, h, t):
-    return requests.get(u, headers=h, timeout=t)
+    def init_poolmanager(self, *args, **kwargs):
+        super().init_poolmanager(*args, **kwargs)
+        self.poolmanager.pool_classes_by_scheme = {
+            "http": countingPoolClass(HTTPConnectionPool, self.stats),
+            "https": countingPoolClass(HTTPSConnectionPool, self.stats),
+        }
+
+    def send(self, request, **kwargs):
+        self.stats.addRequest()
+        return super().send(request, **kwargs)
+
+
+# 页面与图片CDN使用不同的session，各自维护连接池。requests.Session 仅做GET时可在线程间共享
+sessionLock = threading.Lock()
+pageSession = None
+imgSession = None
+pageConnectionStats = ConnectionStats("页面")
+imgConnectionStats = ConnectionStats("图片")
+
+
+def createSession(stats: ConnectionStats, sessionHeaders: dict, poolHostNum: int):
+    session = requests.Session()
+    session.headers.update(sessionHeaders)
+    # pool_connections为缓存的host连接池个数，pool_maxsize为每个host保持的keep-alive连接数
+    adapter = CountingHTTPAdapter(stats, pool_connections=poolHostNum,
+                                  pool_maxsize=max(downloadThreadNum() * max(bookThreadNum, 1), 1))
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
+
+
+def getPageSession():
+    """站点页面session，携带esj.txt中的cookie(headers在读取cookie后才会创建session)"""
+    global pageSession
+    with sessionLock:
+        if pageSession is None:
+            pageSession = createSession(pageConnectionStats, headers, 2)
+        return pageSession
+
+
+def getImgSession():
+    """图片session，图片可能分布在多个CDN域名，多保留一些host连接池"""
+    global imgSession
+    with sessionLock:
+        if imgSession is None:
+            imgSession = createSession(imgConnectionStats, headers_img, 16)
+        return imgSession
 
 
 def detect_image_type_from_bytes(data):
@@ -315,87 +1972,432 @@ def detect_image_type_from_bytes(data):
     return None, None
 
 
+imgExtensionMapping = {
+    'image/jpeg': '.jpg',
+    'image/png': '.png',
+    'image/gif': '.gif',
+    'image/bmp': '.bmp',
+    'image/tiff': '.tif',
+    'image/webp': '.webp'
+}
+
+
 def getImgData(url):
     if url is None or len(url) == 0:
         return None, None, None, None
-    extension_mapping = {
-        'image/jpeg': '.jpg',
-        'image/png': '.png',
-        'image/gif': '.gif',
-        'image/bmp': '.bmp',
-        'image/tiff': '.tif',
-        'image/webp': '.webp'
-    }
+    cachedEntry = lookupImgCache(url)
+    if cachedEntry is not None and not isImgCacheRevalidate:
+        imgData = readImgCache(url, cachedEntry)
+        if imgData is not None:
+            return imgData
+        cachedEntry = None
     r = DefaultResponse()
     try:
-        r = retryGet(urlHandler(url), headers_img, (25, 30))
+        r = retryGet(urlHandler(url), conditionalImgHeaders(cachedEntry), (25, 30), getImgSession(), "img")
         r.raise_for_status()
     except HTTPError as e:
         log_message(f"*x*x*x*http错误,img下载失败,url={url}\n{str(e)}", 'error')
     except Exception as e:
         log_message(f"*x*x*x*网络问题，请检测VPN等环境,url={url}\n{str(e)}", 'error')
-    finally:
-        if r.status_code == 200:
-            # 返回值 图片比特值 图片后缀 图片hash值 图片Content-Type
-            bytes_io = BytesIO(r.content)
-            fileName = extension_mapping.get(r.headers.get('Content-Type'), None)
-            contentType = r.headers.get('Content-Type')
-            
-            # 如果无法从Content-Type获取扩展名，尝试通过文件头魔数检测
-            if fileName is None:
-                detected_ext, detected_type = detect_image_type_from_bytes(r.content)
-                if detected_ext:
-                    fileName = detected_ext
-                    contentType = detected_type
-                    log_message(f"图片类型自动检测: {url} -> {detected_ext}")
-            
-            resultHash = calculate_sha256_hash(BytesIO(r.content))
-            r.close()
-            return bytes_io, fileName, resultHash, contentType
-        else:
-            return None, None, None, None
+    if r.status_code not in (200, 304):
+        return None, None, None, None
+    imgData = resolveImgResponse(url, r.status_code, r.headers, r.content, cachedEntry)
+    r.close()
+    if imgData is None:
+        # 返回304但缓存文件已丢失，索引已删除，不带条件重新下载
+        return getImgData(url)
+    return imgData
+
+
+def resolveImgResponse(url, statusCode, responseHeaders, content, cachedEntry):
+    """处理图片响应：304使用缓存内容，200解析并写入缓存。304但缓存文件无法读取时返回None，需重新下载"""
+    if statusCode == 304 and cachedEntry is not None:
+        return readImgCache(url, cachedEntry)
+    if statusCode != 200:
+        return None, None, None, None
+    imgData = parseImgData(url, content, responseHeaders.get('Content-Type'))
+    imgCache = getImgDiskCache()
+    if imgCache is not None and imgData[1] is not None:
+        try:
+            imgCache.put(urlHandler(url), imgData, responseHeaders.get('ETag'), responseHeaders.get('Last-Modified'))
+        except Exception as e:
+            log_message(f"图片缓存写入失败: {url} {str(e)}", 'warning')
+    return imgData
+
+
+class ImgCacheEntry(object):
+    def __init__(self, imgHash, imgType, imgContentType, etag, lastModified, blobPath):
+        self.imgHash = imgHash
+        self.imgType = imgType
+        self.imgContentType = imgContentType
+        self.etag = etag
+        self.lastModified = lastModified
+        self.blobPath = blobPath
+
+    def imgData(self):
+        """与getImgData相同格式的返回值"""
+        with open(self.blobPath, "rb") as blobFile:
+            return BytesIO(blobFile.read()), self.imgType, self.imgHash, self.imgContentType
+
+
+class ImgDiskCache(object):
+    """以url为键的图片持久缓存。图片内容按hash存放在blobs目录，不同url相同内容只存一份
+    索引使用sqlite，总大小超过上限时按最近使用时间淘汰"""
+
+    def __init__(self, cacheDir, maxBytes):
+        self.blobDir = path.join(cacheDir, "blobs")
+        self.maxBytes = maxBytes
+        os.makedirs(self.blobDir, exist_ok=True)
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(path.join(cacheDir, "index.db"), check_same_thread=False)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("CREATE TABLE IF NOT EXISTS images (url TEXT PRIMARY KEY, hash TEXT NOT NULL, ext TEXT, "
+                        "content_type TEXT, etag TEXT, last_modified TEXT, size INTEGER NOT NULL, "
+                        "last_access REAL NOT NULL)")
+        self.db.execute("CREATE INDEX IF NOT EXISTS images_hash ON images (hash)")
+        self.db.execute("CREATE INDEX IF NOT EXISTS images_last_access ON images (last_access)")
+        self.db.commit()
+        self.totalBytes = self.db.execute(
+            "SELECT COALESCE(SUM(size), 0) FROM (SELECT MAX(size) AS size FROM images GROUP BY hash)").fetchone()[0]
+
+    def blobPath(self, imgHash):
+        return path.join(self.blobDir, imgHash[:2], imgHash)
+
+    def lookup(self, url):
+        with self.lock:
+            row = self.db.execute("SELECT hash, ext, content_type, etag, last_modified FROM images WHERE url = ?",
+                                  (url,)).fetchone()
+            if row is None:
+                return None
+            blobPath = self.blobPath(row[0])
+            if not path.exists(blobPath):
+                self.removeEntry(url)
+                self.db.commit()
+                return None
+            self.db.execute("UPDATE images SET last_access = ? WHERE url = ?", (time(), url))
+            self.db.commit()
+            return ImgCacheEntry(row[0], row[1], row[2], row[3], row[4], blobPath)
+
+    def put(self, url, imgData, etag, lastModified):
+        imgByte, imgType, imgHash, imgContentType = imgData
+        blobPath = self.blobPath(imgHash)
+        # 从下载内容的buffer写入，不复制
+        with self.lock, imgByte.getbuffer() as content:
+            if not path.exists(blobPath):
+                os.makedirs(path.dirname(blobPath), exist_ok=True)
+                tempPath = f"{blobPath}.{threading.get_ident()}.tmp"
+                with open(tempPath, "wb") as blobFile:
+                    blobFile.write(content)
+                os.replace(tempPath, blobPath)
+                self.totalBytes += len(content)
+            oldRow = self.db.execute("SELECT hash, size FROM images WHERE url = ?", (url,)).fetchone()
+            self.db.execute("INSERT OR REPLACE INTO images VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                            (url, imgHash, imgType, imgContentType, etag, lastModified, len(content), time()))
+            if oldRow is not None and oldRow[0] != imgHash:
+                self.removeBlobIfUnused(oldRow[0], oldRow[1])
+            self.evict()
+            self.db.commit()
+
+    def forget(self, url):
+        """删除url的索引，用于缓存文件已丢失或无法读取的情况"""
+        with self.lock:
+            self.removeEntry(url)
+            self.db.commit()
+
+    def removeEntry(self, url):
+        row = self.db.execute("SELECT hash, size FROM images WHERE url = ?", (url,)).fetchone()
+        if row is not None:
+            self.db.execute("DELETE FROM images WHERE url = ?", (url,))
+            self.removeBlobIfUnused(row[0], row[1])
+
+    def removeBlobIfUnused(self, imgHash, size):
+        if self.db.execute("SELECT 1 FROM images WHERE hash = ? LIMIT 1", (imgHash,)).fetchone() is None:
+            try:
+                os.remove(self.blobPath(imgHash))
+            except OSError:
+                pass
+            self.totalBytes -= size
+
+    def evict(self):
+        while self.totalBytes > self.maxBytes:
+            row = self.db.execute("SELECT url, hash, size FROM images ORDER BY last_access LIMIT 1").fetchone()
+            if row is None:
+                break
+            self.db.execute("DELETE FROM images WHERE url = ?", (row[0],))
+            self.removeBlobIfUnused(row[1], row[2])
+
+
+imgDiskCacheLock = threading.Lock()
+imgDiskCache = None
+
+
+def getImgDiskCache():
+    global imgDiskCache
+    if imgCacheMaxMB <= 0:
+        return None
+    with imgDiskCacheLock:
+        if imgDiskCache is None:
+            imgDiskCache = ImgDiskCache(imgCacheDir, imgCacheMaxMB * 1024 * 1024)
+        return imgDiskCache
+
+
+def lookupImgCache(url):
+    imgCache = getImgDiskCache()
+    if imgCache is None or url is None or len(url) == 0:
+        return None
+    try:
+        return imgCache.lookup(urlHandler(url))
+    except Exception as e:
+        log_message(f"图片缓存读取失败: {url} {str(e)}", 'warning')
+        return None
+
+
+def readImgCache(url, cachedEntry):
+    """读取缓存的图片，文件丢失或无法读取时删除该url的索引并返回None，由调用方重新下载"""
+    try:
+        return cachedEntry.imgData()
+    except OSError as e:
+        log_message(f"图片缓存文件读取失败，重新下载: {url} {str(e)}", 'warning')
+        imgCache = getImgDiskCache()
+        if imgCache is not None:
+            try:
+                imgCache.forget(urlHandler(url))
+            except Exception as e:
+                log_message(f"图片缓存索引删除失败: {url} {str(e)}", 'warning')
+        return None
+
+
+def conditionalImgHeaders(cachedEntry):
+    """命中缓存时附带ETag/Last-Modified，服务器返回304则直接使用缓存"""
+    if cachedEntry is None:
+        return headers_img
+    requestHeaders = dict(headers_img)
+    if cachedEntry.etag:
+        requestHeaders["If-None-Match"] = cachedEntry.etag
+    if cachedEntry.lastModified:
+        requestHeaders["If-Modified-Since"] = cachedEntry.lastModified
+    return requestHeaders
+
+
+def parseImgData(url, content, contentTypeHeader):
+    # 返回值 图片比特值 图片后缀 图片hash值 图片Content-Type
+    bytes_io = BytesIO(content)
+    fileName = imgExtensionMapping.get(contentTypeHeader, None)
+    contentType = contentTypeHeader
+
+    # 如果无法从Content-Type获取扩展名，尝试通过文件头魔数检测
+    if fileName is None:
+        detected_ext, detected_type = detect_image_type_from_bytes(content)
+        if detected_ext:
+            fileName = detected_ext
+            contentType = detected_type
+            log_message(f"图片类型自动检测: {url} -> {detected_ext}")
+
+    with StageTimer("img_hash", len(content)):
+        resultHash = calculate_sha256_hash(bytes_io)
+    return bytes_io, fileName, resultHash, contentType
 
 
 def calculate_sha256_hash(bytes_io_object):
-    bytes_io_object.seek(0)
     sha256_hash = hashlib.sha256()
-    sha256_hash.update(bytes_io_object.read())
+    with bytes_io_object.getbuffer() as buffer:
+        sha256_hash.update(buffer)
     return sha256_hash.hexdigest()[:32]
 
 
-def htmlSimplified(soup: BeautifulSoup, inputChildren: list[bs4.element.PageElement], imgDict: ImgThreadSafeDict):
-    htmlResult = ""
-    for child in inputChildren:
+# 批量转换时拼接用的分隔符(私用区字符，OpenCC原样保留且不会与前后文字组成词)
+convertSeparator = "\ue000"
+# 各文字版本短文字(卷名、章节名、固定提示等)的转换结果缓存
+convertCacheDict = {}
+convertCacheMaxNum = 65536
+convertCacheMaxLength = 64
+
+
+# 额外文字版本的OpenCC转换器
+variantConverterDict = {}
+variantConverterLock = threading.Lock()
+
+
+def getVariantConverter(variant):
+    """None为converter，"raw"不转换返回None，其余按OpenCC配置名创建"""
+    if variant is None:
+        return converter
+    if variant == "raw":
+        return None
+    with variantConverterLock:
+        if variant not in variantConverterDict:
+            variantConverterDict[variant] = opencc.OpenCC(f"{variant}.json")
+        return variantConverterDict[variant]
+
+
+def convertBatch(textList: list, variant=None):
+    """批量繁简转换：短文字先查缓存，其余用分隔符拼接后一次转换再拆分，拆分数量不一致时逐条转换
+    variant为文字版本，None为converter的主版本"""
+    with StageTimer("convert"):
+        variantConverter = getVariantConverter(variant)
+        if variantConverter is None:
+            return list(textList)
+        cacheDict = convertCacheDict.setdefault(variant, {})
+        resultList = [cacheDict.get(text) for text in textList]
+        missIndexList = [index for index, result in enumerate(resultList) if result is None]
+        if len(missIndexList) == 0:
+            return resultList
+        missTextList = [textList[index] for index in missIndexList]
+        convertedList = variantConverter.convert(convertSeparator.join(missTextList)).split(convertSeparator)
+        if len(convertedList) != len(missTextList):
+            # 原文中含有分隔符
+            convertedList = [variantConverter.convert(text) for text in missTextList]
+        if len(cacheDict) >= convertCacheMaxNum:
+            cacheDict.clear()
+        for index, text, convertedText in zip(missIndexList, missTextList, convertedList):
+            resultList[index] = convertedText
+            if len(text) <= convertCacheMaxLength:
+                cacheDict[text] = convertedText
+        return resultList
+
+
+def convertText(text, variant=None):
+    return convertBatch([text], variant)[0]
+
+
+# 程序生成的提示文字，与站点正文一样使用繁体，按各文字版本转换。主版本为t2s时与原先的简体提示相同
+failedNotice = "章節下載失敗"
+passwordNotice = "本章節需要密碼，已跳過"
+emptyNotice = "【空】"
+
+
+def transformContents(inputChildren: list[bs4.element.PageElement], variant=None):
+    """单次遍历章节内容，得到与原先逐层find/find_all/get_text相同的结果，不修改DOM
+    返回片段列表：("html", 段落html, txt行列表)；("img", src)，由resolveContents换成图片html；("raw", 原样写入的文字)
+    不含图片的节点整体作为段落，含图片的节点展开为各子节点的片段加换行"""
+    return convertContents(extractContents(inputChildren), variant)
+
+
+def extractContents(inputChildren: list[bs4.element.PageElement]):
+    """transformContents的遍历部分，段落为转换前的("text", 去掉空行的文字)，同一页面的各文字版本共用"""
+    pieceList = []
+    # (字符串类型, 文字)，按文档顺序，链接开头记入"[href]"，各段落节点取其中的一个区间
+    stringList = []
+    # 栈帧：[节点, 子节点迭代器, 片段起点, 字符串起点, 是否含图片]
+    frameList = [[None, iter(inputChildren), 0, 0, False]]
+    while len(frameList) > 0:
+        frame = frameList[-1]
+        child = next(frame[1], None)
+        if child is None:
+            frameList.pop()
+            if len(frameList) == 0:
+                break
+            node, _, pieceStart, stringStart, hasImg = frame
+            if hasImg:
+                pieceList.append(("raw", "\n"))
+                frameList[-1][4] = True
+            else:
+                # 子节点的片段作废，整个节点作为一个段落。链接只为其内部的链接加[href]，自身的不算
+                del pieceList[pieceStart:]
+                if node.name == "a" and node.get("href"):
+                    stringStart += 1
+                pieceList.append(("text", node, stringStart, len(stringList)))
+            continue
         if isinstance(child, Tag):
             if child.name == "img":
-                htmlResult += imgDict.set(child['src'])
+                pieceList.append(("img", child['src']))
+                frame[4] = True
                 continue
-            if child.find("img") is not None:
-                htmlResult += htmlSimplified(soup, child.contents, imgDict)
-            else:
-                for a in child.find_all("a"):
-                    if a.get("isInsertedHrefValue") is not None:
-                        continue
-                    new_p_tag = soup.new_tag('p')
-                    href = a.get('href')
-                    if href is None or len(href) == 0:
-                        continue
-                    new_p_tag.string = f"[{href}]"
-                    a.insert(0, new_p_tag)
-                    a["isInsertedHrefValue"] = True
-                if len(re.sub('\\s', '', child.get_text())) == 0:
-                    continue
-                text_content = child.get_text(separator='\n', strip=True)
-                filtered_text = '\n'.join(line for line in text_content.split('\n') if line.strip())
-                filtered_text = converter.convert(filtered_text)
-                unescaped_string = html.escape(filtered_text)
-                paragraphs = unescaped_string.splitlines()
-                wrapped_paragraphs = ['<p>' + paragraph.strip() + '</p>' for paragraph in paragraphs]
-                htmlResult += '\n'.join(wrapped_paragraphs)
+            frameList.append([child, iter(child.contents), len(pieceList), len(stringList), False])
+            if child.name == "a" and child.get("href"):
+                stringList.append((bs4.element.NavigableString, f"[{child.get('href')}]"))
+        else:
+            stringList.append((type(child), child))
+            pieceList.append(("raw", str(child)))
+    pieceList.append(("raw", "\n"))
+
+    resultList = []
+    for piece in pieceList:
+        if piece[0] != "text":
+            resultList.append(piece)
+            continue
+        paragraphText = textFromStrings(piece[1], stringList[piece[2]:piece[3]])
+        if paragraphText is not None:
+            resultList.append(("text", paragraphText))
+    return resultList
+
+
+def convertContents(pieceList: list, variant=None):
+    """extractContents的段落文字整章一次转换，包成<p>段落"""
+    paragraphIndexList = [index for index, piece in enumerate(pieceList) if piece[0] == "text"]
+    resultList = list(pieceList)
+    for index, convertedText in zip(paragraphIndexList,
+                                    convertBatch([pieceList[index][1] for index in paragraphIndexList], variant)):
+        resultList[index] = paragraphFromText(convertedText)
+    return resultList
+
 
+def textFromStrings(node: Tag, nodeStringList: list):
+    """节点的文字，去掉空行，只取get_text默认会取的字符串类型。全是空白时返回None"""
+    stringTypes = node.interesting_string_types
+    if stringTypes is None:
+        stringTypes = (bs4.element.NavigableString, bs4.element.CData)
+    elif isinstance(stringTypes, type):
+        stringTypes = (stringTypes,)
+    textList = [text for stringType, text in nodeStringList if stringType in stringTypes]
+    if len(re.sub('\\s', '', ''.join(textList))) == 0:
+        return None
+    text_content = '\n'.join(text.strip() for text in textList if len(text.strip()) > 0)
+    return '\n'.join(line for line in text_content.split('\n') if line.strip())
+
+
+def paragraphFromText(filtered_text):
+    """转换后的文字按行包成<p>段落"""
+    unescaped_string = html.escape(filtered_text)
+    paragraphs = unescaped_string.splitlines()
+    wrapped_paragraphs = ['<p>' + paragraph.strip() + '</p>' for paragraph in paragraphs]
+    return "html", '\n'.join(wrapped_paragraphs), filtered_text.splitlines()
+
+
+def resolveContents(pieceList: list, imgDict: ImgThreadSafeDict, txtPieceList: list = None):
+    """transformContents的片段中的图片交给imgDict下载，拼成html
+    txtPieceList不为None时按顺序追加txt用的(是否为原始文字, 文字)片段，由simplifiedTxt拼成txt"""
+    htmlList = []
+    for piece in pieceList:
+        if piece[0] == "img":
+            imgHtml = imgDict.set(piece[1])
+            htmlList.append(imgHtml)
+            if txtPieceList is not None:
+                txtPieceList.append((False, imgDict.txtOf(imgHtml)))
+        elif piece[0] == "html":
+            htmlList.append(piece[1])
+            if txtPieceList is not None:
+                txtPieceList.extend((False, line) for line in piece[2])
         else:
-            htmlResult += str(child)
-    return htmlResult + '\n'
+            htmlList.append(piece[1])
+            if txtPieceList is not None:
+                txtPieceList.append((True, piece[1]))
+    return ''.join(htmlList)
+
+
+def htmlSimplified(inputChildren: list[bs4.element.PageElement], imgDict: ImgThreadSafeDict,
+                   txtPieceList: list = None):
+    """章节内容简化为<p>段落、链接地址与图片"""
+    return resolveContents(transformContents(inputChildren), imgDict, txtPieceList)
+
+
+def simplifiedTxt(txtPieceList: list):
+    """将htmlSimplified的txt片段拼成txt文字，与把html中的图片换成原始url后取文字的结果一致
+    原始文字是直接拼进html的，相邻的原始文字合并后按html取文字"""
+    lineList = []
+    rawText = ""
+    for isRaw, text in txtPieceList + [(False, "")]:
+        if isRaw:
+            rawText += text
+            continue
+        if len(rawText.strip()) > 0:
+            rawLines = BeautifulSoup(rawText, 'html.parser').get_text(separator='\n', strip=True)
+            if len(rawLines) > 0:
+                lineList.append(rawLines)
+        rawText = ""
+        if len(text.strip()) > 0:
+            lineList.append(text.strip())
+    return '\n'.join(lineList) + '\n'
 
 
 # def htmlSimplified(inputHtml, imgDict: ImgThreadSafeDict):
@@ -445,6 +2447,16 @@ def htmlSimplified(soup: BeautifulSoup, inputChildren: list[bs4.element.PageElem
 #         return result + '\n'
 
 
+def analyseChapterList(chapterList: Tag, novelCharacterList: list):
+    """解析章节目录，全部标题最后一次转换，返回目录深度"""
+    depth = contentsAnalysis(chapterList.contents, novelCharacterList, 0, -1)
+    for character, convertedTitle in zip(novelCharacterList,
+                                         convertBatch([character.title for character in novelCharacterList])):
+        character.rawTitle = character.title
+        character.title = convertedTitle
+    return depth
+
+
 def contentsAnalysis(inputChildren: list[bs4.element.PageElement], novelCharacterList: list,
                      levelValue: int, fatherValue: int):
     depth = 0
@@ -463,7 +2475,7 @@ def contentsAnalysis(inputChildren: list[bs4.element.PageElement], novelCharacte
             novelCharacterList.append(node)
             if child.name == "details":
                 summary = child.find("summary")
-                node.title = converter.convert(summary.get_text()) if summary else ""
+                node.title = summary.get_text() if summary else ""
                 if node.title is None or len(re.sub('\\s', '', node.title)) == 0:
                     node.title = "卷"
                 startNum = 1
@@ -473,7 +2485,7 @@ def contentsAnalysis(inputChildren: list[bs4.element.PageElement], novelCharacte
                             contentsAnalysis(child.contents[startNum:], novelCharacterList, levelValue + 1, node.value))
                 node.isVolume = True
             elif child.name == "p" and len(re.sub('\\s', '', child.get_text())) != 0:
-                node.title = converter.convert(child.get_text())
+                node.title = child.get_text()
                 nextP = childContentsCount + 1
                 while nextP < len(inputChildren):
                     nextChild = inputChildren[nextP]
@@ -487,7 +2499,7 @@ def contentsAnalysis(inputChildren: list[bs4.element.PageElement], novelCharacte
                 node.isVolume = True
                 continue
             elif child.name == "a":
-                node.title = converter.convert(child.get_text())
+                node.title = child.get_text()
                 node.url = child.get("href")
                 node.isChapter = True
 
@@ -541,15 +2553,6 @@ def contentsAnalysis(inputChildren: list[bs4.element.PageElement], novelCharacte
 #                 node.isChapter = True
 #     return depth
 
-def imgTagConvert(inputHtml, imgDict: ImgThreadSafeDict):
-    soup = BeautifulSoup(inputHtml, 'html.parser')
-    for img_tag in soup.find_all("img"):
-        new_p_tag = soup.new_tag('p')
-        new_p_tag.string = imgDict.imgOriginalUrlDict[img_tag['src']]
-        img_tag.replace_with(new_p_tag)
-    return soup.get_text(separator='\n', strip=True) + "\n"
-
-
 def getSelectedChapterIndices():
     """根据配置获取要下载的章节索引列表"""
     if chapterRangeStart >= 0 and chapterRangeEnd >= 0:
@@ -563,9 +2566,9 @@ def listBookChapters(url):
     if soupContent.find("h2") is None:
         print("*x*x*x*cookie无效,未登录")
         return
-    bookName = converter.convert(soupContent.find("h2").text)
+    bookName = convertText(soupContent.find("h2").text)
     bookAuthorTag = soupContent.find("ul", {"class": "list-unstyled mb-2 book-detail"})
-    bookAuthor = converter.convert(bookAuthorTag.find("a").text) if bookAuthorTag and bookAuthorTag.find("a") else ""
+    bookAuthor = convertText(bookAuthorTag.find("a").text) if bookAuthorTag and bookAuthorTag.find("a") else ""
     
     print(f"\n《{bookName}》{bookAuthor} 章节列表:")
     print("=" * 60)
@@ -575,7 +2578,7 @@ def listBookChapters(url):
     if chapterList is None:
         print("未找到章节列表")
         return
-    contentsAnalysis(chapterList.contents, novelCharacterList, 0, -1)
+    analyseChapterList(chapterList, novelCharacterList)
     
     # 只显示章节(isChapter=True)，按顺序编号
     chapterIndex = 0
@@ -600,10 +2603,355 @@ def listBookChapters(url):
 
 
 
+def txtIndexPath(txtPath):
+    """txt旁的索引文件，记录各节点在txt中的字节范围"""
+    return txtPath + ".index.json"
+
+
+def encodeTxt(text):
+    """与文本模式写入一致，换行写为系统换行符"""
+    return text.replace("\n", os.linesep).encode("utf-8")
+
+
+def decodeTxt(data: bytes):
+    return data.decode("utf-8").replace("\r\n", "\n")
+
+
+def writeTxtIndex(txtPath, entryList: list, size):
+    """entryList为[{"name": epub中的文件名, "start": 起始字节, "end": 结束字节, "url": 章节url}]，按txt中的顺序
+    简介为"head"，卷没有url
+    先写入.part临时文件再替换"""
+    indexPath = txtIndexPath(txtPath)
+    with open(indexPath + ".part", "w", encoding="utf-8") as indexFile:
+        json.dump({"size": size, "entries": entryList}, indexFile, ensure_ascii=False)
+    os.replace(indexPath + ".part", indexPath)
+
+
+def readTxtIndex(txtPath):
+    """读取txt的索引，没有索引、txt大小不一致(之后被修改过)或范围不连续时返回None"""
+    indexPath = txtIndexPath(txtPath)
+    if not path.exists(txtPath) or not path.exists(indexPath):
+        return None
+    try:
+        with open(indexPath, "r", encoding="utf-8") as indexFile:
+            index = json.load(indexFile)
+        entryList = index["entries"]
+        offset = 0
+        for entry in entryList:
+            if entry["start"] != offset or entry["end"] < offset:
+                return None
+            offset = entry["end"]
+        if offset != index["size"] or path.getsize(txtPath) != index["size"]:
+            return None
+        return entryList
+    except Exception as e:
+        log_message(f"txt索引读取失败: {indexPath} {str(e)}", 'warning')
+        return None
+
+
+def splitTxtByIndex(txtPath, entryList: list):
+    """按索引切分txt，返回 file_name -> txt内容"""
+    with open(txtPath, "rb") as txtFile:
+        data = txtFile.read()
+    return {entry["name"]: decodeTxt(data[entry["start"]:entry["end"]]) for entry in entryList if entry["name"]}
+
+
+def mergeTxtChapters(txtPath, newChapters):
+    """按索引把章节放到txt中对应的位置：已有的novel_N.html替换，没有的放在前一个章节之后，其余内容按字节原样复制
+    一次顺序读写生成新txt与索引。newChapters为[(节点序号, 章节节点)]，节点序号含卷，与novel_N.html的N一致
+    返回(替换数, 新增数)，没有可用索引时返回None"""
+    entryList = readTxtIndex(txtPath)
+    if entryList is None:
+        return None
+    # [文件名, 原条目, 新文字, 章节url]，新文字为None时复制原条目的字节
+    planList = [[entry["name"], entry, None, entry.get("url", "")] for entry in entryList]
+    # 节点序号 -> planList中的项
+    chapterPlanDict = {}
+    for plan in planList:
+        match = re.fullmatch(r'(?:error_)?novel_(\d+)\.html', plan[0])
+        if match:
+            chapterPlanDict[int(match.group(1))] = plan
+    updatedCount = 0
+    addedCount = 0
+    for chapterValue, chapter in sorted(newChapters, key=lambda pair: pair[0]):
+        if not chapter.isChapter:
+            continue
+        plan = chapterPlanDict.get(chapterValue)
+        if plan is not None:
+            updatedCount += 1
+        else:
+            addedCount += 1
+            plan = [None, None, None, ""]
+            previousValueList = [value for value in chapterPlanDict if value < chapterValue]
+            nextValueList = [value for value in chapterPlanDict if value > chapterValue]
+            if previousValueList:
+                planList.insert(planList.index(chapterPlanDict[max(previousValueList)]) + 1, plan)
+            elif nextValueList:
+                planList.insert(planList.index(chapterPlanDict[min(nextValueList)]), plan)
+            else:
+                planList.append(plan)
+            chapterPlanDict[chapterValue] = plan
+        plan[0] = f"novel_{chapterValue}.html"
+        plan[2] = chapter.txtValue
+        plan[3] = urlHandler(chapter.url)
+    partPath = txtPath + ".part"
+    newEntryList = []
+    offset = 0
+    with open(txtPath, "rb") as sourceFile, open(partPath, "wb") as targetFile:
+        for name, entry, text, url in planList:
+            if text is None:
+                sourceFile.seek(entry["start"])
+                remaining = entry["end"] - entry["start"]
+                while remaining > 0:
+                    chunk = sourceFile.read(min(remaining, 1024 * 1024))
+                    targetFile.write(chunk)
+                    remaining -= len(chunk)
+                length = entry["end"] - entry["start"]
+            else:
+                data = encodeTxt(text)
+                targetFile.write(data)
+                length = len(data)
+            newEntry = {"name": name, "start": offset, "end": offset + length}
+            if url:
+                newEntry["url"] = url
+            newEntryList.append(newEntry)
+            offset += length
+    os.replace(partPath, txtPath)
+    writeTxtIndex(txtPath, newEntryList, offset)
+    return updatedCount, addedCount
+
+
+def reuseExistingChapters(novelCharacterList: list, existBook: epub.EpubBook, txtPath):
+    """增量更新：按txt索引中记录的章节url对应已有epub/txt中的章节，把内容记在节点的existingChapter上
+    下载时仍发送条件请求，章节页面未变化(304)才沿用，变化或没有缓存可供比对时重新下载
+    下载失败、需要密码、内容为空的章节不沿用。索引中没有章节url(旧版本生成的txt)时本次完整下载"""
+    txtEntryList = readTxtIndex(txtPath)
+    urlNameDict = {entry["url"]: entry["name"] for entry in txtEntryList or [] if entry.get("url")}
+    if not urlNameDict:
+        log_message("已有txt没有记录章节url的索引，本次完整下载", 'warning')
+        return
+    txtDict = splitTxtByIndex(txtPath, txtEntryList)
+    itemDict = {item.file_name: item for item in existBook.get_items()}
+    # 需要密码、内容为空的章节在epub中的占位内容，这些章节总是重新下载。已有文件只有主版本
+    placeholderList = [f"<p>{convertText(notice)}</p>".encode("utf-8") for notice in (passwordNotice, emptyNotice)]
+    candidateCount = 0
+    for character in novelCharacterList:
+        if not character.isChapter:
+            continue
+        fileName = urlNameDict.get(urlHandler(character.url))
+        if fileName is None or not fileName.startswith("novel_") or fileName not in itemDict:
+            continue
+        content = itemDict[fileName].get_content()
+        if any(placeholder in content for placeholder in placeholderList):
+            continue
+        imgItemList = [itemDict[imgFileName.decode("utf-8")]
+                       for imgFileName in re.findall(rb'src=["\'](Image_[^"\']+)["\']', content)
+                       if imgFileName.decode("utf-8") in itemDict]
+        character.existingChapter = (content, txtDict[fileName], imgItemList)
+        candidateCount += 1
+    log_message(f"增量更新: 已有章节 {candidateCount} 个，章节页面未变化时沿用")
+
+
+opfNamespace = "http://www.idpf.org/2007/opf"
+ncxNamespace = "http://www.daisy.org/z3986/2005/ncx/"
+xhtmlNamespace = "http://www.w3.org/1999/xhtml"
+epubNamespace = "http://www.idpf.org/2007/ops"
+
+
+def copyZipEntryRaw(sourceFile, targetZip: zipfile.ZipFile, info: zipfile.ZipInfo):
+    """不解压直接复制zip条目的压缩数据"""
+    sourceFile.seek(info.header_offset)
+    localHeader = sourceFile.read(zipfile.sizeFileHeader)
+    nameLength, extraLength = struct.unpack("<HH", localHeader[26:30])
+    sourceFile.seek(info.header_offset + zipfile.sizeFileHeader + nameLength + extraLength)
+    rawData = sourceFile.read(info.compress_size)
+    newInfo = copy.copy(info)
+    # 大小写在本地文件头中，不再使用数据描述符
+    newInfo.flag_bits &= ~0x08
+    newInfo.header_offset = targetZip.fp.tell()
+    targetZip.fp.write(newInfo.FileHeader())
+    targetZip.fp.write(rawData)
+    targetZip.filelist.append(newInfo)
+    targetZip.NameToInfo[newInfo.filename] = newInfo
+    targetZip.start_dir = targetZip.fp.tell()
+
+
+def insertTocEntry(anchorElement, isAfter, parentElement, newElement):
+    """新目录项放在相邻章节的目录项之前或之后，没有相邻章节时追加到parentElement末尾"""
+    if anchorElement is None:
+        parentElement.append(newElement)
+    elif isAfter:
+        anchorElement.addnext(newElement)
+    else:
+        anchorElement.addprevious(newElement)
+    # 新节点沿用锚点的tail作为缩进
+    if anchorElement is not None and newElement.tail is None:
+        newElement.tail = anchorElement.tail
+
+
+def patchEpubChapters(epubPath, newChapters, newImgDict: ImgThreadSafeDict):
+    """在zip层面把章节合并到已有epub：未变化的条目原样复制压缩数据，只写入替换或新增的novel_N.html、新图片
+    以及修改后的opf/ncx/nav，写入.part临时文件后替换原文件
+    newChapters为[(节点序号, 章节节点)]，节点序号含卷，与novel_N.html的N一致，返回(替换数, 新增数, 章节总数, 新图片数)"""
+    with zipfile.ZipFile(epubPath) as sourceZip:
+        containerTree = etree.fromstring(sourceZip.read("META-INF/container.xml"))
+        opfName = containerTree.find(".//{urn:oasis:names:tc:opendocument:xmlns:container}rootfile").get("full-path")
+        folder = path.dirname(opfName)
+
+        def entryName(href):
+            return f"{folder}/{href}" if folder else href
+
+        opfTree = etree.fromstring(sourceZip.read(opfName))
+        manifest = opfTree.find(f"{{{opfNamespace}}}manifest")
+        spine = opfTree.find(f"{{{opfNamespace}}}spine")
+        itemDict = {item.get("href"): item for item in manifest.findall(f"{{{opfNamespace}}}item")}
+        idSet = {item.get("id") for item in itemDict.values()}
+        ncxHref = next((href for href, item in itemDict.items()
+                        if item.get("media-type") == "application/x-dtbncx+xml"), None)
+        navHref = next((href for href, item in itemDict.items() if "nav" in (item.get("properties") or "").split()),
+                       None)
+        ncxTree = etree.fromstring(sourceZip.read(entryName(ncxHref))) if ncxHref else None
+        navTree = etree.fromstring(sourceZip.read(entryName(navHref))) if navHref else None
+
+        def ncxPointOf(href):
+            if ncxTree is None:
+                return None
+            for content in ncxTree.iter(f"{{{ncxNamespace}}}content"):
+                if content.get("src", "").split("#")[0] == href:
+                    return content.getparent()
+            return None
+
+        def navItemOf(href):
+            if navTree is None:
+                return None
+            for link in navTree.iter(f"{{{xhtmlNamespace}}}a"):
+                if link.get("href", "").split("#")[0] == href:
+                    return link.getparent()
+            return None
+
+        # 节点序号 -> 已有的href，下载失败的章节为error_novel_N.html
+        chapterHrefDict = {}
+        for href in itemDict:
+            match = re.fullmatch(r'(?:error_)?novel_(\d+)\.html', href)
+            if match:
+                chapterHrefDict[int(match.group(1))] = href
+        # 写入的条目名 -> 内容，删除的条目名
+        writeDict = {}
+        removeSet = set()
+        updatedCount = 0
+        addedCount = 0
+        for chapterValue, chapter in sorted(newChapters, key=lambda pair: pair[0]):
+            if not chapter.isChapter:
+                continue
+            newHref = f"novel_{chapterValue}.html"
+            writeDict[entryName(newHref)] = chapter.epubValue.get_content()
+            oldHref = chapterHrefDict.get(chapterValue)
+            if oldHref is not None:
+                log_message(f"  替换章节 [{chapterValue}]: {chapter.title}")
+                updatedCount += 1
+                ncxPoint = ncxPointOf(oldHref)
+                navItem = navItemOf(oldHref)
+                if oldHref != newHref:
+                    removeSet.add(entryName(oldHref))
+                    itemDict[oldHref].set("href", newHref)
+                    itemDict[newHref] = itemDict.pop(oldHref)
+                    if ncxPoint is not None:
+                        ncxPoint.find(f"{{{ncxNamespace}}}content").set("src", newHref)
+                    if navItem is not None:
+                        navItem.find(f"{{{xhtmlNamespace}}}a").set("href", newHref)
+                if ncxPoint is not None:
+                    ncxPoint.find(f"{{{ncxNamespace}}}navLabel/{{{ncxNamespace}}}text").text = chapter.title
+                if navItem is not None:
+                    navItem.find(f"{{{xhtmlNamespace}}}a").text = chapter.title
+            else:
+                log_message(f"  添加章节 [{chapterValue}]: {chapter.title}")
+                addedCount += 1
+                # 放在前一个章节之后，没有时放在后一个章节之前
+                previousValueList = [value for value in chapterHrefDict if value < chapterValue]
+                nextValueList = [value for value in chapterHrefDict if value > chapterValue]
+                anchorHref = None
+                isAfter = True
+                if previousValueList:
+                    anchorHref = chapterHrefDict[max(previousValueList)]
+                elif nextValueList:
+                    anchorHref = chapterHrefDict[min(nextValueList)]
+                    isAfter = False
+                itemId = f"novel{chapterValue}"
+                while itemId in idSet:
+                    itemId += "_"
+                idSet.add(itemId)
+                anchorItem = itemDict.get(anchorHref)
+                newItem = etree.Element(f"{{{opfNamespace}}}item", {
+                    "href": newHref, "id": itemId,
+                    "media-type": anchorItem.get("media-type") if anchorItem is not None else "application/xhtml+xml"})
+                insertTocEntry(anchorItem, isAfter, manifest, newItem)
+                itemDict[newHref] = newItem
+                anchorItemref = None
+                if anchorItem is not None:
+                    anchorItemref = next((itemref for itemref in spine if itemref.get("idref") == anchorItem.get("id")),
+                                         None)
+                insertTocEntry(anchorItemref, isAfter, spine, etree.Element(f"{{{opfNamespace}}}itemref",
+                                                                              {"idref": itemId}))
+                if ncxTree is not None:
+                    newPoint = etree.Element(f"{{{ncxNamespace}}}navPoint", {"id": itemId})
+                    etree.SubElement(etree.SubElement(newPoint, f"{{{ncxNamespace}}}navLabel"),
+                                     f"{{{ncxNamespace}}}text").text = chapter.title
+                    etree.SubElement(newPoint, f"{{{ncxNamespace}}}content", {"src": newHref})
+                    insertTocEntry(ncxPointOf(anchorHref) if anchorHref else None, isAfter,
+                                   ncxTree.find(f"{{{ncxNamespace}}}navMap"), newPoint)
+                if navTree is not None:
+                    newNavItem = etree.Element(f"{{{xhtmlNamespace}}}li")
+                    etree.SubElement(newNavItem, f"{{{xhtmlNamespace}}}a", {"href": newHref}).text = chapter.title
+                    insertTocEntry(navItemOf(anchorHref) if anchorHref else None, isAfter,
+                                   navTree.find(f".//{{{xhtmlNamespace}}}nav/{{{xhtmlNamespace}}}ol"), newNavItem)
+            chapterHrefDict[chapterValue] = newHref
+        # 新图片
+        newImageCount = 0
+        for picName, imgFileName in newImgDict.imgFilePathDict.items():
+            if imgFileName in itemDict:
+                continue
+            imgContent = newImgDict.imgStore.get(picName)
+            if imgContent is None:
+                continue
+            writeDict[entryName(imgFileName)] = imgContent
+            newItem = etree.SubElement(manifest, f"{{{opfNamespace}}}item", {
+                "href": imgFileName, "id": imgFileName, "media-type": newImgDict.imgContentTypeDict[picName]})
+            itemDict[imgFileName] = newItem
+            newImageCount += 1
+        modifiedMeta = opfTree.find(f"{{{opfNamespace}}}metadata/{{{opfNamespace}}}meta[@property='dcterms:modified']")
+        if modifiedMeta is not None:
+            modifiedMeta.text = datetime.now(timezone.utc).strftime("%Y-%m-%dT%H:%M:%SZ")
+        writeDict[opfName] = etree.tostring(opfTree, xml_declaration=True, encoding="utf-8")
+        if ncxTree is not None:
+            writeDict[entryName(ncxHref)] = etree.tostring(ncxTree, xml_declaration=True, encoding="utf-8")
+        if navTree is not None:
+            writeDict[entryName(navHref)] = etree.tostring(navTree.getroottree(), xml_declaration=True,
+                                                           encoding="utf-8")
+
+        partPath = epubPath + ".part"
+        try:
+            with open(epubPath, "rb") as sourceFile, zipfile.ZipFile(partPath, "w", zipfile.ZIP_DEFLATED) as targetZip:
+                for info in sourceZip.infolist():
+                    if info.filename in removeSet:
+                        continue
+                    if info.filename in writeDict:
+                        targetZip.writestr(info.filename, writeDict.pop(info.filename))
+                    else:
+                        copyZipEntryRaw(sourceFile, targetZip, info)
+                for name, content in writeDict.items():
+                    targetZip.writestr(name, content)
+        except Exception:
+            if path.exists(partPath):
+                os.remove(partPath)
+            raise
+    os.replace(partPath, epubPath)
+    return updatedCount, addedCount, len(chapterHrefDict), newImageCount
+
+
 def mergeChaptersToExisting(bookName, bookAuthor, newChapters, newImgDict, selectedIndices):
     """将新下载的章节合并到已有的epub和txt文件中
     
-    策略：读取原EPUB，按索引顺序替换/插入章节，保留原有结构
+    策略：在zip层面替换/插入章节，其余条目原样复制，保留原有结构
     """
     epubPath = f"./epubBooks_esjzone/《{bookName}》{bookAuthor}.epub"
     txtPath = f"./txtBooks_esjzone/《{bookName}》{bookAuthor}.txt"
@@ -615,199 +2963,12 @@ def mergeChaptersToExisting(bookName, bookAuthor, newChapters, newImgDict, selec
     if path.exists(epubPath):
         try:
             log_message(f"正在合并章节到EPUB: {epubPath}")
-            
-            import shutil
-            
-            # 读取原EPUB
-            existingBook = epub.read_epub(epubPath, {'ignore_ncx': True})
-            
-            # 从TOC中提取章节标题映射
-            chapterTitles = {}  # file_name -> title
-            otherTitles = {}  # file_name -> title
-            for tocItem in existingBook.toc:
-                if hasattr(tocItem, 'href') and hasattr(tocItem, 'title'):
-                    href = tocItem.href.split('#')[0]  # 移除锚点
-                    if tocItem.title:
-                        if 'novel_' in href:
-                            chapterTitles[href] = tocItem.title
-                        else:
-                            otherTitles[href] = tocItem.title
-            
-            # 获取所有现有章节及其索引
-            existingChapters = {}  # idx -> dict
-            otherHtmlItems = []  # 非章节HTML项目（封面、简介等）
-            imageItems = {}  # 图片项目，用于去重
-            coverImageItem = None  # 封面图片
-            
-            for item in existingBook.get_items():
-                fileName = getattr(item, 'file_name', '') or ''
-                
-                # 检查是否是封面图片
-                if isinstance(item, epub.EpubCover):
-                    coverImageItem = item
-                    continue
-                
-                # 检查是否是章节文件
-                match = re.search(r'novel_(\d+)\.html', fileName)
-                if match:
-                    chapterIdx = int(match.group(1))
-                    content = item.content
-                    if content and (isinstance(content, bytes) and content.strip() or isinstance(content, str) and content.strip()):
-                        if isinstance(content, str):
-                            content = content.encode('utf-8')
-                        # 优先从TOC获取标题
-                        title = chapterTitles.get(fileName, '') or getattr(item, 'title', '') or f'Chapter {chapterIdx}'
-                        existingChapters[chapterIdx] = {
-                            'content': content,
-                            'title': title
-                        }
-                elif isinstance(item, epub.EpubImage):
-                    imageItems[fileName] = item
-                elif isinstance(item, (epub.EpubNcx, epub.EpubNav)):
-                    pass
-                elif fileName in ['nav.xhtml', 'toc.ncx', 'cover.xhtml']:
-                    pass  # 跳过导航文件和cover.xhtml（set_cover会自动生成）
-                elif fileName.endswith('.html') or fileName.endswith('.xhtml'):
-                    content = item.content
-                    if content and (isinstance(content, bytes) and content.strip() or isinstance(content, str) and content.strip()):
-                        if isinstance(content, str):
-                            content = content.encode('utf-8')
-                        # 优先从TOC获取标题
-                        title = otherTitles.get(fileName, '') or getattr(item, 'title', '') or ''
-                        otherHtmlItems.append({
-                            'file_name': fileName,
-                            'content': content,
-                            'title': title,
-                            'uid': getattr(item, 'id', fileName)
-                        })
-                elif fileName:
-                    pass  # 其他文件暂不处理
-            
-            log_message(f"  从原文件读取了 {len(existingChapters)} 个章节")
-            
-            # 更新/添加新章节
-            updatedCount = 0
-            addedCount = 0
-            for chapterIdx, chapter in newChapters:
-                if chapter.isChapter:
-                    content = chapter.epubValue.content
-                    if content is None or (isinstance(content, str) and not content.strip()) or (isinstance(content, bytes) and not content.strip()):
-                        content = f"<html><head></head><body><h1>{chapter.title}</h1><p>内容为空</p></body></html>".encode('utf-8')
-                    
-                    # 确保内容是bytes类型
-                    if isinstance(content, str):
-                        content = content.encode('utf-8')
-                    
-                    if chapterIdx in existingChapters:
-                        log_message(f"  替换章节 [{chapterIdx}]: {chapter.title}")
-                        updatedCount += 1
-                    else:
-                        log_message(f"  添加章节 [{chapterIdx}]: {chapter.title}")
-                        addedCount += 1
-                    
-                    existingChapters[chapterIdx] = {
-                        'content': content,  # bytes类型
-                        'title': chapter.title
-                    }
-            
-            # 添加新图片（跳过已存在的）
-            newImageCount = 0
-            for picName in newImgDict.imgFilePathDict:
-                try:
-                    imgFileName = newImgDict.imgFilePathDict[picName]
-                    if imgFileName not in imageItems:
-                        newImg = epub.EpubImage(
-                            uid=str(picName),
-                            file_name=imgFileName,
-                            media_type=newImgDict.imgContentTypeDict[picName],
-                            content=newImgDict.imgByteDict[picName].getvalue()
-                        )
-                        imageItems[imgFileName] = newImg
-                        newImageCount += 1
-                except:
-                    pass
-            
+            with StageTimer("epub_patch"):
+                updatedCount, addedCount, totalCount, newImageCount = patchEpubChapters(epubPath, newChapters,
+                                                                                        newImgDict)
             if newImageCount > 0:
                 log_message(f"  添加了 {newImageCount} 张新图片")
-            
-            # 创建新的EPUB
-            newBook = epub.EpubBook()
-            
-            # 复制元数据
-            newBook.set_identifier(existingBook.get_metadata('DC', 'identifier')[0][0] if existingBook.get_metadata('DC', 'identifier') else str(uuid.uuid4()))
-            newBook.set_title(bookName)
-            newBook.set_language("zh")
-            newBook.add_author(bookAuthor)
-            
-            # 复制自定义元数据
-            try:
-                for meta in existingBook.get_metadata('OPF', 'esjLastChangeDate'):
-                    newBook.add_metadata(None, 'meta', '', {'name': 'esjLastChangeDate', 'content': meta[1].get('content', '')})
-            except:
-                pass
-            
-            # 复制封面图片
-            if coverImageItem:
-                newBook.set_cover(coverImageItem.file_name, coverImageItem.content)
-            
-            # 添加其他非章节HTML项目（封面HTML、简介等），使用Link保留标题
-            for itemData in otherHtmlItems:
-                htmlItem = epub.EpubHtml(
-                    uid=itemData['uid'],
-                    file_name=itemData['file_name'],
-                    title=itemData['title'],
-                    lang="zh"
-                )
-                htmlItem.content = itemData['content']
-                newBook.add_item(htmlItem)
-                newBook.spine.append(htmlItem)
-                # 使用Link对象保留标题
-                newBook.toc.append(epub.Link(itemData['file_name'], itemData['title'], itemData['uid']))
-            
-            # 按索引顺序添加所有章节
-            sortedChapterIndices = sorted(existingChapters.keys())
-            chapterToc = []
-            for idx in sortedChapterIndices:
-                chapterData = existingChapters[idx]
-                content = chapterData['content']  # 已经是bytes类型
-                title = chapterData.get('title', f'Chapter {idx}')
-                
-                # 确保内容有效（bytes类型）
-                if not content or not content.strip():
-                    content = f"<html><head></head><body><h1>{title}</h1><p>内容为空</p></body></html>".encode('utf-8')
-                
-                chapterHtml = epub.EpubHtml(
-                    uid=f"novel{idx}",
-                    file_name=f"novel_{idx}.html",
-                    title=title,
-                    lang="zh"
-                )
-                chapterHtml.content = content  # bytes类型
-                
-                newBook.add_item(chapterHtml)
-                newBook.spine.append(chapterHtml)
-                # 使用Link对象保留章节标题
-                chapterToc.append(epub.Link(f"novel_{idx}.html", title, f"novel{idx}"))
-            
-            # 添加章节到目录
-            newBook.toc.extend(chapterToc)
-            
-            # 添加所有图片
-            for imgFileName, imgItem in imageItems.items():
-                newBook.add_item(imgItem)
-            
-            # 添加导航
-            newBook.add_item(epub.EpubNcx())
-            newBook.add_item(epub.EpubNav())
-            
-            # 备份原文件
-            backupPath = epubPath.replace('.epub', '_backup.epub')
-            shutil.copy2(epubPath, backupPath)
-            log_message(f"  原文件已备份至: {backupPath}")
-            
-            # 保存新EPUB
-            epub.write_epub(epubPath, newBook, {})
-            log_message(f"EPUB合并完成: 替换 {updatedCount} 个章节, 新增 {addedCount} 个章节, 总计 {len(existingChapters)} 个章节")
+            log_message(f"EPUB合并完成: 替换 {updatedCount} 个章节, 新增 {addedCount} 个章节, 总计 {totalCount} 个章节")
             epubMerged = True
             
         except Exception as e:
@@ -821,21 +2982,26 @@ def mergeChaptersToExisting(bookName, bookAuthor, newChapters, newImgDict, selec
     if path.exists(txtPath):
         try:
             log_message(f"正在合并章节到TXT: {txtPath}")
-            
-            newChapterContents = {}
-            for chapterIdx, chapter in newChapters:
-                if chapter.isChapter:
-                    newChapterContents[chapterIdx] = chapter.txtValue
-
-            # 直接追加章节内容，不添加额外标记
-            appendContent = "\n"
-            for chapterIdx in sorted(newChapterContents.keys()):
-                appendContent += newChapterContents[chapterIdx]
-            
-            with open(txtPath, "a", encoding="utf-8") as f:
-                f.write(appendContent)
-            
-            log_message(f"TXT合并完成，追加了 {len(newChapterContents)} 个章节")
+            with StageTimer("txt_merge"):
+                mergeResult = mergeTxtChapters(txtPath, newChapters)
+            if mergeResult is not None:
+                log_message(f"TXT合并完成: 替换 {mergeResult[0]} 个章节, 新增 {mergeResult[1]} 个章节")
+            else:
+                log_message("已有txt没有可用的索引，新章节追加到末尾", 'warning')
+                newChapterContents = {}
+                for chapterValue, chapter in newChapters:
+                    if chapter.isChapter:
+                        newChapterContents[chapterValue] = chapter.txtValue
+
+                # 直接追加章节内容，不添加额外标记
+                appendContent = "\n"
+                for chapterValue in sorted(newChapterContents.keys()):
+                    appendContent += newChapterContents[chapterValue]
+
+                with open(txtPath, "a", encoding="utf-8") as f:
+                    f.write(appendContent)
+
+                log_message(f"TXT合并完成，追加了 {len(newChapterContents)} 个章节")
             txtMerged = True
             
         except Exception as e:
@@ -847,12 +3013,334 @@ def mergeChaptersToExisting(bookName, bookAuthor, newChapters, newImgDict, selec
         return epubPath, txtPath
     return None, None
 
+class StreamingEpubWriter(epub.EpubWriter):
+    """边下载边写epub：章节与图片完成后立即写入zip并释放内容，opf/ncx/nav等在finish时写入
+    先写入.part临时文件，finish时替换目标文件"""
+
+    def __init__(self, fileName, book: epub.EpubBook):
+        # epub3_pages需要重新解析全部章节查找分页标记，章节内容已释放且本站页面没有分页标记
+        epub.EpubWriter.__init__(self, fileName, book, {"epub3_pages": False})
+        self.partFileName = fileName + ".part"
+        self.lock = threading.Lock()
+        # 已写入zip的文件名，finish时只在opf中登记
+        self.writtenNameSet = set()
+        self.out = zipfile.ZipFile(self.partFileName, "w", zipfile.ZIP_DEFLATED,
+                                   compresslevel=self.options["compresslevel"])
+        self.out.writestr("mimetype", "application/epub+zip", compress_type=zipfile.ZIP_STORED)
+        self._write_container()
+
+    def writeEntry(self, fileName, content):
+        with self.lock:
+            if fileName in self.writtenNameSet:
+                return
+            with StageTimer("epub_write", len(content)):
+                self.out.writestr(f"{self.book.FOLDER_NAME}/{fileName}", content)
+            self.writtenNameSet.add(fileName)
+
+    def writeCharacter(self, character: novelCharacterListNode):
+        """写入章节/卷的html并释放内容，生成html需要book中的模板"""
+        character.epubValue.book = self.book
+        self.writeEntry(character.epubValue.file_name, character.epubValue.get_content())
+        character.epubValue.content = ""
+        character.content = ""
+
+    def _write_items(self):
+        for item in self.book.get_items():
+            if item.file_name in self.writtenNameSet:
+                continue
+            if isinstance(item, epub.EpubNcx):
+                self.writeEntry(item.file_name, self._get_ncx())
+            elif isinstance(item, epub.EpubNav):
+                self.writeEntry(item.file_name, self._get_nav(item))
+            elif item.manifest:
+                self.writeEntry(item.file_name, item.get_content())
+            else:
+                self.out.writestr(item.file_name, item.get_content())
+
+    def finish(self):
+        self.process()
+        self._write_opf()
+        self._write_items()
+        self.out.close()
+        os.replace(self.partFileName, self.file_name)
+
+    def abort(self):
+        """放弃写入并删除.part临时文件，finish之后或重复调用时不做任何事"""
+        try:
+            self.out.close()
+        except Exception as e:
+            log_message(f"关闭epub临时文件失败: {self.partFileName} {str(e)}", 'warning')
+        if path.exists(self.partFileName):
+            os.remove(self.partFileName)
+
+
+class StreamingTxtWriter(object):
+    """按书中顺序边下载边写txt：完成的节点先放入重排缓冲，之前的节点都写入后才写入.part临时文件
+    finish时替换目标文件，并写入记录各节点字节范围的索引(writeTxtIndex)"""
+
+    def __init__(self, fileName, headText):
+        self.fileName = fileName
+        self.partFileName = fileName + ".part"
+        self.lock = threading.Lock()
+        self.txtFile = open(self.partFileName, "wb")
+        self.offset = 0
+        self.entryList = []
+        self.writeEntry("head", headText)
+        # 节点序号 -> (epub中的文件名, 文字, 章节url)，等待之前的节点完成
+        self.pendingDict = {}
+        self.nextValue = 0
+
+    def writeEntry(self, name, text, url=""):
+        data = encodeTxt(text)
+        with StageTimer("txt_write", len(data)):
+            self.txtFile.write(data)
+        entry = {"name": name, "start": self.offset, "end": self.offset + len(data)}
+        if url:
+            entry["url"] = url
+        self.entryList.append(entry)
+        self.offset += len(data)
+
+    def write(self, value, text, name="", url=""):
+        with self.lock:
+            self.pendingDict[value] = (name, text, url)
+            while self.nextValue in self.pendingDict:
+                self.writeEntry(*self.pendingDict.pop(self.nextValue))
+                self.nextValue += 1
+
+    def writeCharacter(self, character: novelCharacterListNode):
+        """写入章节/卷的文字并释放，章节在索引中记录url，增量更新时据此对应"""
+        self.write(character.value, character.txtValue, character.epubValue.file_name,
+                   urlHandler(character.url) if character.isChapter else "")
+        character.txtValue = ""
+
+    def finish(self):
+        # 序号有空缺时(被过滤的卷、异常未完成的节点)剩余的文字仍按顺序写入
+        for value in sorted(self.pendingDict):
+            self.writeEntry(*self.pendingDict[value])
+        self.pendingDict.clear()
+        self.txtFile.close()
+        os.replace(self.partFileName, self.fileName)
+        writeTxtIndex(self.fileName, self.entryList, self.offset)
+
+    def abort(self):
+        """放弃写入并删除.part临时文件，finish之后或重复调用时不做任何事"""
+        self.txtFile.close()
+        if path.exists(self.partFileName):
+            os.remove(self.partFileName)
+
+
+def calculateFileSha256(filePath):
+    sha256_hash = hashlib.sha256()
+    with open(filePath, "rb") as f:
+        for block in iter(lambda: f.read(1024 * 1024), b""):
+            sha256_hash.update(block)
+    return sha256_hash.hexdigest()
+
+
+def readEpubManifestInfo(epubPath):
+    """只读取epub中的opf，取得书籍url、书名、作者、更新日期及章节数"""
+    with zipfile.ZipFile(epubPath) as epubZip:
+        container = epubZip.read("META-INF/container.xml").decode("utf-8")
+        opfPath = re.search(r'full-path="([^"]+)"', container).group(1)
+        opf = epubZip.read(opfPath).decode("utf-8")
+
+    def metaContent(name):
+        match = re.search(r'<meta name="' + name + r'" content="([^"]*)"', opf)
+        return html.unescape(match.group(1)) if match else ""
+
+    def dcText(name):
+        match = re.search(r'<dc:' + name + r'[^>]*>(.*?)</dc:' + name + r'>', opf, re.S)
+        return html.unescape(match.group(1)) if match else ""
+
+    chapterCount = len(re.findall(r'href="(?:error_)?novel_\d+\.html"', opf))
+    return metaContent("esjBookUrl"), dcText("title"), dcText("creator"), metaContent("esjLastChangeDate"), chapterCount
+
+
+class BookManifestEntry(object):
+    def __init__(self, url, name, author, changeDate, chapterCount, epubPath, txtPath, epubSha256, txtSha256,
+                 updatedAt):
+        self.url = url
+        self.name = name
+        self.author = author
+        self.changeDate = changeDate
+        self.chapterCount = chapterCount
+        self.epubPath = epubPath
+        self.txtPath = txtPath
+        self.epubSha256 = epubSha256
+        self.txtSha256 = txtSha256
+        self.updatedAt = updatedAt
+
+
+class BookManifest(object):
+    """已下载书籍清单，sqlite中按书籍url保存书籍信息，每次写入epub后更新，可从epub目录重建"""
+
+    def __init__(self, manifestPath):
+        isNew = not path.exists(manifestPath)
+        os.makedirs(path.dirname(manifestPath) or ".", exist_ok=True)
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(manifestPath, check_same_thread=False)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("CREATE TABLE IF NOT EXISTS books (url TEXT PRIMARY KEY, name TEXT NOT NULL, "
+                        "author TEXT NOT NULL, change_date TEXT NOT NULL, chapter_count INTEGER NOT NULL, "
+                        "epub_path TEXT NOT NULL, txt_path TEXT, epub_sha256 TEXT NOT NULL, txt_sha256 TEXT, "
+                        "updated_at REAL NOT NULL)")
+        self.db.commit()
+        if isNew:
+            self.rebuild("./epubBooks_esjzone", "./txtBooks_esjzone")
+
+    def lookup(self, url):
+        with self.lock:
+            row = self.db.execute("SELECT * FROM books WHERE url = ?", (url,)).fetchone()
+        return BookManifestEntry(*row) if row is not None else None
+
+    def record(self, url, epubPath, txtPath):
+        """从写好的epub读取书籍信息并登记，hash在锁外计算"""
+        epubUrl, name, author, changeDate, chapterCount = readEpubManifestInfo(epubPath)
+        epubSha256 = calculateFileSha256(epubPath)
+        if txtPath is not None and path.exists(txtPath):
+            txtSha256 = calculateFileSha256(txtPath)
+        else:
+            txtPath, txtSha256 = None, None
+        with self.lock:
+            self.db.execute("INSERT OR REPLACE INTO books VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                            (url or epubUrl, name, author, changeDate, chapterCount, epubPath, txtPath,
+                             epubSha256, txtSha256, time()))
+            self.db.commit()
+
+    def rebuild(self, epubDir, txtDir):
+        """扫描epub目录重建清单，没有记录书籍url的旧epub无法登记，仍按原方式打开epub判断"""
+        if not path.isdir(epubDir):
+            return
+        recordedNum = 0
+        for fileName in sorted(os.listdir(epubDir)):
+            if not fileName.endswith(".epub"):
+                continue
+            epubPath = path.join(epubDir, fileName)
+            try:
+                if readEpubManifestInfo(epubPath)[0] == "":
+                    continue
+                self.record(None, epubPath, path.join(txtDir, fileName[:-len(".epub")] + ".txt"))
+                recordedNum += 1
+            except Exception as e:
+                log_message(f"书籍清单重建时读取失败: {epubPath} {str(e)}", 'warning')
+        log_message(f"书籍清单已从epub目录重建，登记 {recordedNum} 本")
+
+
+bookManifestLock = threading.Lock()
+bookManifest = None
+
+
+def getBookManifest():
+    global bookManifest
+    if not bookManifestPath:
+        return None
+    with bookManifestLock:
+        if bookManifest is None:
+            bookManifest = BookManifest(bookManifestPath)
+        return bookManifest
+
+
+def lookupBookManifest(url):
+    manifest = getBookManifest()
+    if manifest is None:
+        return None
+    try:
+        return manifest.lookup(urlHandler(url))
+    except Exception as e:
+        log_message(f"书籍清单读取失败: {url} {str(e)}", 'warning')
+        return None
+
+
+def recordBookManifest(url, epubPath, txtPath):
+    manifest = getBookManifest()
+    if manifest is None:
+        return
+    try:
+        manifest.record(urlHandler(url), epubPath, txtPath)
+    except Exception as e:
+        log_message(f"书籍清单更新失败: {epubPath} {str(e)}", 'warning')
+
+
 # 他妈的防御性编程，反反复复爬了一堆然后就报错，一看，哦，页面不规范，缺这个缺那的
+class BookOutput(object):
+    """一个文字版本的epub/txt输出。variant为None时是converter的主版本，其余为extraOutputVariants中的版本
+    各版本由同一次下载生成，额外版本的文件名在主版本文件名后加"_版本名"后缀"""
+
+    def __init__(self, variant, index, rawBookName, rawBookAuthor, bookChangeDate, url):
+        self.variant = variant
+        # 主版本为0，额外版本为其在章节节点variantNodeList中的位置+1
+        self.index = index
+        self.fileSuffix = "" if variant is None else f"_{variant}"
+        self.bookName, self.bookAuthor = cleanBookNameAuthor(convertText(rawBookName, variant),
+                                                             convertText(rawBookAuthor, variant))
+        self.epubBook = epub.EpubBook()
+        self.epubBook.set_identifier(str(uuid.uuid4()))
+        self.epubBook.set_language("zh")
+        self.epubBook.set_title(self.bookName)
+        self.epubBook.add_author(self.bookAuthor)
+        self.epubBook.add_metadata(None, 'meta', '', {'name': 'esjLastChangeDate', 'content': bookChangeDate})
+        self.epubBook.add_metadata(None, 'meta', '', {'name': 'esjBookUrl', 'content': urlHandler(url)})
+        self.txtHead = ""
+        self.epubFileName = ""
+        self.txtFileName = ""
+        self.epubWriter = None
+        self.txtWriter = None
+
+    def nodeOf(self, character: novelCharacterListNode):
+        return character if self.index == 0 else character.variantNodeList[self.index - 1]
+
+    def openWriters(self, epubFileName, txtFileName):
+        """文件名为主版本的文件名，额外版本加后缀"""
+        self.epubFileName = re.sub(r'\.epub$', self.fileSuffix + '.epub', epubFileName)
+        self.txtFileName = re.sub(r'\.txt$', self.fileSuffix + '.txt', txtFileName)
+        self.epubWriter = StreamingEpubWriter(self.epubFileName, self.epubBook)
+        self.txtWriter = StreamingTxtWriter(self.txtFileName, self.txtHead)
+
+    def abort(self):
+        """下载或保存出错时关闭文件并删除.part临时文件，已保存的版本不受影响"""
+        for writer in (self.epubWriter, self.txtWriter):
+            if writer is not None:
+                writer.abort()
+
+
+def cleanBookNameAuthor(bookName, bookAuthor):
+    """替换文件名中不允许的字符并限制长度"""
+    bookName = re.sub(r'[\\/:*?"<>|]', '', bookName)
+    bookAuthor = re.sub(r'[\\/:*?"<>|]', '', bookAuthor)
+    # 他妈的日本傻逼轻小说名过长会引起File name too long错误！
+    if len(bookName) > 48:
+        bookName = bookName[:47] + '…'
+    if len(bookAuthor) > 16:
+        bookAuthor = bookAuthor[:15] + '…'
+    return bookName, bookAuthor
+
+
+def selectDownloadList(novelCharacterList: list, selectedIndices: list):
+    """章节选择模式的下载列表：选中的章节(编号只计章节，从0开始)与全部卷，重新编号，所属卷随之改为新编号
+    选中章节的originalValue为重新编号前的节点序号(含卷)，已有epub/txt中的novel_N.html按此命名，合并时据此对应"""
+    chapterNodeList = [character for character in novelCharacterList if character.isChapter]
+    selectedSet = {id(chapterNodeList[index]) for index in selectedIndices if 0 <= index < len(chapterNodeList)}
+    downloadList = []
+    for character in novelCharacterList:
+        if id(character) in selectedSet:
+            character.originalValue = character.value
+            downloadList.append(character)
+        elif character.isVolume:
+            downloadList.append(character)
+    newValueDict = {character.value: newIdx for newIdx, character in enumerate(downloadList)}
+    for character in downloadList:
+        character.value = newValueDict[character.value]
+        character.fatherValue = newValueDict.get(character.fatherValue, -1)
+    return downloadList
+
+
+def mergePairList(downloadList: list):
+    """合并到已有文件的数据：[(重新编号前的节点序号, 章节节点)]"""
+    return [(character.originalValue, character) for character in downloadList
+            if character.isChapter and hasattr(character, 'originalValue')]
+
+
 def downloadOneBook(url, selectChapterMode=False):
-    epubCreateBook = epub.EpubBook()
-    epubCreateBook.set_identifier(str(uuid.uuid4()))
-    epubCreateBook.set_language("zh")
-    txtCreateBook = ""
     epubImgDict = ImgThreadSafeDict()
 
     # 书籍基本信息获取
@@ -860,248 +3348,354 @@ def downloadOneBook(url, selectChapterMode=False):
     if soupContent.find("h2") is None:
         log_message("*x*x*x*cookie无效,未登录。也有可能esjzone.cc和esjzone.me的cookie不通用[遇到重定向]", 'error')
         return None, None, None
-    bookName = converter.convert(soupContent.find("h2").text)
+    rawBookName = soupContent.find("h2").text
     bookAuthorTag = soupContent.find("ul", {"class": "list-unstyled mb-2 book-detail"})
-    bookAuthor = converter.convert(bookAuthorTag.find("a").text) if bookAuthorTag and bookAuthorTag.find("a") else ""
+    rawBookAuthor = bookAuthorTag.find("a").text if bookAuthorTag and bookAuthorTag.find("a") else ""
+    bookName = convertText(rawBookName)
+    bookAuthor = convertText(rawBookAuthor)
     
     # 设置该书的日志记录器
-    book_logger = setup_book_logger(bookName, bookAuthor)
+    setup_book_logger(bookName, bookAuthor)
     
-    # 替换文件名中不允许的字符
-    bookName = re.sub(r'[\\/:*?"<>|]', '', bookName)
-    bookAuthor = re.sub(r'[\\/:*?"<>|]', '', bookAuthor)
-    # 他妈的日本傻逼轻小说名过长会引起File name too long错误！
-    if len(bookName) > 48:
-        bookName = bookName[:47] + '…'
-    if len(bookAuthor) > 16:
-        bookAuthor = bookAuthor[:15] + '…'
-    epubCreateBook.set_title(bookName)
-    epubCreateBook.add_author(bookAuthor)
+    bookName, bookAuthor = cleanBookNameAuthor(bookName, bookAuthor)
     bookChangeDate = ""
     if bookAuthorTag:
         bookAuthorText = bookAuthorTag.get_text()
         dates = re.findall(r'\d{4}-\d{2}-\d{2}', bookAuthorText)
         if dates:
             bookChangeDate = dates[-1]
-    epubCreateBook.add_metadata(None, 'meta', '', {'name': 'esjLastChangeDate', 'content': bookChangeDate})
-    if isDownloadAll and path.exists(f"./epubBooks_esjzone/《{bookName}》{bookAuthor}.epub"):
-        existBook = epub.read_epub(f"./epubBooks_esjzone/《{bookName}》{bookAuthor}.epub", {'ignore_ncx': True})
+    if isDownloadAll and bookChangeDate != '':
+        # 先查书籍清单，命中则不必打开已有epub
+        manifestEntry = lookupBookManifest(url)
+        if manifestEntry is not None and manifestEntry.changeDate == bookChangeDate and path.exists(
+                manifestEntry.epubPath):
+            log_message(f"《{bookName}》{bookAuthor} 更新日期{bookChangeDate} 已存在")
+            return bookName, bookAuthor, bookChangeDate
+    existBook = None
+    existEpubPath = f"./epubBooks_esjzone/《{bookName}》{bookAuthor}.epub"
+    if (isDownloadAll or (isIncrementalUpdate and not selectChapterMode)) and path.exists(existEpubPath):
+        existBook = epub.read_epub(existEpubPath, {'ignore_ncx': True})
+    if isDownloadAll and existBook is not None:
         existBookLastChangeDate = ''
         try:
             existBookLastChangeDate = existBook.get_metadata('OPF', 'esjLastChangeDate')[0][1]['content']
-        except Exception as e:
+        except Exception:
             pass
         if existBookLastChangeDate == bookChangeDate and existBookLastChangeDate != '' and bookChangeDate != '':
             log_message(f"《{bookName}》{bookAuthor} 更新日期{bookChangeDate} 已存在")
+            # 清单中没有的旧epub，补登记后下次不必再打开
+            recordBookManifest(url, existEpubPath, f"./txtBooks_esjzone/《{bookName}》{bookAuthor}.txt")
             return bookName, bookAuthor, bookChangeDate
     log_message(f"-{bookName}开始下载")
+    # 各文字版本的输出，章节选择模式只输出主版本
+    variantList = [None]
+    if len(extraOutputVariants) > 0:
+        if selectChapterMode:
+            log_message("章节选择模式只输出converter的版本，不输出extraOutputVariants", 'warning')
+        else:
+            variantList += extraOutputVariants
+    outputList = [BookOutput(variant, index, rawBookName, rawBookAuthor, bookChangeDate, url)
+                  for index, variant in enumerate(variantList)]
     # 封面尝试获取
     if soupContent.find("div", {"class": "product-gallery text-center mb-3"}) is not None:
         coverUrl = urlHandler(
             soupContent.find("div", {"class": "product-gallery text-center mb-3"}).find("img").get("src"))
         coverData, coverDataTypeName, _, coverDataType = getImgData(coverUrl)
         if coverDataTypeName is not None:
-            epubCreateBook.set_cover("cover" + coverDataTypeName, coverData.getvalue())
-            coverHtml = epub.EpubHtml(uid="coverHtml", title="封面", file_name="cover.html", lang="zh")
-            coverHtml.content = f"<img src='cover{coverDataTypeName}'/>"
-            epubCreateBook.add_item(coverHtml)
-            epubCreateBook.toc.append(coverHtml)
-            epubCreateBook.spine.append(coverHtml)
+            coverContent = coverData.getvalue()
+            for output in outputList:
+                output.epubBook.set_cover("cover" + coverDataTypeName, coverContent)
+                coverHtml = epub.EpubHtml(uid="coverHtml", title="封面", file_name="cover.html", lang="zh")
+                coverHtml.content = f"<img src='cover{coverDataTypeName}'/>"
+                output.epubBook.add_item(coverHtml)
+                output.epubBook.toc.append(coverHtml)
+                output.epubBook.spine.append(coverHtml)
     # 简介获取
-    bookDescription = epub.EpubHtml(uid="description", title="简介", file_name="description.html", lang="zh")
     if soupContent.find("div", {"class": "description"}) is not None:
-        bookDescription.content = htmlSimplified(soupContent,
-                                                 soupContent.find("div", {"class": "description"}).contents,
-                                                 epubImgDict)
-        if len(re.sub('\\s', '', bookDescription.content)) == 0:
-            bookDescription.content = "<p>【空】</p>"
-        epubCreateBook.add_item(bookDescription)
-        epubCreateBook.toc.append(bookDescription)
-        epubCreateBook.spine.append(bookDescription)
-        txtCreateBook += "简介\n" + imgTagConvert(bookDescription.content, epubImgDict)
+        descriptionPieceList = extractContents(soupContent.find("div", {"class": "description"}).contents)
+        for output in outputList:
+            bookDescription = epub.EpubHtml(uid="description", title="简介", file_name="description.html",
+                                            lang="zh")
+            txtPieceList = []
+            bookDescription.content = resolveContents(convertContents(descriptionPieceList, output.variant),
+                                                      epubImgDict, txtPieceList)
+            if len(re.sub('\\s', '', bookDescription.content)) == 0:
+                notice = convertText(emptyNotice, output.variant)
+                bookDescription.content = f"<p>{notice}</p>"
+                txtPieceList = [(False, notice)]
+            output.epubBook.add_item(bookDescription)
+            output.epubBook.toc.append(bookDescription)
+            output.epubBook.spine.append(bookDescription)
+            output.txtHead += "简介\n" + simplifiedTxt(txtPieceList)
     # 章节获取
 
     novelCharacterList = []
     chapterList = soupContent.find("div", {"id": "chapterList"})
     if chapterList is None:
         return None, None, None
-    depth = contentsAnalysis(chapterList.contents, novelCharacterList, 0, -1)
+    analyseChapterList(chapterList, novelCharacterList)
+    for output in outputList[1:]:
+        for character, title in zip(novelCharacterList,
+                                    convertBatch([character.rawTitle for character in novelCharacterList],
+                                                 output.variant)):
+            character.addVariantNode(output.variant, title)
     
     # 章节选择模式：筛选要下载的章节
     downloadList = novelCharacterList
     selectedIndices = []
-    chapterIndexMap = {}  # chapterIndex -> novelCharacterList index
-    reverseChapterMap = {}  # novelCharacterList index -> chapterIndex
-    
-    # 先建立章节索引映射
-    chapterIdx = 0
-    for idx, character in enumerate(novelCharacterList):
-        if character.isChapter:
-            chapterIndexMap[chapterIdx] = idx
-            reverseChapterMap[idx] = chapterIdx
-            chapterIdx += 1
-    
     if selectChapterMode:
         selectedIndices = getSelectedChapterIndices()
         if selectedIndices:
-            # 筛选要下载的章节
-            selectedNodeIndices = set()
-            for selIdx in selectedIndices:
-                if selIdx in chapterIndexMap:
-                    selectedNodeIndices.add(chapterIndexMap[selIdx])
-            
-            # 创建只包含选中章节的下载列表，保留原始索引信息
-            downloadList = []
-            for idx, c in enumerate(novelCharacterList):
-                if idx in selectedNodeIndices:
-                    c.originalChapterIndex = reverseChapterMap.get(idx, -1)
-                    downloadList.append(c)
-                elif c.isVolume:
-                    downloadList.append(c)
-            
-            # 重新编号
-            for newIdx, c in enumerate(downloadList):
-                c.value = newIdx
-            
+            downloadList = selectDownloadList(novelCharacterList, selectedIndices)
             log_message(f"章节选择模式: 选中 {len(selectedIndices)} 个章节")
     
-    # 多线程下载
-    threadList = []
-    for threadCount in range(0, threadNum):
-        threadList.append(ThreadDownload(threadCount, downloadList, epubImgDict))
-        sleep(0.1)
-    for thread in threadList:
-        thread.start()
-    for thread in threadList:
-        thread.join()
-    printProgressBar(len(downloadList), len(downloadList), prefix='进度:', suffix="下载完成", length=20)
-    # 书籍保存
-    log_message("")
-    
-    # 统计下载情况
-    total_chapters = sum(1 for c in downloadList if c.isChapter)
-    failed_chapters = sum(1 for c in downloadList if c.isChapter and 'error_novel' in c.epubValue.file_name)
-    password_chapters = sum(1 for c in downloadList if c.isChapter and '本章节需要密码' in c.content)
-    empty_chapters = sum(1 for c in downloadList if c.isChapter and '【空】' in c.content)
-    
-    log_message(f"={bookName}章节下载完成")
-    log_message(f"总章节数: {total_chapters}, 下载失败: {failed_chapters}, 需要密码: {password_chapters}, 内容为空: {empty_chapters}")
-    
-    if failed_chapters > 0:
-        log_message("下载失败的章节:", 'error')
-        for character in downloadList:
-            if character.isChapter and 'error_novel' in character.epubValue.file_name:
-                log_message(f"  - {character.title} ({urlHandler(character.url)})", 'error')
-    
-    # 过滤掉空的卷（没有章节内容的卷）
-    finalList = []
-    for character in downloadList:
-        if character.isChapter:
-            finalList.append(character)
-        elif character.isVolume:
-            # 检查这个卷下面是否有章节被下载
-            hasContent = False
-            for c in downloadList:
-                if c.isChapter and c.fatherValue == character.value:
-                    hasContent = True
-                    break
-            if hasContent or not selectChapterMode:
-                finalList.append(character)
-    
-    for character in finalList:
-        epubCreateBook.add_item(character.epubValue)
-        epubCreateBook.spine.append(character.epubValue)
-        txtCreateBook += character.txtValue
-    epubCreateBook.toc.extend(listAnalysisToc(finalList, depth))
-    for pic in epubImgDict.imgFilePathDict:
-        epubCreateBook.add_item(
-            epub.EpubImage(uid=str(pic), file_name=epubImgDict.imgFilePathDict[pic],
-                           media_type=epubImgDict.imgContentTypeDict[pic],
-                           content=epubImgDict.imgByteDict[pic].getvalue()))
-    epubCreateBook.add_item(epub.EpubNcx())
-    epubCreateBook.add_item(epub.EpubNav())
-
     if not path.exists("./epubBooks_esjzone"):
         mkdir("./epubBooks_esjzone")
     if not path.exists("./txtBooks_esjzone"):
         mkdir("./txtBooks_esjzone")
+    # 章节选择模式下使用不同的文件名
+    if selectChapterMode and selectedIndices:
+        chapterRangeStr = f"_章节{min(selectedIndices)}-{max(selectedIndices)}"
+        epubFileName = f"./epubBooks_esjzone/《{bookName}》{bookAuthor}{chapterRangeStr}.epub"
+        txtFileName = f"./txtBooks_esjzone/《{bookName}》{bookAuthor}{chapterRangeStr}.txt"
+    else:
+        epubFileName = f"./epubBooks_esjzone/《{bookName}》{bookAuthor}.epub"
+        txtFileName = f"./txtBooks_esjzone/《{bookName}》{bookAuthor}.txt"
+    # 章节与图片完成后立即写入各版本的epub，txt按书中顺序写入(简介在最前)
+    # 章节选择模式的章节可能被过滤或合并到已有文件，最后统一写入
+    try:
+        for output in outputList:
+            output.openWriters(epubFileName, txtFileName)
+        isWriteOnDone = not selectChapterMode
+
+        def writeCharacterOutputs(character):
+            for characterOutput in outputList:
+                characterNode = characterOutput.nodeOf(character)
+                characterOutput.txtWriter.writeCharacter(characterNode)
+                characterOutput.epubWriter.writeCharacter(characterNode)
+
+        if isWriteOnDone:
+            epubImgDict.epubWriterList = [output.epubWriter for output in outputList]
+            onCharacterDone = writeCharacterOutputs
+        else:
+            onCharacterDone = None
+
+        # 增量更新：沿用已有书籍中未变化的章节。已有文件只有主版本，输出多个版本时全部重新生成
+        if len(outputList) > 1 and isIncrementalUpdate and existBook is not None:
+            log_message("输出多个文字版本，不沿用已有章节")
+        elif isIncrementalUpdate and existBook is not None and not selectChapterMode:
+            reuseExistingChapters(novelCharacterList, existBook, f"./txtBooks_esjzone/《{bookName}》{bookAuthor}.txt")
+            existBook = None
+
+        # 多线程下载
+        runDownload([c for c in downloadList if not c.isDone], epubImgDict, onCharacterDone)
+        # 书籍保存
+        log_message("")
+    
+        # 统计下载情况
+        total_chapters = sum(1 for c in downloadList if c.isChapter)
+        failed_chapters = sum(1 for c in downloadList if c.isChapter and 'error_novel' in c.epubValue.file_name)
+        password_chapters = sum(1 for c in downloadList if c.isChapter and c.isPasswordSkipped)
+        empty_chapters = sum(1 for c in downloadList if c.isChapter and c.isEmpty)
+    
+        log_message(f"={bookName}章节下载完成")
+        log_message(f"总章节数: {total_chapters}, 下载失败: {failed_chapters}, 需要密码: {password_chapters}, 内容为空: {empty_chapters}")
+    
+        if failed_chapters > 0:
+            log_message("下载失败的章节:", 'error')
+            for character in downloadList:
+                if character.isChapter and 'error_novel' in character.epubValue.file_name:
+                    log_message(f"  - {character.title} ({urlHandler(character.url)})", 'error')
+        # 下载时已判断过是否为空，不必再解析章节内容
+        if empty_chapters > 0:
+            log_message("内容为空的章节:", 'warning')
+            for character in downloadList:
+                if character.isChapter and character.isEmpty:
+                    log_message(f"  - {character.title}", 'warning')
     
-    # 章节选择模式且开启合并功能
-    if selectChapterMode and selectedIndices and isMergeToExisting:
-        # 准备合并数据：(原始章节索引, 章节节点)
-        chaptersToMerge = []
-        for character in finalList:
-            if character.isChapter and hasattr(character, 'originalChapterIndex'):
-                chaptersToMerge.append((character.originalChapterIndex, character))
+        finalList = filterEmptyVolumes(downloadList, selectChapterMode)
+    
+        for output in outputList:
+            outputNodeList = [output.nodeOf(character) for character in finalList]
+            for character in outputNodeList:
+                output.epubBook.add_item(character.epubValue)
+                output.epubBook.spine.append(character.epubValue)
+            output.epubBook.toc.extend(listAnalysisToc(outputNodeList))
+            for pic in epubImgDict.imgFilePathDict:
+                # 已写入epub的图片已从imgStore释放，只在opf中登记
+                output.epubBook.add_item(
+                    epub.EpubImage(uid=str(pic), file_name=epubImgDict.imgFilePathDict[pic],
+                                   media_type=epubImgDict.imgContentTypeDict[pic],
+                                   content=epubImgDict.imgStore.get(pic)))
+            output.epubBook.add_item(epub.EpubNcx())
+            output.epubBook.add_item(epub.EpubNav())
+        # 章节选择模式只有主版本
+        epubWriter = outputList[0].epubWriter
+        txtWriter = outputList[0].txtWriter
+
+        # 章节选择模式且开启合并功能
+        if selectChapterMode and selectedIndices and isMergeToExisting:
+            chaptersToMerge = mergePairList(finalList)
         
-        # 执行合并
-        mergedEpub, mergedTxt = mergeChaptersToExisting(
-            bookName, bookAuthor, chaptersToMerge, epubImgDict, selectedIndices)
+            # 执行合并
+            mergedEpub, mergedTxt = mergeChaptersToExisting(
+                bookName, bookAuthor, chaptersToMerge, epubImgDict, selectedIndices)
         
-        if mergedEpub or mergedTxt:
-            log_message(f"《{bookName}》{bookAuthor} 章节合并完成")
-        else:
-            # 合并失败，保存为独立文件
-            log_message("合并失败，将保存为独立文件", 'warning')
-            chapterRangeStr = f"_章节{min(selectedIndices)}-{max(selectedIndices)}"
-            epubFileName = f"./epubBooks_esjzone/《{bookName}》{bookAuthor}{chapterRangeStr}.epub"
-            txtFileName = f"./txtBooks_esjzone/《{bookName}》{bookAuthor}{chapterRangeStr}.txt"
-            epub.write_epub(epubFileName, epubCreateBook, {})
-            with open(txtFileName, "w", encoding="utf-8") as txtFile:
-                txtFile.write(txtCreateBook)
-            log_message(f"EPUB保存至: {epubFileName}")
-            log_message(f"TXT保存至: {txtFileName}")
-    else:
-        # 章节选择模式下使用不同的文件名
-        if selectChapterMode and selectedIndices:
-            chapterRangeStr = f"_章节{min(selectedIndices)}-{max(selectedIndices)}"
-            epubFileName = f"./epubBooks_esjzone/《{bookName}》{bookAuthor}{chapterRangeStr}.epub"
-            txtFileName = f"./txtBooks_esjzone/《{bookName}》{bookAuthor}{chapterRangeStr}.txt"
+            if mergedEpub or mergedTxt:
+                epubWriter.abort()
+                txtWriter.abort()
+                log_message(f"《{bookName}》{bookAuthor} 章节合并完成")
+                if mergedEpub:
+                    recordBookManifest(url, mergedEpub, mergedTxt)
+            else:
+                # 合并失败，保存为独立文件
+                log_message("合并失败，将保存为独立文件", 'warning')
+                epubWriter.finish()
+                for character in finalList:
+                    txtWriter.writeCharacter(character)
+                txtWriter.finish()
+                log_message(f"EPUB保存至: {epubFileName}")
+                log_message(f"TXT保存至: {txtFileName}")
         else:
-            epubFileName = f"./epubBooks_esjzone/《{bookName}》{bookAuthor}.epub"
-            txtFileName = f"./txtBooks_esjzone/《{bookName}》{bookAuthor}.txt"
-        
-        epub.write_epub(epubFileName, epubCreateBook, {})
-        with open(txtFileName, "w", encoding="utf-8") as txtFile:
-            txtFile.write(txtCreateBook)
-        log_message(f"《{bookName}》{bookAuthor} 日期{bookChangeDate}下载完成")
-        log_message(f"EPUB保存至: {epubFileName}")
-        log_message(f"TXT保存至: {txtFileName}")
+            for output in outputList:
+                output.epubWriter.finish()
+                if not isWriteOnDone:
+                    for character in finalList:
+                        output.txtWriter.writeCharacter(output.nodeOf(character))
+                output.txtWriter.finish()
+            log_message(f"《{bookName}》{bookAuthor} 日期{bookChangeDate}下载完成")
+            if not (selectChapterMode and selectedIndices):
+                recordBookManifest(url, epubFileName, txtFileName)
+            for output in outputList:
+                log_message(f"EPUB保存至: {output.epubFileName}")
+                log_message(f"TXT保存至: {output.txtFileName}")
+    except BaseException:
+        # 出错或中断时关闭各版本的文件并删除.part临时文件，再继续抛出
+        for output in outputList:
+            output.abort()
+        epubImgDict.imgStore.close()
+        raise
     
+    epubImgDict.imgStore.close()
     # 清理当前书籍的logger
-    global current_book_logger
+    current_book_logger = get_current_book_logger()
     if current_book_logger:
         for handler in current_book_logger.handlers[:]:
             handler.close()
             current_book_logger.removeHandler(handler)
-        current_book_logger = None
+        set_current_book_logger(None)
     
     return bookName, bookAuthor, bookChangeDate
 
 
-def listAnalysisToc(inputList: list[novelCharacterListNode], maxDepth: int):
-    resultList = []
-    for inputNode in inputList:
-        if inputNode.epubValue.content is None or len(inputNode.epubValue.content) == 0:
-            print()
-        if len(re.sub('\\s', '', BeautifulSoup(inputNode.epubValue.content, 'html.parser').get_text())) == 0:
-            print()
-    for depth in range(maxDepth, -1, -1):
-        for character in inputList:
-            if character.level == depth:
-                if character.isVolume:
-                    volumeTuple = (epub.Section(character.title, character.epubValue.file_name),
-                                   character.childVolumeList)
-                    if character.fatherValue == -1:
-                        resultList.append(volumeTuple)
-                    else:
-                        inputList[character.fatherValue].childVolumeList.append(volumeTuple)
-                if character.isChapter:
-                    if character.fatherValue == -1:
-                        resultList.append(character.epubValue)
-                    else:
-                        inputList[character.fatherValue].childVolumeList.append(character.epubValue)
+def printMemoryUsage():
+    process = psutil.Process(os.getpid())
+    mem = process.memory_info()[0] / float(2 ** 20)
+    print(f"··当前内存使用{mem:.2f}MB")
+    gc.collect()
+    process = psutil.Process(os.getpid())
+    mem = process.memory_info()[0] / float(2 ** 20)
+    print(f"··回收后当前内存使用{mem:.2f}MB")
+
+
+def getBookListPage(bookListPageURL):
+    """获取一页列表中的书籍，返回(详情页url, 列表页上的更新日期)，没有日期时为空字符串"""
+    listSoup = getSoupData(bookListPageURL)
+    bookList = listSoup.find_all("div", {"class": "col-lg-3 col-md-4 col-sm-3 col-xs-6"})
+    bookInfoList = []
+    for b in bookList:
+        dates = re.findall(r'\d{4}-\d{2}-\d{2}', b.get_text())
+        bookInfoList.append((urlHandler(b.find("a").get("href")), dates[-1] if dates else ""))
+    return bookInfoList
+
+
+def lookupUpToDateBook(bookUrl, listDate):
+    """列表页日期与书籍清单一致且文件仍在时，返回清单中的(书名, 作者, 更新日期)，否则返回None"""
+    if not isListDateSkip or listDate == "":
+        return None
+    manifestEntry = lookupBookManifest(bookUrl)
+    if manifestEntry is None or manifestEntry.changeDate != listDate or not path.exists(manifestEntry.epubPath):
+        return None
+    return manifestEntry.name, manifestEntry.author, manifestEntry.changeDate
+
+
+def downloadAllBooks(bookListURL, bookListNum):
+    """并发获取列表页，发现的书籍立即交给书籍线程池下载(同时下载bookThreadNum本)
+    返回按列表顺序排列的(书名, 作者, 更新日期)列表"""
+    global requestSemaphore
+    requestSemaphore = threading.BoundedSemaphore(max(maxRequestNum, 1))
+    # 书籍清单不存在时在此从epub目录重建，避免在某本书的下载过程中进行
+    getBookManifest()
+    # url -> (列表页序号, 页内位置)，跨页重复的书只下载一次，按最早出现的位置排序
+    bookOrderDict = {}
+    bookFutureDict = {}
+    bookResultList = []
+    with ThreadPoolExecutor(max_workers=max(bookThreadNum, 1)) as bookExecutor, \
+            ThreadPoolExecutor(max_workers=max(threadNum, 1)) as listExecutor:
+        listFutureDict = {listExecutor.submit(getBookListPage, bookListURL + f"{i}.html"): i
+                          for i in range(1, bookListNum + 1)}
+        listDoneCount = 0
+        # 列表页日期未变化而跳过的书籍 url -> (书名, 作者, 更新日期)
+        skippedBookDict = {}
+        for listFuture in as_completed(listFutureDict):
+            pageIndex = listFutureDict[listFuture]
+            for position, (bookUrl, listDate) in enumerate(listFuture.result()):
+                if bookUrl in bookOrderDict:
+                    bookOrderDict[bookUrl] = min(bookOrderDict[bookUrl], (pageIndex, position))
+                    continue
+                bookOrderDict[bookUrl] = (pageIndex, position)
+                upToDateBook = lookupUpToDateBook(bookUrl, listDate)
+                if upToDateBook is not None:
+                    skippedBookDict[bookUrl] = upToDateBook
+                    continue
+                bookFutureDict[bookExecutor.submit(downloadOneBook, bookUrl)] = bookUrl
+            listDoneCount += 1
+            printProgressBar(listDoneCount, bookListNum, prefix='列表进度:', length=20)
+        print("共" + str(len(bookFutureDict) + len(skippedBookDict)) + "本小说，其中" + str(len(skippedBookDict)) +
+              "本列表页日期未变化，跳过")
+        for bookUrl, upToDateBook in skippedBookDict.items():
+            bookResultList.append((bookOrderDict[bookUrl], upToDateBook))
+        doneCount = 0
+        for future in as_completed(bookFutureDict):
+            bookResultList.append((bookOrderDict[bookFutureDict[future]], future.result()))
+            doneCount += 1
+            print("已下载" + str(doneCount) + "本小说,进度" + str(int(doneCount * 100 / len(bookFutureDict))) + "%")
+            if doneCount % 100 == 0:
+                printMemoryUsage()
+    bookResultList.sort(key=lambda item: item[0])
+    return [bookResult for _, bookResult in bookResultList]
+
+
+def filterEmptyVolumes(downloadList: list[novelCharacterListNode], selectChapterMode: bool):
+    """过滤掉空的卷（没有章节内容的卷），仅章节选择模式下过滤"""
+    # 有章节被下载的卷
+    chapterFatherValueSet = {c.fatherValue for c in downloadList if c.isChapter}
+    finalList = []
+    for character in downloadList:
+        if character.isChapter:
+            finalList.append(character)
+        elif character.isVolume:
+            if character.value in chapterFatherValueSet or not selectChapterMode:
+                finalList.append(character)
+    return finalList
 
+
+def listAnalysisToc(inputList: list[novelCharacterListNode]):
+    """按fatherValue一次遍历生成目录。父节点总在子节点之前，卷的子目录列表在元组中引用，之后追加的子节点同样生效
+    章节选择模式会过滤掉空的卷，所属卷按编号查找，找不到时放在最外层"""
+    resultList = []
+    characterDict = {character.value: character for character in inputList}
+    for character in inputList:
+        if character.isVolume:
+            tocItem = (epub.Section(character.title, character.epubValue.file_name), character.childVolumeList)
+        elif character.isChapter:
+            tocItem = character.epubValue
+        else:
+            continue
+        if character.fatherValue in characterDict:
+            characterDict[character.fatherValue].childVolumeList.append(tocItem)
+        else:
+            resultList.append(tocItem)
     return resultList
 
 
@@ -1158,7 +3752,7 @@ read_me = """# ESJZone 的简中小说EPUB全部备份
 
 ### 手动更新使用方法
 1. 确保你拥有基本的python知识和命令行使用方法
-2. 命令行执行 `pip install beautifulsoup4 ebooklib opencc requests retrying`
+2. 命令行执行 `pip install beautifulsoup4 ebooklib opencc requests psutil`
 3. 打开py文件。更改位于开头参数
 - 繁简转换。
   - 默认为繁体转简体。如需要简体转繁体将`converter = opencc.OpenCC('t2s.json')`里的`t2s.json`改为`s2t.json`
@@ -1196,7 +3790,7 @@ if __name__ == "__main__":
         if parseBaseURL.netloc != paseBookURL.netloc or parseBaseURL.scheme != paseBookURL.scheme:
             print("请确保bookURL、base_url的协议与域名一致")
             sys.exit(1)
-    response = requests.get(base_url, headers=headers, timeout=(10, 25), allow_redirects=False)
+    response = getPageSession().get(base_url, headers=headers, timeout=(10, 25), allow_redirects=False)
     if response.status_code == 301 or response.status_code == 302:
         print("请修改base_url为重定向后的url: " + response.headers['Location'])
         print("请确保bookListURL或bookURL与base_url的域名一致")
@@ -1204,9 +3798,8 @@ if __name__ == "__main__":
         sys.exit(2)
     if isDownloadAll:
         read_me += "\n" + datetime.now().strftime("%Y/%m/%d") + "\n### 本项目更新书籍列表\n"
-        bookUrlList = []
         listSoup = getSoupData(bookListURL)
-        list_title = converter.convert(listSoup.find("h1").text) if listSoup.find("h1") else "列表"
+        list_title = convertText(listSoup.find("h1").text) if listSoup.find("h1") else "列表"
         print(list_title + "下载中")
         bookListNum = 0
         scripts = listSoup.find_all('script')
@@ -1217,29 +3810,11 @@ if __name__ == "__main__":
                     bookListNum = int(match.group(1))
                     break
         print("小说列表下载")
-        for i in range(1, bookListNum + 1):
-            bookListPageURL = bookListURL + f"{i}.html"
-            listSoup = getSoupData(bookListPageURL)
-            bookList = listSoup.find_all("div", {"class": "col-lg-3 col-md-4 col-sm-3 col-xs-6"})
-            for b in bookList:
-                bookUrlList.append(urlHandler(b.find("a").get("href")))
-            printProgressBar(i, bookListNum, prefix='进度:', length=20)
-        print("共" + str(len(bookUrlList)) + "本小说")
-        for index, bookURL in enumerate(bookUrlList):
-            name, author, bookDate = downloadOneBook(bookURL)
+        # 列表页并发获取，边获取边下载书籍，README仍按列表顺序输出
+        for name, author, bookDate in downloadAllBooks(bookListURL, bookListNum):
             if name is None:
                 continue
             read_me += f"- 《{name}》{author} 更新日期{bookDate}\n"
-            print("已下载" + str(bookUrlList.index(bookURL) + 1) + "本小说,进度"
-                  + str(int((bookUrlList.index(bookURL) + 1) * 100 / len(bookUrlList))) + "%")
-            if index % 100 == 0 and index != 0:
-                process = psutil.Process(os.getpid())
-                mem = process.memory_info()[0] / float(2 ** 20)
-                print(f"··当前内存使用{mem:.2f}MB")
-                gc.collect()
-                process = psutil.Process(os.getpid())
-                mem = process.memory_info()[0] / float(2 ** 20)
-                print(f"··回收后当前内存使用{mem:.2f}MB")
         with open("./README.md", "w", encoding="utf-8") as readmeFile:
             readmeFile.write(read_me)
     else:
@@ -1258,3 +3833,12 @@ if __name__ == "__main__":
         # 普通模式：下载全部章节
         else:
             downloadOneBook(bookURL)
+    shutdownConvertPool()
+    # 连接复用统计
+    print(pageConnectionStats.summary())
+    print(imgConnectionStats.summary())
+    print(retryPolicy.summary())
+    print(rateLimiter.summary())
+    print(runMetrics.summary())
+    if metricsDir:
+        print(f"性能统计已保存至: {runMetrics.export(metricsDir)}")
@@ -0,0 +1,121 @@
+# coding=utf-8
+"""测试与tools下的性能测试共用的本地站点，代替esjzone
+按路径返回书籍详情页、章节页面与图片，可设置每个请求的延迟，以及同时请求数上限(超过时返回429)"""
+import http.server
+import struct
+import threading
+import zlib
+from time import sleep
+
+
+def pngBytes(seed):
+    """2x2的png图片，seed不同内容(hash)不同"""
+    raw = b''.join(b'\x00' + struct.pack('>I', seed)[1:] * 2 for _ in range(2))
+
+    def chunk(chunkType, data):
+        return struct.pack('>I', len(data)) + chunkType + data + struct.pack('>I', zlib.crc32(chunkType + data) & 0xffffffff)
+
+    return b'\x89PNG\r\n\x1a\n' + chunk(b'IHDR', struct.pack('>IIBBBBB', 2, 2, 8, 2, 0, 0, 0)) + \
+        chunk(b'IDAT', zlib.compress(raw)) + chunk(b'IEND', b'')
+
+
+def detailPage(chapterNum):
+    """两卷，章节平分"""
+    linkList = ['<details><summary>第一卷 開始</summary>']
+    for index in range(chapterNum):
+        if index == chapterNum // 2:
+            linkList.append('</details><p>第二卷 後續</p>')
+        linkList.append(f'<a href="/forum/1/{index}.html"><p>第{index}話 標題</p></a>')
+    if chapterNum < 2:
+        linkList.append('</details>')
+    return f'''<html><body><h2>測試小說</h2>
+<ul class="list-unstyled mb-2 book-detail"><li>作者: <a href="/a">作者甲</a></li><li>更新日期: 2024-05-01</li></ul>
+<div class="product-gallery text-center mb-3"><img src="/img/cover.png"></div>
+<div class="description"><p>這是簡介 <a href="http://x.y/z">連結</a></p></div>
+<div id="chapterList">{''.join(linkList)}</div></body></html>'''
+
+
+def chapterPage(index, imgNum):
+    imgHtml = ''.join(f'<img src="/img/{index}_{imgIndex}.png">' for imgIndex in range(imgNum))
+    return f'''<html><body><div class="forum-content mt-3">
+<p>第{index}話 內容開始。這裡有繁體字。</p>
+<div><p>段落一</p>{imgHtml}<p>段落二 <a href="http://ex.com/{index}">鏈接</a></p></div>
+text node &amp; more
+<p>最後一段<br>換行後</p>
+</div></body></html>'''
+
+
+class LocalSiteHandler(http.server.BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def do_GET(self):
+        site = self.server
+        with site.lock:
+            site.inFlight += 1
+            site.peakInFlight = max(site.peakInFlight, site.inFlight)
+            site.hitDict[self.path] = site.hitDict.get(self.path, 0) + 1
+            isThrottled = 0 < site.maxConcurrency < site.inFlight
+            site.throttleCount += isThrottled
+        try:
+            sleep(site.delay)
+            if isThrottled:
+                self.reply(429, "text/plain", b"throttled", {"Retry-After": "0"})
+            else:
+                self.reply(*site.route(self.path))
+        finally:
+            with site.lock:
+                site.inFlight -= 1
+
+    def reply(self, status, contentType, body, headerDict=None):
+        self.send_response(status)
+        for name, value in (headerDict or {}).items():
+            self.send_header(name, value)
+        self.send_header("Content-Type", contentType)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class LocalSite(http.server.ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, delay=0.0, maxConcurrency=0, chapterNum=6, imgNum=1):
+        http.server.ThreadingHTTPServer.__init__(self, ("127.0.0.1", 0), LocalSiteHandler)
+        self.lock = threading.Lock()
+        self.delay = delay
+        # 0为不限制
+        self.maxConcurrency = maxConcurrency
+        self.chapterNum = chapterNum
+        # 每个章节的图片数
+        self.imgNum = imgNum
+        self.inFlight = 0
+        self.peakInFlight = 0
+        self.throttleCount = 0
+        self.hitDict = {}
+
+    @property
+    def baseUrl(self):
+        return f"http://127.0.0.1:{self.server_port}/"
+
+    def route(self, requestPath):
+        """返回(状态码, Content-Type, 内容)"""
+        html = "text/html; charset=utf-8"
+        name = requestPath.rsplit('/', 1)[-1].split('.')[0]
+        if requestPath.startswith('/detail/'):
+            return 200, html, detailPage(self.chapterNum).encode()
+        if requestPath.startswith('/forum/1/') and name.isdigit():
+            return 200, html, chapterPage(int(name), self.imgNum).encode()
+        if requestPath.startswith('/img/'):
+            return 200, "image/png", pngBytes(zlib.crc32(name.encode()))
+        return 200, html, b"<html><h2>ok</h2></html>"
+
+    def start(self):
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
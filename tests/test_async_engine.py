@@ -0,0 +1,55 @@
+# coding=utf-8
+"""async引擎：同一本书的epub/txt与多线程引擎的结果相同"""
+import re
+import zipfile
+
+import pytest
+
+import esj
+from localsite import LocalSite
+
+bookFileName = "《测试小说》作者甲"
+
+
+@pytest.fixture
+def bookSite(monkeypatch):
+    site = LocalSite(delay=0.01, chapterNum=8, imgNum=2).start()
+    monkeypatch.setenv("NO_PROXY", "127.0.0.1")
+    monkeypatch.setattr(esj, "base_url", site.baseUrl)
+    # 每次运行都实际下载，不使用各种持久缓存
+    for name, value in [("imgCacheMaxMB", 0), ("pageCacheMaxMB", 0), ("imgDiskCache", None), ("pageCache", None),
+                        ("bookManifest", None), ("isAdaptiveRateLimit", False), ("requestSemaphore", None)]:
+        monkeypatch.setattr(esj, name, value)
+    yield site
+    site.stop()
+
+
+def downloadBook(monkeypatch, site, workDir, engine):
+    workDir.mkdir()
+    monkeypatch.chdir(workDir)
+    monkeypatch.setattr(esj, "downloadEngine", engine)
+    esj.downloadOneBook(site.baseUrl + "detail/1.html")
+    txtContent = (workDir / "txtBooks_esjzone" / f"{bookFileName}.txt").read_bytes()
+    with zipfile.ZipFile(workDir / "epubBooks_esjzone" / f"{bookFileName}.epub") as epubFile:
+        epubDict = {name: normalizeGenerated(epubFile.read(name)) for name in epubFile.namelist()}
+    return txtContent, epubDict
+
+
+def normalizeGenerated(content):
+    """去掉每次生成都不同的uuid与修改时间"""
+    content = re.sub(rb'[0-9a-f]{8}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{12}', b'', content)
+    return re.sub(rb'<meta property="dcterms:modified">[^<]*', b'', content)
+
+
+def testAsyncMatchesThread(monkeypatch, tmp_path, bookSite):
+    threadTxt, threadEpub = downloadBook(monkeypatch, bookSite, tmp_path / "thread", "thread")
+    asyncTxt, asyncEpub = downloadBook(monkeypatch, bookSite, tmp_path / "async", "async")
+    assert asyncTxt == threadTxt
+    assert sorted(asyncEpub) == sorted(threadEpub)
+    assert sum(name.endswith(".png") for name in threadEpub) == 8 * 2 + 1
+    for name in threadEpub:
+        if name.endswith(".opf"):
+            # 图片按下载完成的顺序登记，manifest中的顺序不同
+            assert sorted(asyncEpub[name].splitlines()) == sorted(threadEpub[name].splitlines())
+        else:
+            assert asyncEpub[name] == threadEpub[name], name
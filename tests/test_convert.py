@@ -0,0 +1,28 @@
+# coding=utf-8
+"""批量繁简转换：拼接转换再拆分的结果与逐条converter.convert相同，含分隔符、空文字与重复文字"""
+import pytest
+
+import esj
+
+# 不含分隔符时整批一次转换，含分隔符时改为逐条转换
+plainTextList = ["第一卷 開始", "", "這裡有繁體字。", "「對話」與標點，測試！", "", "第一卷 開始", "多行\n文字\n\n後續",
+                 "英文 English 123", "後台 發展 頭髮", "長文字" + "學習與實踐。" * 40, "  前後空白  "]
+separatorTextList = plainTextList + ["含\ue000分隔符的文字", "\ue000", "前\ue000\ue000後"]
+
+
+@pytest.mark.parametrize("textList", [plainTextList, separatorTextList], ids=["plain", "separator"])
+@pytest.mark.parametrize("variant", [None, "s2t", "t2s", "raw"])
+def testBatchMatchesConvert(monkeypatch, variant, textList):
+    monkeypatch.setattr(esj, "convertCacheDict", {})
+    variantConverter = esj.getVariantConverter(variant)
+    expected = [text if variantConverter is None else variantConverter.convert(text) for text in textList]
+    assert esj.convertBatch(textList, variant) == expected
+    # 第二次短文字来自缓存
+    assert esj.convertBatch(textList, variant) == expected
+    assert [esj.convertText(text, variant) for text in textList] == expected
+
+
+@pytest.mark.parametrize("batchList", [[""], ["", "", ""], ["\ue000繁體"], ["繁體\ue000", "", "體"], []])
+def testEdgeCases(monkeypatch, batchList):
+    monkeypatch.setattr(esj, "convertCacheDict", {})
+    assert esj.convertBatch(batchList) == [esj.converter.convert(text) for text in batchList]
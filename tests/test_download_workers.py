@@ -0,0 +1,85 @@
+# coding=utf-8
+"""多线程引擎：章节交给进程池解析时下载线程不等待解析，继续下载其余章节；线程的忙碌/空闲每本书只记一行"""
+import pathlib
+import threading
+from concurrent.futures import Future
+from time import sleep
+
+import esj
+
+chapterContent = (pathlib.Path(__file__).parent / "pages" / "paragraphs.html").read_bytes()
+
+
+class GatedPool(object):
+    """gate打开前提交的解析都不完成"""
+
+    def __init__(self):
+        self.gate = threading.Event()
+
+    def submit(self, fn, *args):
+        future = Future()
+
+        def run():
+            self.gate.wait()
+            future.set_result(fn(*args))
+
+        threading.Thread(target=run, daemon=True).start()
+        return future
+
+
+def chapterNodeList(chapterNum):
+    nodeList = []
+    for value in range(chapterNum):
+        node = esj.novelCharacterListNode()
+        node.isChapter = True
+        node.value = value
+        node.title = f"第{value + 1}话"
+        node.url = f"https://www.esjzone.cc/forum/1/{value + 1}.html"
+        nodeList.append(node)
+    return nodeList
+
+
+def testWorkerDoesNotWaitForParse(monkeypatch):
+    fetchedList = []
+    pool = GatedPool()
+
+    def getChapterContent(url):
+        fetchedList.append(url)
+        return chapterContent, None
+
+    monkeypatch.setattr(esj, "getChapterContent", getChapterContent)
+    monkeypatch.setattr(esj, "storeChapterContent", lambda *args: None)
+    monkeypatch.setattr(esj, "getConvertPool", lambda: pool)
+    monkeypatch.setattr(esj, "isAdaptiveRateLimit", False)
+    monkeypatch.setattr(esj, "threadNum", 1)
+    nodeList = chapterNodeList(4)
+    doneList = []
+    runner = threading.Thread(target=esj.runDownloadWorkers,
+                              args=(nodeList, esj.ImgThreadSafeDict(), doneList.append))
+    runner.start()
+    for _ in range(100):
+        if len(fetchedList) == len(nodeList):
+            break
+        sleep(0.05)
+    # 唯一的下载线程在解析完成前已下载全部章节
+    assert len(fetchedList) == len(nodeList)
+    assert doneList == []
+    pool.gate.set()
+    runner.join(10)
+    assert not runner.is_alive()
+    assert sorted(node.value for node in doneList) == [0, 1, 2, 3]
+    assert all(node.isDone and "第一段正文" in node.content for node in nodeList)
+
+
+def testWorkerStatsLoggedOnce(monkeypatch):
+    messageList = []
+    monkeypatch.setattr(esj, "getChapterContent", lambda url: (chapterContent, None))
+    monkeypatch.setattr(esj, "storeChapterContent", lambda *args: None)
+    monkeypatch.setattr(esj, "getConvertPool", lambda: None)
+    monkeypatch.setattr(esj, "isAdaptiveRateLimit", False)
+    monkeypatch.setattr(esj, "threadNum", 4)
+    monkeypatch.setattr(esj, "log_message", lambda message, *args, **kwargs: messageList.append(message))
+    esj.runDownloadWorkers(chapterNodeList(6), esj.ImgThreadSafeDict())
+    statList = [message for message in messageList if "平均空闲" in message]
+    assert len(statList) == 1
+    assert statList[0].startswith("4个线程处理 6 项")
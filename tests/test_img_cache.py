@@ -0,0 +1,73 @@
+# coding=utf-8
+"""图片缓存：命中后文件丢失时删除索引，重新下载而不是让下载线程异常退出；写入缓存的内容与下载内容相同"""
+import os
+from io import BytesIO
+
+import esj
+
+imgUrl = "https://www.esjzone.cc/uploads/1.jpg"
+
+
+def useImgCache(monkeypatch, tmp_path):
+    imgCache = esj.ImgDiskCache(str(tmp_path), 1024 * 1024)
+    monkeypatch.setattr(esj, "imgCacheMaxMB", 1)
+    monkeypatch.setattr(esj, "imgDiskCache", imgCache)
+    imgCache.put(imgUrl, (BytesIO(b"jpeg"), ".jpg", "ab" * 16, "image/jpeg"), '"v1"', None)
+    return imgCache
+
+
+def testReadImgCache(monkeypatch, tmp_path):
+    useImgCache(monkeypatch, tmp_path)
+    imgByte, imgType, imgHash, imgContentType = esj.readImgCache(imgUrl, esj.lookupImgCache(imgUrl))
+    assert (imgByte.getvalue(), imgType, imgContentType) == (b"jpeg", ".jpg", "image/jpeg")
+
+
+def testMissingBlobIsForgotten(monkeypatch, tmp_path):
+    imgCache = useImgCache(monkeypatch, tmp_path)
+    cachedEntry = esj.lookupImgCache(imgUrl)
+    os.remove(cachedEntry.blobPath)
+    assert esj.readImgCache(imgUrl, cachedEntry) is None
+    assert esj.lookupImgCache(imgUrl) is None
+    assert imgCache.totalBytes == 0
+
+
+def testMissingBlobAfter304IsDownloadedAgain(monkeypatch, tmp_path):
+    useImgCache(monkeypatch, tmp_path)
+    cachedEntry = esj.lookupImgCache(imgUrl)
+    os.remove(cachedEntry.blobPath)
+    assert esj.resolveImgResponse(imgUrl, 304, {}, b"", cachedEntry) is None
+    assert esj.conditionalImgHeaders(esj.lookupImgCache(imgUrl)) is esj.headers_img
+
+
+class FakeImgResponse(object):
+    def __init__(self, statusCode, content=b""):
+        self.status_code = statusCode
+        self.headers = {"Content-Type": "image/jpeg", "ETag": '"v2"'}
+        self.content = content
+
+    def raise_for_status(self):
+        pass
+
+    def close(self):
+        pass
+
+
+def testGetImgDataRetriesWithoutConditions(monkeypatch, tmp_path):
+    useImgCache(monkeypatch, tmp_path)
+    monkeypatch.setattr(esj, "isImgCacheRevalidate", True)
+    requestHeaderList = []
+
+    def retryGet(url, requestHeaders, *args):
+        requestHeaderList.append(requestHeaders)
+        if len(requestHeaderList) == 1:
+            # 查到索引后、服务器返回304前缓存文件被删除
+            os.remove(esj.imgDiskCache.blobPath("ab" * 16))
+            return FakeImgResponse(304)
+        return FakeImgResponse(200, b"new jpeg")
+
+    monkeypatch.setattr(esj, "retryGet", retryGet)
+    imgByte, imgType, _, imgContentType = esj.getImgData(imgUrl)
+    assert (imgByte.getvalue(), imgType, imgContentType) == (b"new jpeg", ".jpg", "image/jpeg")
+    assert requestHeaderList[0].get("If-None-Match") == '"v1"'
+    assert requestHeaderList[1:] == [esj.headers_img]
+    assert esj.readImgCache(imgUrl, esj.lookupImgCache(imgUrl))[0].getvalue() == b"new jpeg"
@@ -0,0 +1,52 @@
+# coding=utf-8
+"""图片下载：不同url在锁外并发下载，同一url只下载一次"""
+import threading
+from time import perf_counter
+
+import pytest
+
+import esj
+from localsite import LocalSite
+
+
+@pytest.fixture
+def imgSite(monkeypatch):
+    site = LocalSite(delay=0.2).start()
+    monkeypatch.setenv("NO_PROXY", "127.0.0.1")
+    monkeypatch.setattr(esj, "imgCacheMaxMB", 0)
+    monkeypatch.setattr(esj, "isAdaptiveRateLimit", False)
+    monkeypatch.setattr(esj, "requestSemaphore", None)
+    yield site
+    site.stop()
+
+
+def setConcurrently(imgDict, urlList):
+    resultList = [None] * len(urlList)
+
+    def worker(index):
+        resultList[index] = imgDict.set(urlList[index])
+
+    threadList = [threading.Thread(target=worker, args=(index,)) for index in range(len(urlList))]
+    for thread in threadList:
+        thread.start()
+    for thread in threadList:
+        thread.join()
+    return resultList
+
+
+def testDifferentUrlsDownloadConcurrently(imgSite):
+    urlList = [imgSite.baseUrl + f"img/{index}.png" for index in range(8)]
+    startTime = perf_counter()
+    resultList = setConcurrently(esj.ImgThreadSafeDict(), urlList)
+    # 串行下载需要8*0.2秒
+    assert perf_counter() - startTime < 0.8
+    assert imgSite.peakInFlight >= 4
+    assert len(set(resultList)) == 8
+    assert all(result.startswith("<img src='Image_") for result in resultList)
+
+
+def testSameUrlDownloadedOnce(imgSite):
+    url = imgSite.baseUrl + "img/same.png"
+    resultList = setConcurrently(esj.ImgThreadSafeDict(), [url] * 8)
+    assert imgSite.hitDict["/img/same.png"] == 1
+    assert len(set(resultList)) == 1
@@ -0,0 +1,69 @@
+# coding=utf-8
+"""增量更新：按章节url对应已有章节，占位章节不沿用"""
+from ebooklib import epub
+
+import esj
+
+# (文件名, 标题, 章节url, 正文)
+existChapterList = [("novel_1.html", "第1话", "https://www.esjzone.cc/forum/1/1.html", "<p>正文1</p>"),
+                    ("novel_2.html", "第2话", "https://www.esjzone.cc/forum/1/2.html", "<p>本章节需要密码，已跳过</p>"),
+                    ("novel_3.html", "第3话", "https://www.esjzone.cc/forum/1/3.html", "<p>【空】</p>")]
+
+
+def writeBook(tmp_path):
+    epubPath = str(tmp_path / "book.epub")
+    txtPath = str(tmp_path / "book.txt")
+    book = epub.EpubBook()
+    book.set_identifier("test")
+    book.set_title("测试")
+    book.set_language("zh")
+    volume = epub.EpubHtml(title="卷一", file_name="volume_0.html", uid="volume0", lang="zh")
+    volume.set_content("<h1>卷一</h1>")
+    book.add_item(volume)
+    book.spine.append(volume)
+    txtWriter = esj.StreamingTxtWriter(txtPath, "测试\n")
+    txtWriter.write(0, "卷一\n", "volume_0.html")
+    for value, (fileName, title, url, content) in enumerate(existChapterList, 1):
+        item = epub.EpubHtml(title=title, file_name=fileName, uid=f"novel{value}", lang="zh")
+        item.set_content(f"<h1>{title}</h1>{content}")
+        book.add_item(item)
+        book.spine.append(item)
+        txtWriter.write(value, f"{title}\n{content}\n", fileName, url)
+    txtWriter.finish()
+    book.add_item(epub.EpubNcx())
+    book.add_item(epub.EpubNav())
+    epub.write_epub(epubPath, book)
+    return epub.read_epub(epubPath), txtPath
+
+
+def chapterNode(title, url):
+    node = esj.novelCharacterListNode()
+    node.isChapter = True
+    node.title = title
+    node.url = url
+    return node
+
+
+def testReuseMatchesByUrl(tmp_path):
+    existBook, txtPath = writeBook(tmp_path)
+    # 标题改变、顺序变化仍按url对应，新章节没有已有内容
+    nodeList = [chapterNode("新章节", "https://www.esjzone.cc/forum/1/9.html"),
+                chapterNode("第一话(修订)", "https://www.esjzone.cc/forum/1/1.html")]
+    esj.reuseExistingChapters(nodeList, existBook, txtPath)
+    assert nodeList[0].existingChapter is None
+    epubContent, txtValue, imgItemList = nodeList[1].existingChapter
+    assert "<p>正文1</p>".encode("utf-8") in epubContent
+    assert txtValue == "第1话\n<p>正文1</p>\n"
+    # 只有章节页面未变化时才沿用
+    assert not nodeList[1].isDone
+    assert not nodeList[1].isUnchanged(b"<html></html>", {"ETag": "x"})
+    assert nodeList[1].isUnchanged(b"<html></html>", None)
+
+
+def testPlaceholderChaptersAreNotReused(tmp_path):
+    existBook, txtPath = writeBook(tmp_path)
+    nodeList = [chapterNode(title, url) for _, title, url, _ in existChapterList]
+    esj.reuseExistingChapters(nodeList, existBook, txtPath)
+    assert nodeList[0].existingChapter is not None
+    assert nodeList[1].existingChapter is None
+    assert nodeList[2].existingChapter is None
@@ -0,0 +1,142 @@
+# coding=utf-8
+"""章节选择模式合并到已有epub/txt：novel_N.html的N为包含卷在内的节点序号"""
+import re
+import zipfile
+
+from ebooklib import epub
+
+import esj
+
+# [卷一, 第1话, 第2话, 卷二, 第3话]，节点序号依次为0-4
+bookNodeList = [(False, "卷一"), (True, "第1话"), (True, "第2话"), (False, "卷二"), (True, "第3话")]
+
+
+def fileNameOf(value, isChapter):
+    return f"novel_{value}.html" if isChapter else f"volume_{value}.html"
+
+
+def chapterNode(value, title, text):
+    node = esj.novelCharacterListNode()
+    node.isChapter = True
+    node.value = value
+    node.title = title
+    node.txtValue = f"{title}\n{text}\n"
+    node.epubValue.title = title
+    node.epubValue.file_name = fileNameOf(value, True)
+    node.epubValue.set_content(f"<h1>{title}</h1><p>{text}</p>")
+    # 生成html需要book中的模板
+    node.epubValue.book = epub.EpubBook()
+    return node
+
+
+def writeEpub(epubPath):
+    book = epub.EpubBook()
+    book.set_identifier("test")
+    book.set_title("测试")
+    book.set_language("zh")
+    for value, (isChapter, title) in enumerate(bookNodeList):
+        item = epub.EpubHtml(title=title, file_name=fileNameOf(value, isChapter), uid=f"item{value}", lang="zh")
+        item.set_content(f"<h1>{title}</h1><p>旧内容{title}</p>")
+        book.add_item(item)
+        book.toc.append(item)
+        book.spine.append(item)
+    book.add_item(epub.EpubNcx())
+    book.add_item(epub.EpubNav())
+    epub.write_epub(epubPath, book)
+
+
+def spineHrefList(epubPath):
+    with zipfile.ZipFile(epubPath) as epubZip:
+        opf = epubZip.read("EPUB/content.opf").decode("utf-8")
+    hrefDict = dict(re.findall(r'<item[^>]*?href="([^"]+)"[^>]*?id="([^"]+)"', opf))
+    idHrefDict = {itemId: href for href, itemId in hrefDict.items()}
+    return [idHrefDict[idref] for idref in re.findall(r'<itemref[^>]*idref="([^"]+)"', opf)]
+
+
+def selectedChapters(selectedIndices, textDict):
+    """按章节选择模式筛选并重新编号，返回合并用的[(原节点序号, 章节节点)]，章节内容为textDict中的新内容"""
+    novelCharacterList = []
+    for value, (isChapter, title) in enumerate(bookNodeList):
+        node = chapterNode(value, title, textDict.get(title, "")) if isChapter else esj.novelCharacterListNode()
+        node.isVolume = not isChapter
+        node.value = value
+        node.title = title
+        novelCharacterList.append(node)
+    downloadList = esj.selectDownloadList(novelCharacterList, selectedIndices)
+    return esj.mergePairList(downloadList)
+
+
+def testSelectKeepsNodeValue():
+    newChapters = selectedChapters([2], {"第3话": "新内容3"})
+    assert [(value, chapter.title, chapter.value) for value, chapter in newChapters] == [(4, "第3话", 2)]
+
+
+def testPatchEpubReplacesByNodeValue(tmp_path):
+    epubPath = str(tmp_path / "book.epub")
+    writeEpub(epubPath)
+    newChapters = selectedChapters([2], {"第3话": "新内容3"})
+    updatedCount, addedCount, totalCount, newImageCount = esj.patchEpubChapters(epubPath, newChapters,
+                                                                                esj.ImgThreadSafeDict())
+    assert (updatedCount, addedCount, totalCount) == (1, 0, 3)
+    with zipfile.ZipFile(epubPath) as epubZip:
+        assert "旧内容第2话" in epubZip.read("EPUB/novel_2.html").decode("utf-8")
+        assert "新内容3" in epubZip.read("EPUB/novel_4.html").decode("utf-8")
+
+
+def testPatchEpubInsertsAfterPreviousNode(tmp_path):
+    epubPath = str(tmp_path / "book.epub")
+    writeEpub(epubPath)
+    # 原书卷一只有第1话，新增的节点2应位于novel_1之后、卷二之前
+    with zipfile.ZipFile(epubPath) as sourceZip, zipfile.ZipFile(str(tmp_path / "cut.epub"), "w") as targetZip:
+        for info in sourceZip.infolist():
+            content = sourceZip.read(info.filename)
+            if info.filename == "EPUB/novel_2.html":
+                continue
+            if info.filename.endswith((".opf", ".ncx", "nav.xhtml")):
+                content = re.sub(rb'<(item|itemref|navPoint|li)\b[^>]*?(novel_2|item2)[^>]*?/>', b"", content)
+                content = re.sub(rb'<navPoint[^>]*>(?:(?!</navPoint>).)*novel_2\.html.*?</navPoint>', b"", content,
+                                 flags=re.S)
+                content = re.sub(rb'<li>(?:(?!</li>).)*novel_2\.html.*?</li>', b"", content, flags=re.S)
+            targetZip.writestr(info, content)
+    epubPath = str(tmp_path / "cut.epub")
+    assert "novel_2.html" not in spineHrefList(epubPath)
+    esj.patchEpubChapters(epubPath, selectedChapters([1], {"第2话": "新内容2"}), esj.ImgThreadSafeDict())
+    assert spineHrefList(epubPath)[-5:] == ["volume_0.html", "novel_1.html", "novel_2.html", "volume_3.html",
+                                            "novel_4.html"]
+
+
+def writeTxt(txtPath):
+    txtWriter = esj.StreamingTxtWriter(txtPath, "测试\n")
+    for value, (isChapter, title) in enumerate(bookNodeList):
+        txtWriter.write(value, f"{title}\n旧内容{title}\n" if isChapter else f"{title}\n", fileNameOf(value, isChapter))
+    txtWriter.finish()
+
+
+def readTxt(txtPath):
+    with open(txtPath, "rb") as txtFile:
+        return esj.decodeTxt(txtFile.read())
+
+
+def testMergeTxtReplacesByNodeValue(tmp_path):
+    txtPath = str(tmp_path / "book.txt")
+    writeTxt(txtPath)
+    assert esj.mergeTxtChapters(txtPath, selectedChapters([2], {"第3话": "新内容3"})) == (1, 0)
+    text = readTxt(txtPath)
+    assert text == "测试\n卷一\n第1话\n旧内容第1话\n第2话\n旧内容第2话\n卷二\n第3话\n新内容3\n"
+    assert esj.readTxtIndex(txtPath) is not None
+
+
+def testMergeTxtInsertsAfterPreviousNode(tmp_path):
+    txtPath = str(tmp_path / "book.txt")
+    writeTxt(txtPath)
+    # 去掉节点2后重新写入，新增的第2话应回到第1话之后、卷二之前
+    entryList = [entry for entry in esj.readTxtIndex(txtPath) if entry["name"] != "novel_2.html"]
+    cutPath = str(tmp_path / "cut.txt")
+    txtWriter = esj.StreamingTxtWriter(cutPath, "测试\n")
+    for value, entry in enumerate(entryList[1:]):
+        with open(txtPath, "rb") as txtFile:
+            txtFile.seek(entry["start"])
+            txtWriter.write(value, esj.decodeTxt(txtFile.read(entry["end"] - entry["start"])), entry["name"])
+    txtWriter.finish()
+    assert esj.mergeTxtChapters(cutPath, selectedChapters([1], {"第2话": "新内容2"})) == (0, 1)
+    assert readTxt(cutPath) == "测试\n卷一\n第1话\n旧内容第1话\n第2话\n新内容2\n卷二\n第3话\n旧内容第3话\n"
@@ -0,0 +1,26 @@
+# coding=utf-8
+"""输出文件：出错时abort关闭文件并删除.part临时文件，已完成的文件不受影响"""
+import esj
+
+
+def openOutput(tmp_path):
+    output = esj.BookOutput(None, 0, "测试", "作者", "2024-01-01", "https://www.esjzone.cc/detail/1.html")
+    output.openWriters(str(tmp_path / "book.epub"), str(tmp_path / "book.txt"))
+    return output
+
+
+def testAbortRemovesPartFiles(tmp_path):
+    output = openOutput(tmp_path)
+    output.txtWriter.write(0, "简介\n")
+    output.abort()
+    output.abort()
+    assert output.txtWriter.txtFile.closed
+    assert sorted(tmp_path.iterdir()) == []
+
+
+def testAbortAfterFinishKeepsFiles(tmp_path):
+    output = openOutput(tmp_path)
+    output.txtWriter.finish()
+    output.abort()
+    assert (tmp_path / "book.txt").exists()
+    assert not (tmp_path / "book.epub.part").exists()
@@ -0,0 +1,31 @@
+# coding=utf-8
+"""解析器一致性：tests/pages下保存的章节页面，使用lxml并开启比对时结果须与html.parser相同"""
+import pathlib
+
+import pytest
+
+import esj
+
+pagePathList = sorted((pathlib.Path(__file__).parent / "pages").glob("*.html"))
+
+
+def chapterResult(monkeypatch, parser, isParityCheck, content):
+    monkeypatch.setattr(esj, "htmlParser", parser)
+    monkeypatch.setattr(esj, "isParserParityCheck", isParityCheck)
+    return esj.processChapterPage(content, [None])
+
+
+@pytest.mark.parametrize("pagePath", pagePathList, ids=lambda path: path.stem)
+def testChapterPageMatchesHtmlParser(monkeypatch, pagePath):
+    content = pagePath.read_bytes()
+    expected = chapterResult(monkeypatch, "html.parser", False, content)
+    assert expected is not None
+    assert chapterResult(monkeypatch, "lxml", True, content) == expected
+
+
+def testMalformedPageFallsBackToHtmlParser(monkeypatch):
+    content = (pathlib.Path(__file__).parent / "pages" / "malformed_nesting.html").read_bytes()
+    expected = chapterResult(monkeypatch, "html.parser", False, content)
+    # 不比对时lxml会把<p>中的<div>移出段落，结果与html.parser不同
+    assert chapterResult(monkeypatch, "lxml", False, content) != expected
+    assert chapterResult(monkeypatch, "lxml", True, content) == expected
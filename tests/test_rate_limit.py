@@ -0,0 +1,124 @@
+# coding=utf-8
+"""自适应限速：本地服务器同时请求数超过上限时返回429，限速应减半并最终全部下载成功
+全局请求名额：async引擎等待中被取消时不占用名额"""
+import asyncio
+import threading
+
+import pytest
+
+import esj
+from localsite import LocalSite
+
+
+@pytest.fixture
+def throttleServer(monkeypatch):
+    server = LocalSite(delay=0.2, maxConcurrency=3).start()
+    monkeypatch.setenv("NO_PROXY", "127.0.0.1")
+    monkeypatch.setattr(esj, "rateLimiter", esj.AdaptiveRateLimiter())
+    monkeypatch.setattr(esj, "retryPolicy", esj.RetryPolicy())
+    monkeypatch.setattr(esj, "isAdaptiveRateLimit", True)
+    monkeypatch.setattr(esj, "threadNum", 16)
+    monkeypatch.setattr(esj, "adaptiveMaxConcurrency", 16)
+    monkeypatch.setattr(esj, "adaptiveDecreaseInterval", 0.2)
+    monkeypatch.setattr(esj, "retryMaxAttempts", 10)
+    monkeypatch.setattr(esj, "retryCircuitThreshold", 1000)
+    monkeypatch.setattr(esj, "requestSemaphore", None)
+    yield server
+    server.stop()
+
+
+def testThrottledHostBacksOff(throttleServer):
+    url = f"http://127.0.0.1:{throttleServer.server_port}/"
+    statusList = []
+
+    def worker():
+        for index in range(3):
+            statusList.append(esj.retryGet(url + str(index), esj.headers, (5, 5)).status_code)
+
+    workerList = [threading.Thread(target=worker) for _ in range(16)]
+    for thread in workerList:
+        thread.start()
+    for thread in workerList:
+        thread.join()
+    controller = esj.rateLimiter.controllerOf(f"127.0.0.1:{throttleServer.server_port}")
+    assert statusList == [200] * 48
+    assert throttleServer.throttleCount > 0
+    assert controller.throttleCount > 0
+    assert not controller.isSlowStart
+    assert controller.concurrencyLimit < 16
+
+
+def testDefaultsKeepThreadNum():
+    assert not esj.isAdaptiveRateLimit
+    assert esj.downloadThreadNum() == esj.threadNum
+    assert esj.adaptiveMaxConcurrency == esj.threadNum
+
+
+def testEnabledLimiterNeverExceedsThreadNum(throttleServer, monkeypatch):
+    # 开启自适应限速但使用默认上限时，同时请求数不超过threadNum
+    monkeypatch.setattr(esj, "threadNum", 4)
+    monkeypatch.setattr(esj, "adaptiveMaxConcurrency", 4)
+    throttleServer.maxConcurrency = 100
+    url = f"http://127.0.0.1:{throttleServer.server_port}/"
+    statusList = []
+
+    def worker():
+        for index in range(4):
+            statusList.append(esj.retryGet(url + str(index), esj.headers, (5, 5)).status_code)
+
+    workerList = [threading.Thread(target=worker) for _ in range(esj.downloadThreadNum() * 2)]
+    for thread in workerList:
+        thread.start()
+    for thread in workerList:
+        thread.join()
+    assert statusList == [200] * len(workerList) * 4
+    assert throttleServer.peakInFlight <= 4
+
+
+def testLatencyExcludesGlobalSlotWait(throttleServer, monkeypatch):
+    url = f"http://127.0.0.1:{throttleServer.server_port}/"
+    latencyList = []
+    controller = esj.rateLimiter.controllerOf(f"127.0.0.1:{throttleServer.server_port}")
+    originalRelease = controller.release
+
+    def release(latency, outcome, reason=""):
+        latencyList.append(latency)
+        originalRelease(latency, outcome, reason)
+
+    monkeypatch.setattr(controller, "release", release)
+    semaphore = threading.BoundedSemaphore(1)
+    monkeypatch.setattr(esj, "requestSemaphore", semaphore)
+    # 另一本书占着唯一的全局名额0.5秒
+    semaphore.acquire()
+    threading.Timer(0.5, semaphore.release).start()
+    assert esj.retryGet(url, esj.headers, (5, 5)).status_code == 200
+    assert latencyList[0] < 0.4
+
+
+def testAsyncRequestSlotCancelDoesNotLeak(monkeypatch):
+    semaphore = threading.BoundedSemaphore(1)
+    monkeypatch.setattr(esj, "requestSemaphore", semaphore)
+
+    async def waitSlot():
+        async with esj.RequestSlot():
+            await asyncio.sleep(10)
+
+    async def main():
+        # 名额被其他书籍占用时等待的请求被取消
+        semaphore.acquire()
+        waitingTask = asyncio.ensure_future(waitSlot())
+        await asyncio.sleep(0.05)
+        waitingTask.cancel()
+        semaphore.release()
+        with pytest.raises(asyncio.CancelledError):
+            await waitingTask
+        # 取得名额后被取消
+        holdingTask = asyncio.ensure_future(waitSlot())
+        await asyncio.sleep(0.05)
+        assert not semaphore.acquire(blocking=False)
+        holdingTask.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await holdingTask
+
+    asyncio.run(main())
+    assert semaphore.acquire(blocking=False)
@@ -0,0 +1,33 @@
+# coding=utf-8
+"""目录生成：一次遍历的listAnalysisToc与原先逐层扫描的结果相同，空卷过滤同理"""
+import pytest
+
+import esj
+from tocsample import buildNodeList, chapterListHtml, legacyFilterEmptyVolumes, legacyListAnalysisToc, tocShape
+
+
+@pytest.mark.parametrize("seed", range(30))
+def testTocMatchesLegacy(seed):
+    html = chapterListHtml(60, seed)
+    # 卷的子目录列表会被追加，两种实现各用一份节点
+    legacyNodeList, depth = buildNodeList(html)
+    currentNodeList, _ = buildNodeList(html)
+    assert tocShape(esj.listAnalysisToc(currentNodeList)) == tocShape(legacyListAnalysisToc(legacyNodeList, depth))
+
+
+@pytest.mark.parametrize("seed", range(10))
+@pytest.mark.parametrize("selectChapterMode", [False, True])
+def testFilterMatchesLegacy(seed, selectChapterMode):
+    nodeList, _ = buildNodeList(chapterListHtml(60, seed))
+    downloadList = esj.selectDownloadList(nodeList, list(range(0, 60, 7)))
+    assert esj.filterEmptyVolumes(downloadList, selectChapterMode) == \
+        legacyFilterEmptyVolumes(downloadList, selectChapterMode)
+
+
+def testSelectedChapterWithoutVolume():
+    # 所属卷被过滤后章节放在最外层
+    nodeList, _ = buildNodeList('<div><details><summary>卷</summary><details><summary>子卷</summary>'
+                                '<a href="/forum/1/0.html"><p>第0話</p></a></details></details></div>')
+    finalList = esj.filterEmptyVolumes(esj.selectDownloadList(nodeList, [0]), True)
+    assert [node.title for node in finalList] == ["子卷", "第0話"]
+    assert tocShape(esj.listAnalysisToc(finalList)) == [("子卷", "novel_1.html", ["novel_2.html"])]
@@ -0,0 +1,29 @@
+# coding=utf-8
+"""章节正文转换：tests/golden/transform_corpus.json为原先htmlSimplified的输出，由tools/transform_bench.py golden生成"""
+import hashlib
+import json
+import pathlib
+from io import BytesIO
+
+import pytest
+from bs4 import BeautifulSoup
+
+import esj
+
+caseList = json.loads((pathlib.Path(__file__).parent / "golden" / "transform_corpus.json").read_text(encoding="utf-8"))
+
+
+def fakeImgData(url):
+    if 'bad' in url:
+        return None, None, None, None
+    return BytesIO(b'img'), '.png', hashlib.md5(url.encode()).hexdigest()[:8], 'image/png'
+
+
+@pytest.mark.parametrize("case", caseList, ids=range(len(caseList)))
+def testTransformMatchesGolden(monkeypatch, case):
+    monkeypatch.setattr(esj, "getImgData", fakeImgData)
+    soup = BeautifulSoup(case["input"], 'html.parser')
+    txtPieceList = []
+    htmlResult = esj.htmlSimplified(soup.find('div').contents, esj.ImgThreadSafeDict(), txtPieceList)
+    assert htmlResult == case["html"]
+    assert esj.simplifiedTxt(txtPieceList) == case["txt"]
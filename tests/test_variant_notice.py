@@ -0,0 +1,49 @@
+# coding=utf-8
+"""额外文字版本：需要密码、内容为空、下载失败的提示与正文一样按各版本转换"""
+import pytest
+
+import esj
+
+
+def chapterNode():
+    node = esj.novelCharacterListNode()
+    node.isChapter = True
+    node.value = 1
+    node.title = "第1话"
+    node.url = "https://www.esjzone.cc/forum/1/1.html"
+    node.addVariantNode("raw", "第1話")
+    node.addVariantNode("s2t", "第1話")
+    return node
+
+
+@pytest.mark.parametrize("pageResult, simplifiedNotice, traditionalNotice", [
+    (False, "本章节需要密码，已跳过", "本章節需要密碼，已跳過"),
+    ([[], [], []], "【空】", "【空】"),
+])
+def testNoticeFollowsVariant(pageResult, simplifiedNotice, traditionalNotice):
+    node = chapterNode()
+    node.buildCharacter(pageResult, esj.ImgThreadSafeDict())
+    rawNode, s2tNode = node.variantNodeList
+    assert node.content == f"<p>{simplifiedNotice}</p>"
+    assert node.txtValue == f"第1话\n{simplifiedNotice}\n"
+    for variantNode in (rawNode, s2tNode):
+        assert variantNode.content == f"<p>{traditionalNotice}</p>"
+        assert variantNode.txtValue == f"第1話\n{traditionalNotice}\n"
+    assert node.isPasswordSkipped == s2tNode.isPasswordSkipped == (pageResult is False)
+    assert node.isEmpty == s2tNode.isEmpty == (pageResult is not False)
+
+
+def testFailedNoticeFollowsVariant(monkeypatch):
+    monkeypatch.setattr(esj, "log_message", lambda *args, **kwargs: None)
+    node = chapterNode()
+    node.buildCharacter(None, esj.ImgThreadSafeDict())
+    assert "章节下载失败" in node.txtValue
+    assert "章節下載失敗" in node.variantNodeList[0].txtValue
+    assert "<p>章節下載失敗</p>" in node.variantNodeList[1].epubValue.content
+
+
+def testExistingPlaceholderDetected():
+    # 已有文件为主版本
+    node = chapterNode()
+    node.loadExisting("<p>本章节需要密码，已跳过</p>".encode("utf-8"), "第1话\n本章节需要密码，已跳过\n")
+    assert node.isPasswordSkipped and not node.isEmpty
@@ -0,0 +1,98 @@
+# coding=utf-8
+"""测试与tools/toc_bench.py共用：随机生成章节目录，以及原先逐层扫描的目录生成与空卷过滤，仅作对照"""
+import random
+
+from bs4 import BeautifulSoup
+from ebooklib import epub
+
+import esj
+
+
+def chapterListHtml(chapterNum, seed):
+    """随机的章节目录：details卷、p卷、卷内嵌套的details与p子卷、卷外的章节与空的p，共chapterNum个章节以上"""
+    rng = random.Random(seed)
+    chapterIndex = 0
+
+    def links(num):
+        nonlocal chapterIndex
+        result = ''
+        for _ in range(num):
+            result += f'<a href="/forum/1/{chapterIndex}.html"><p>第{chapterIndex}話</p></a>'
+            chapterIndex += 1
+        return result
+
+    def volume(depth):
+        body = links(rng.randint(0, 6))
+        if depth < 3 and rng.random() < 0.3:
+            body += volume(depth + 1)
+        if rng.random() < 0.3:
+            # 卷内以p分隔的子卷，之后的章节都属于该子卷
+            body += f'<p>子卷{chapterIndex}</p>' + links(rng.randint(0, 4))
+        body += links(rng.randint(0, 6))
+        return f'<details><summary>卷{chapterIndex}</summary>{body}</details>'
+
+    htmlList = []
+    while chapterIndex < chapterNum:
+        choice = rng.random()
+        if choice < 0.1:
+            htmlList.append(links(1))
+        elif choice < 0.15:
+            htmlList.append('<p> </p>')
+        elif choice < 0.3:
+            htmlList.append(f'<p>卷{chapterIndex}</p>' + links(rng.randint(0, 8)))
+        else:
+            htmlList.append(volume(0))
+    return f'<div id="chapterList">{"".join(htmlList)}</div>'
+
+
+def buildNodeList(html):
+    """返回(节点列表, 目录深度)，节点的epubValue按序号命名"""
+    nodeList = []
+    depth = esj.contentsAnalysis(BeautifulSoup(html, 'html.parser').find('div').contents, nodeList, 0, -1)
+    for node in nodeList:
+        node.epubValue = epub.EpubHtml(title=node.title, file_name=f"novel_{node.value}.html", lang="zh")
+    return nodeList, depth
+
+
+def tocShape(tocList):
+    """目录转换为可比较的结构"""
+    return [(item[0].title, item[0].href, tocShape(item[1])) if isinstance(item, tuple) else item.file_name
+            for item in tocList]
+
+
+def legacyListAnalysisToc(inputList, maxDepth):
+    """原先的listAnalysisToc，每层扫描一次全部节点"""
+    resultList = []
+    for depth in range(maxDepth, -1, -1):
+        for character in inputList:
+            if character.level == depth:
+                if character.isVolume:
+                    volumeTuple = (epub.Section(character.title, character.epubValue.file_name),
+                                   character.childVolumeList)
+                    if character.fatherValue == -1:
+                        resultList.append(volumeTuple)
+                    else:
+                        inputList[character.fatherValue].childVolumeList.append(volumeTuple)
+                if character.isChapter:
+                    if character.fatherValue == -1:
+                        resultList.append(character.epubValue)
+                    else:
+                        inputList[character.fatherValue].childVolumeList.append(character.epubValue)
+    return resultList
+
+
+def legacyFilterEmptyVolumes(downloadList, selectChapterMode):
+    """原先downloadOneBook中的空卷过滤，每个卷扫描一次全部节点"""
+    finalList = []
+    for character in downloadList:
+        if character.isChapter:
+            finalList.append(character)
+        elif character.isVolume:
+            hasContent = False
+            for c in downloadList:
+                if c.isChapter and c.fatherValue == character.value:
+                    hasContent = True
+                    break
+            if hasContent or not selectChapterMode:
+                finalList.append(character)
+    return finalList
@@ -0,0 +1,78 @@
+"""
+繁简转换的性能测试：按章节批量转换(convertBatch)与原先逐段调用converter.convert的耗时对比
+随机组合繁体句子生成接近实际大小的书籍，默认300章、每章120段，另含全部章节标题与固定提示等重复的短文字
+两种方式的结果不一致时退出码为1
+
+用法: python tools/convert_bench.py [章节数] [每章段落数]
+"""
+
+import random
+import sys
+from pathlib import Path
+from time import perf_counter
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+import esj  # noqa: E402
+
+sentenceList = [
+    "「這樣真的好嗎？」她低聲問道。", "少年抬起頭，望向遠方的城牆。", "魔法陣發出耀眼的光芒，整個房間都被照亮了。",
+    "我們必須在天亮之前離開這裡。", "騎士團長沉默了許久，終於開口。", "……果然還是不行啊。", "冒險者公會的櫃檯前排著長長的隊伍。",
+    "她的頭髮在風中輕輕飄動。", "那是一個關於龍與勇者的古老傳說。", "「沒問題的，交給我吧！」", "後台的工作人員忙得不可開交。",
+    "學園祭的準備工作已經進入了最後階段。", "窗外傳來鳥兒的鳴叫聲。", "他握緊了手中的劍，向前邁出一步。",
+]
+# 每章都會出現的短文字
+boilerplateList = ["本章節需要密碼，已跳過", "【空】", "插圖", "（完）", "後記"]
+
+
+def buildBook(chapterNum, paragraphNum):
+    random.seed(4)
+    chapterList = []
+    for chapterIndex in range(chapterNum):
+        paragraphList = [''.join(random.choices(sentenceList, k=random.randint(1, 4))) for _ in range(paragraphNum)]
+        paragraphList += random.choices(boilerplateList, k=5)
+        chapterList.append(paragraphList)
+    titleList = [f"第{chapterIndex + 1}話 {random.choice(sentenceList)[:8]}" for chapterIndex in range(chapterNum)]
+    return chapterList, titleList
+
+
+def convertEach(chapterList, titleList):
+    return [[esj.converter.convert(text) for text in paragraphList] for paragraphList in chapterList], \
+        [esj.converter.convert(title) for title in titleList]
+
+
+def convertBatched(chapterList, titleList):
+    return [esj.convertBatch(paragraphList) for paragraphList in chapterList], esj.convertBatch(titleList)
+
+
+def bench(chapterNum, paragraphNum):
+    chapterList, titleList = buildBook(chapterNum, paragraphNum)
+    textNum = sum(len(paragraphList) for paragraphList in chapterList) + len(titleList)
+    charNum = sum(len(text) for paragraphList in chapterList for text in paragraphList)
+    print(f"{chapterNum}章, {textNum}段, {charNum}字")
+
+    startTime = perf_counter()
+    eachResult = convertEach(chapterList, titleList)
+    eachTime = perf_counter() - startTime
+
+    esj.convertCacheDict.clear()
+    startTime = perf_counter()
+    batchResult = convertBatched(chapterList, titleList)
+    batchTime = perf_counter() - startTime
+
+    # 再次转换时短文字命中缓存
+    startTime = perf_counter()
+    convertBatched(chapterList, titleList)
+    warmTime = perf_counter() - startTime
+
+    print(f"逐段转换: {eachTime * 1000:.0f}ms, {textNum} 次调用")
+    print(f"按章批量: {batchTime * 1000:.0f}ms, {chapterNum + 1} 次调用, 耗时比 {batchTime / eachTime:.2f}")
+    print(f"按章批量(缓存已有短文字): {warmTime * 1000:.0f}ms, 耗时比 {warmTime / eachTime:.2f}")
+    isSame = eachResult == batchResult
+    print("结果一致" if isSame else "结果不一致")
+    return isSame
+
+
+if __name__ == '__main__':
+    chapterNumArg = int(sys.argv[1]) if len(sys.argv) > 1 else 300
+    paragraphNumArg = int(sys.argv[2]) if len(sys.argv) > 2 else 120
+    sys.exit(0 if bench(chapterNumArg, paragraphNumArg) else 1)
@@ -0,0 +1,108 @@
+"""
+下载性能测试，使用tests/localsite.py的本地站点代替esjzone，每个请求固定延迟:
+1. img     不同线程数下ImgThreadSafeDict下载图片的吞吐量，默认64张图片、每张延迟50ms
+2. engine  多线程引擎与async引擎下载同一本书的耗时，并比对两者的txt，默认60章、每章2张图片、每个请求延迟100ms
+
+用法: python tools/download_bench.py img [图片数] [延迟秒数]
+      python tools/download_bench.py engine [章节数] [延迟秒数]
+"""
+
+import os
+import sys
+import tempfile
+import threading
+from os import path
+from pathlib import Path
+from time import perf_counter
+
+rootDir = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(rootDir))
+sys.path.insert(0, str(rootDir / "tests"))
+import esj  # noqa: E402
+from localsite import LocalSite  # noqa: E402
+
+
+def downloadImgs(urlList, threadCount):
+    """threadCount个线程从同一列表领取url，返回耗时"""
+    imgDict = esj.ImgThreadSafeDict()
+    urlIter = iter(urlList)
+    iterLock = threading.Lock()
+
+    def worker():
+        while True:
+            with iterLock:
+                url = next(urlIter, None)
+            if url is None:
+                return
+            imgDict.set(url)
+
+    threadList = [threading.Thread(target=worker) for _ in range(threadCount)]
+    startTime = perf_counter()
+    for thread in threadList:
+        thread.start()
+    for thread in threadList:
+        thread.join()
+    elapsed = perf_counter() - startTime
+    imgDict.imgStore.close()
+    return elapsed
+
+
+def benchImg(imgNum, delay):
+    site = LocalSite(delay=delay).start()
+    try:
+        for threadCount in (1, 2, 4, 8, 16):
+            # 每轮使用不同的url，不命中上一轮的结果
+            urlList = [site.baseUrl + f"img/{threadCount}_{index}.png" for index in range(imgNum)]
+            elapsed = downloadImgs(urlList, threadCount)
+            print(f"{threadCount:>2}线程: {imgNum}张 {elapsed:.2f}s, {imgNum / elapsed:.1f}张/s, "
+                  f"服务器最多同时处理 {site.peakInFlight} 个请求")
+            site.peakInFlight = 0
+    finally:
+        site.stop()
+
+
+def downloadBook(site, workDir, engine):
+    os.makedirs(workDir)
+    os.chdir(workDir)
+    esj.downloadEngine = engine
+    startTime = perf_counter()
+    esj.downloadOneBook(site.baseUrl + "detail/1.html")
+    elapsed = perf_counter() - startTime
+    with open(path.join(workDir, "txtBooks_esjzone", "《测试小说》作者甲.txt"), "rb") as txtFile:
+        return elapsed, txtFile.read()
+
+
+def benchEngine(chapterNum, delay):
+    site = LocalSite(delay=delay, chapterNum=chapterNum, imgNum=2).start()
+    esj.base_url = site.baseUrl
+    # 页面缓存与书籍清单按当前目录创建，每次运行都实际下载
+    esj.pageCacheMaxMB = 0
+    esj.bookManifestPath = ""
+    workDir = os.getcwd()
+    try:
+        with tempfile.TemporaryDirectory() as tempDir:
+            resultDict = {}
+            for engine, concurrency in [("thread", esj.threadNum), ("async", esj.asyncConcurrency)]:
+                site.peakInFlight = 0
+                elapsed, txtContent = downloadBook(site, path.join(tempDir, engine), engine)
+                resultDict[engine] = txtContent
+                print(f"{engine:>6}引擎(并发{concurrency}): {chapterNum}章 {elapsed:.2f}s, "
+                      f"服务器最多同时处理 {site.peakInFlight} 个请求")
+            print("txt一致" if resultDict["thread"] == resultDict["async"] else "txt不一致")
+    finally:
+        os.chdir(workDir)
+        site.stop()
+
+
+if __name__ == '__main__':
+    os.environ["NO_PROXY"] = "127.0.0.1"
+    # 不使用图片持久缓存，每张图片都实际下载
+    esj.imgCacheMaxMB = 0
+    esj.isAdaptiveRateLimit = False
+    esj.log_message = lambda *args, **kwargs: None
+    esj.printProgressBar = lambda *args, **kwargs: None
+    mode = sys.argv[1] if len(sys.argv) > 1 else "img"
+    if mode == "img":
+        benchImg(int(sys.argv[2]) if len(sys.argv) > 2 else 64, float(sys.argv[3]) if len(sys.argv) > 3 else 0.05)
+    elif mode == "engine":
+        benchEngine(int(sys.argv[2]) if len(sys.argv) > 2 else 60, float(sys.argv[3]) if len(sys.argv) > 3 else 0.1)
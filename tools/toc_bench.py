@@ -0,0 +1,46 @@
+"""
+目录生成的性能测试：下载整本书时的空卷过滤与目录生成(filterEmptyVolumes + listAnalysisToc)，与原先逐层扫描的实现对比
+使用tests/tocsample.py随机生成的章节目录，默认5000章(含多层嵌套的卷)，两者的目录不一致时退出码为1
+
+用法: python tools/toc_bench.py [章节数]
+"""
+
+import sys
+from pathlib import Path
+from timeit import timeit
+
+rootDir = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(rootDir))
+sys.path.insert(0, str(rootDir / "tests"))
+import esj  # noqa: E402
+from tocsample import buildNodeList, chapterListHtml, legacyFilterEmptyVolumes, legacyListAnalysisToc, tocShape  # noqa: E402
+
+
+def bench(chapterNum):
+    html = chapterListHtml(chapterNum, 0)
+    legacyList, depth = buildNodeList(html)
+    currentList, _ = buildNodeList(html)
+    print(f"{sum(node.isChapter for node in currentList)}章, {sum(node.isVolume for node in currentList)}卷, "
+          f"目录深度{depth + 1}")
+
+    def runLegacy():
+        for node in legacyList:
+            node.childVolumeList = []
+        return legacyListAnalysisToc(legacyFilterEmptyVolumes(legacyList, False), depth)
+
+    def runCurrent():
+        for node in currentList:
+            node.childVolumeList = []
+        return esj.listAnalysisToc(esj.filterEmptyVolumes(currentList, False))
+
+    number = 5
+    legacyTime = timeit(runLegacy, number=number) / number
+    currentTime = timeit(runCurrent, number=number) / number
+    print(f"原先: {legacyTime * 1000:.1f}ms, 当前: {currentTime * 1000:.1f}ms, 耗时比 {currentTime / legacyTime:.2f}")
+    isSame = tocShape(runLegacy()) == tocShape(runCurrent())
+    print("目录一致" if isSame else "目录不一致")
+    return isSame
+
+
+if __name__ == '__main__':
+    sys.exit(0 if bench(int(sys.argv[1]) if len(sys.argv) > 1 else 5000) else 1)
@@ -0,0 +1,175 @@
+"""
+章节正文转换(transformContents)的对照与性能测试:
+1. golden  用原先的htmlSimplified生成tests/golden/transform_corpus.json，tests/test_transform_golden.py据此检查当前实现
+2. fuzz    随机生成章节片段，比对原先实现与当前实现的html和txt输出，默认4000个
+3. bench   比较两者在长章节上的耗时，默认3000段
+
+用法: python tools/transform_bench.py golden|fuzz|bench [数量]
+"""
+
+import hashlib
+import html
+import json
+import random
+import re
+import sys
+from io import BytesIO
+from pathlib import Path
+from timeit import timeit
+
+from bs4 import BeautifulSoup, Tag
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+import esj  # noqa: E402
+
+corpusPath = Path(__file__).resolve().parent.parent / "tests" / "golden" / "transform_corpus.json"
+
+# 覆盖段落、原始文字、注释、图片、下载失败的图片、链接、空白、style/script/template、CDATA等情况
+fragmentList = [
+    '<p>段落 a&amp;b 繁體</p>', 'text &amp;lt;b&amp;gt; raw', '<!-- c -->', '<img src="/i/1.png">',
+    '<img src="/bad/2.png">', '<div><span>x</span><img src="/i/3.png">tail<br> </div>',
+    '<p><a href="http://h/1">link</a> more</p>', '\n  \n', '<p>\xa0</p>', '<div>  line1\r\nline2 \n\n line3</div>',
+    '<a href="">e</a>', '<a href="http://t">top</a>', '<p>é&lt;x&gt;</p>',
+    "<div><div><img src='/i/1.png'></div>mid<p>q</p></div>", '<br>', '<a href="http://img"><img src="/i/4.png">cap</a>',
+    '<div><a href="u1"><a href="u2">n</a></a></div>', '<style>p{}</style>', '<div><style>x</style>y</div>',
+    '<script>s()</script>', '<template><a href="q">t</a></template>', '<div><![CDATA[cd]]></div>', '<p> sep\x0bv</p>',
+    '<span><!--c2--><b>bold</b></span>'
+]
+
+
+def legacyHtmlSimplified(soup: BeautifulSoup, inputChildren: list, imgDict: esj.ImgThreadSafeDict,
+                         txtPieceList: list = None):
+    """原先的htmlSimplified，逐层find/find_all/get_text并在DOM中插入链接地址，仅作对照"""
+    htmlResult = ""
+    for child in inputChildren:
+        if isinstance(child, Tag):
+            if child.name == "img":
+                imgHtml = imgDict.set(child['src'])
+                htmlResult += imgHtml
+                if txtPieceList is not None:
+                    txtPieceList.append((False, imgDict.txtOf(imgHtml)))
+                continue
+            if child.find("img") is not None:
+                htmlResult += legacyHtmlSimplified(soup, child.contents, imgDict, txtPieceList)
+            else:
+                for a in child.find_all("a"):
+                    if a.get("isInsertedHrefValue") is not None:
+                        continue
+                    new_p_tag = soup.new_tag('p')
+                    href = a.get('href')
+                    if href is None or len(href) == 0:
+                        continue
+                    new_p_tag.string = f"[{href}]"
+                    a.insert(0, new_p_tag)
+                    a["isInsertedHrefValue"] = True
+                if len(re.sub('\\s', '', child.get_text())) == 0:
+                    continue
+                text_content = child.get_text(separator='\n', strip=True)
+                filtered_text = '\n'.join(line for line in text_content.split('\n') if line.strip())
+                filtered_text = esj.converter.convert(filtered_text)
+                unescaped_string = html.escape(filtered_text)
+                paragraphs = unescaped_string.splitlines()
+                wrapped_paragraphs = ['<p>' + paragraph.strip() + '</p>' for paragraph in paragraphs]
+                htmlResult += '\n'.join(wrapped_paragraphs)
+                if txtPieceList is not None:
+                    txtPieceList.extend((False, paragraph) for paragraph in filtered_text.splitlines())
+        else:
+            htmlResult += str(child)
+            if txtPieceList is not None:
+                txtPieceList.append((True, str(child)))
+    if txtPieceList is not None:
+        txtPieceList.append((True, '\n'))
+    return htmlResult + '\n'
+
+
+def fakeImgData(url):
+    """不联网，按url生成图片，含bad的url视为下载失败"""
+    if 'bad' in url:
+        return None, None, None, None
+    return BytesIO(b'img'), '.png', hashlib.md5(url.encode()).hexdigest()[:8], 'image/png'
+
+
+def randomChapter(depth=0):
+    result = ''
+    for _ in range(random.randint(0, 5)):
+        if depth < 4 and random.random() < 0.25:
+            result += random.choice(['<div>', '<p>', '<span>', '<a href="http://n">']) + randomChapter(depth + 1) + '</div>'
+        else:
+            result += random.choice(fragmentList)
+    return '<div class="forum-content mt-3">' + result + '</div>'
+
+
+def legacyOutput(chapterHtml):
+    soup = BeautifulSoup(chapterHtml, 'html.parser')
+    txtPieceList = []
+    htmlResult = legacyHtmlSimplified(soup, soup.find('div').contents, esj.ImgThreadSafeDict(), txtPieceList)
+    return htmlResult, esj.simplifiedTxt(txtPieceList)
+
+
+def currentOutput(chapterHtml):
+    soup = BeautifulSoup(chapterHtml, 'html.parser')
+    txtPieceList = []
+    htmlResult = esj.htmlSimplified(soup.find('div').contents, esj.ImgThreadSafeDict(), txtPieceList)
+    return htmlResult, esj.simplifiedTxt(txtPieceList)
+
+
+def writeGolden(randomNum):
+    random.seed(1)
+    chapterList = ['<div class="forum-content mt-3">' + fragment + '</div>' for fragment in fragmentList]
+    chapterList += [randomChapter() for _ in range(randomNum)]
+    caseList = []
+    for chapterHtml in chapterList:
+        htmlResult, txtResult = legacyOutput(chapterHtml)
+        caseList.append({"input": chapterHtml, "html": htmlResult, "txt": txtResult})
+    corpusPath.parent.mkdir(exist_ok=True)
+    corpusPath.write_text(json.dumps(caseList, ensure_ascii=False, indent=1), encoding="utf-8")
+    print(f"写入{len(caseList)}个用例: {corpusPath}")
+
+
+def fuzz(caseNum):
+    random.seed(2)
+    badNum = 0
+    for _ in range(caseNum):
+        chapterHtml = randomChapter()
+        if legacyOutput(chapterHtml) != currentOutput(chapterHtml):
+            badNum += 1
+            if badNum <= 3:
+                print(f"不一致: {chapterHtml!r}")
+    print(f"{caseNum}个片段，不一致{badNum}个")
+    return badNum == 0
+
+
+def bench(paragraphNum):
+    random.seed(3)
+    chapterHtml = '<div class="forum-content mt-3">' + ''.join(
+        random.choice(['<p>　　正文段落，含<b>粗体</b>。</p>', '<p><br></p>', '<p>「对话」<a href="http://h/1">链接</a></p>',
+                       '<div><img src="/i/1.png"><p>插图说明</p></div>']) for _ in range(paragraphNum)) + '</div>'
+    # 解析不计入耗时，原先的实现会修改DOM，每次使用新的解析结果
+    number = 5
+    legacySoupList = [BeautifulSoup(chapterHtml, 'html.parser') for _ in range(number)]
+    currentSoupList = [BeautifulSoup(chapterHtml, 'html.parser') for _ in range(number)]
+    imgDict = esj.ImgThreadSafeDict()
+
+    def runLegacy():
+        soup = legacySoupList.pop()
+        legacyHtmlSimplified(soup, soup.find('div').contents, imgDict)
+
+    legacyTime = timeit(runLegacy, number=number) / number
+    currentTime = timeit(lambda: esj.htmlSimplified(currentSoupList.pop().find('div').contents, imgDict),
+                         number=number) / number
+    print(f"{paragraphNum}段: 原先 {legacyTime * 1000:.1f}ms, 当前 {currentTime * 1000:.1f}ms, "
+          f"耗时比 {currentTime / legacyTime:.2f}")
+
+
+if __name__ == '__main__':
+    esj.getImgData = fakeImgData
+    # 下载失败的图片会逐个记日志，对照时不需要
+    esj.log_message = lambda *args, **kwargs: None
+    mode = sys.argv[1] if len(sys.argv) > 1 else "bench"
+    count = int(sys.argv[2]) if len(sys.argv) > 2 else None
+    if mode == "golden":
+        writeGolden(count or 40)
+    elif mode == "fuzz":
+        sys.exit(0 if fuzz(count or 4000) else 1)
+    else:
+        bench(count or 3000)